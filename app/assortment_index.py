@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Dict
+
+from . import cache
+
+
+def href_id(href: str) -> str:
+    return (href or "").split("?", 1)[0].rstrip("/").split("/")[-1]
+
+
+def save_index(
+    cache_dir: str,
+    articles: Dict[str, str],
+    bundles: Dict[str, Dict[str, Any]],
+    partial: bool = False,
+) -> None:
+    """
+    Индекс для точечного пересчёта (пишет полный stock sync):
+    articles: id товара -> артикул; bundles: id комплекта -> {article, components: [[id, qty]]}.
+    Комплекты сливаются с прежним индексом: при лимите времени прогон считает не все.
+    partial — артикулы резолвились не все (шард): сливаются с прежними, articles_ts
+    (время полного резолва) не обновляется.
+    """
+    old = load_index(cache_dir)
+    data = {
+        "articles": {**(old.get("articles") or {}), **articles} if partial else articles,
+        "articles_ts": old.get("articles_ts", 0) if partial else time.time(),
+        "bundles": {**(old.get("bundles") or {}), **bundles},
+    }
+    cache.store(cache_dir, "assortment_index").put("index", data)
+
+
+def fresh_articles(cache_dir: str, max_age_s: float) -> Dict[str, str]:
+    """id товара -> артикул из индекса, если полный резолв был не раньше max_age_s назад."""
+    data = load_index(cache_dir)
+    if time.time() - float(data.get("articles_ts") or 0) > max_age_s:
+        return {}
+    return data.get("articles") or {}
+
+
+def load_index(cache_dir: str) -> Dict[str, Any]:
+    try:
+        data = cache.store(cache_dir, "assortment_index").get("index")
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def bundle_entry(full: Dict[str, Any], article: str) -> Dict[str, Any]:
+    comps = ((full.get("components") or {}).get("rows")) or []
+    return {
+        "article": article,
+        "components": [
+            [href_id(((c.get("assortment") or {}).get("meta") or {}).get("href") or ""), float(c.get("quantity") or 0)]
+            for c in comps
+        ],
+    }
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+from urllib.parse import quote
+
+import requests
+
+from . import cache
+from .http import HttpError, clear_last_attempt, last_attempt
+from .log import log_json
+
+T = TypeVar("T")
+
+# BATCH_ADAPTIVE=0 — размеры фиксированные (start из LIMITS), без подстройки
+ADAPTIVE = os.getenv("BATCH_ADAPTIVE", "1") != "0"
+# целевая длительность одного запроса: быстрее — страница растёт, медленнее — уменьшается
+TARGET_S = max(0.1, float(os.getenv("BATCH_TARGET_S", "2") or 2))
+# потолок тела запроса/ответа одной страницы
+MAX_PAYLOAD_BYTES = max(64, int(os.getenv("BATCH_MAX_PAYLOAD_KB", "8192") or 8192)) * 1024
+# длина URL целиком (фильтры filter=id=...;id=... в query); дальше 414
+MAX_URL = max(1024, int(os.getenv("HTTP_MAX_URL", "8000") or 8000))
+
+# доля ошибок среди последних ERROR_WINDOW запросов, при которой размер не растёт
+ERROR_WINDOW = 20
+MAX_ERROR_RATE = 0.2
+# рост за один запрос — не больше чем вдвое; уменьшение по латентности — не больше чем вдвое
+GROWTH = 2.0
+# после стольких полных успешных батчей на потолке, сниженном 413/414, он пробно поднимается на четверть
+CAP_PROBE_AFTER = 50
+
+# выученные размеры между прогонами (неделя — потом снова от start); потолок от
+# 413/414 не сохраняется — он живёт в пределах прогона
+_STORE_NS = "batch_sizes"
+_STORE_TTL_S = 7 * 24 * 3600
+
+
+@dataclass(frozen=True)
+class Limit:
+    max: int          # документированный максимум эндпоинта
+    start: int        # без истории начинаем с него
+    min: int = 1
+    url: bool = False  # элементы батча идут в query (filter=...) — режется длиной URL
+
+
+LIMITS: Dict[str, Limit] = {
+    # МойСклад: limit до 1000 (без expand)
+    "ms.report_stock_bystore": Limit(1000, 1000),
+    "ms.entity_bundle": Limit(1000, 100),
+    "ms.entity_by_ids": Limit(1000, 100, url=True),
+    "ms.stock_current": Limit(1000, 100, url=True),
+    # Ozon
+    "ozon.product_list": Limit(1000, 1000),
+    "ozon.product_list_offers": Limit(1000, 1000),
+    "ozon.supply_order_list": Limit(100, 100),
+    "ozon.stocks": Limit(100, 100),
+    "ozon.fbs_list": Limit(1000, 1000),
+}
+
+
+class Sizer:
+    """
+    Размер страницы/батча одного эндпоинта в пределах [min, cap], cap <= max.
+
+    - запрос быстрее TARGET_S и полный батч — размер растёт к n * TARGET_S / elapsed
+      (не больше чем вдвое за раз), если ошибок немного;
+    - медленнее TARGET_S — уменьшается пропорционально;
+    - тело больше MAX_PAYLOAD_BYTES — уменьшается по байтам на элемент;
+    - 413/414 — cap падает до половины отвергнутого батча; после CAP_PROBE_AFTER
+      полных успешных батчей на нём снова поднимается (к max);
+    - таймаут/5xx — размер вдвое меньше отвергнутого батча.
+    """
+
+    def __init__(self, name: str, limit: Limit, size: Optional[int] = None):
+        self.name = name
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.cap = limit.max
+        self._at_cap = 0
+        self._size = self._clamp(size or limit.start, self.cap)
+        self._errors: Deque[bool] = deque(maxlen=ERROR_WINDOW)
+        self.stats = {"requests": 0, "requested": 0, "grown": 0, "shrunk": 0, "rejected": 0, "failed": 0}
+
+    def _clamp(self, n: int, hi: int) -> int:
+        return max(self.limit.min, min(int(n), hi, self.limit.max))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _set(self, n: int) -> None:
+        n = self._clamp(n, self.cap)
+        if n > self._size:
+            self.stats["grown"] += 1
+        elif n < self._size:
+            self.stats["shrunk"] += 1
+        self._size = n
+
+    def observe(self, n: int, elapsed_s: float, payload_bytes: int = 0) -> None:
+        """Успешный запрос на n элементов."""
+        with self._lock:
+            self._errors.append(False)
+            self.stats["requests"] += 1
+            self.stats["requested"] += n
+            if not ADAPTIVE or n <= 0:
+                return
+            cur = self._size
+            if self.cap < self.limit.max and n >= self.cap:
+                self._at_cap += 1
+                if self._at_cap >= CAP_PROBE_AFTER:
+                    self._at_cap = 0
+                    self.cap = self._clamp(self.cap + max(1, self.cap // 4), self.limit.max)
+            ideal = n * TARGET_S / max(elapsed_s, 1e-3)
+            if payload_bytes > 0:
+                ideal = min(ideal, n * MAX_PAYLOAD_BYTES / payload_bytes)
+            if ideal < n:
+                self._set(max(cur // 2, min(cur, int(ideal))))
+            elif n >= cur and sum(self._errors) <= MAX_ERROR_RATE * len(self._errors):
+                self._set(max(cur, min(int(cur * GROWTH), int(ideal))))
+
+    def failed(self, n: int, too_large: bool) -> None:
+        """Запрос на n элементов не прошёл: too_large — 413/414, иначе таймаут/5xx."""
+        with self._lock:
+            self._errors.append(True)
+            self.stats["rejected" if too_large else "failed"] += 1
+            if not ADAPTIVE:
+                return
+            if too_large:
+                self.cap = self._clamp(n // 2, self.cap)
+                self._at_cap = 0
+            self._set(min(self._size, max(1, n // 2)))
+
+    def fit(self, items: Sequence[str], start: int, used: int, key: str = "") -> int:
+        """
+        Сколько items, начиная со start (до size), влезает в URL, где уже занято
+        used символов; в фильтре элемент — key=<item>.
+        """
+        n = self._size
+        if not self.limit.url:
+            return min(n, len(items) - start)
+        room = MAX_URL - used
+        count = 0
+        for x in items[start:start + n]:
+            # в query кодируются и "=", и разделитель ";"
+            room -= len(quote(f"{key}={x}" if key else x, safe="")) + len("%3B")
+            if room < 0:
+                break
+            count += 1
+        return max(1, count)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": self._size, "cap": self.cap, "max": self.limit.max, **self.stats}
+
+
+_sizers: Dict[str, Sizer] = {}
+_learned: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+
+def sizer(name: str) -> Sizer:
+    with _lock:
+        s = _sizers.get(name)
+        if s is None:
+            prev = _learned.get(name) or {}
+            s = _sizers[name] = Sizer(name, LIMITS[name], prev.get("size"))
+        return s
+
+
+def size(name: str) -> int:
+    return sizer(name).size
+
+
+def call(name: str, n: int, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    fn(*args, **kwargs) — один запрос на n элементов эндпоинта name;
+    латентность, размер тела и отказы идут в его Sizer. Латентность — последней
+    (успешной) попытки request_json: ретраи, 429 и ожидание лимитера к размеру
+    батча отношения не имеют. Если запрос шёл не в этом потоке — время вызова целиком.
+    """
+    s = sizer(name)
+    clear_last_attempt()
+    t0 = time.perf_counter()
+    try:
+        out = fn(*args, **kwargs)
+    except HttpError as e:
+        if e.status in (413, 414):
+            s.failed(n, too_large=True)
+        elif e.status == 408 or e.status >= 500:
+            s.failed(n, too_large=False)
+        raise
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        s.failed(n, too_large=False)
+        raise
+    attempt = last_attempt()
+    elapsed, payload = attempt if attempt is not None else (time.perf_counter() - t0, 0)
+    s.observe(n, elapsed, payload)
+    return out
+
+
+def batches(
+    name: str,
+    items: Sequence[str],
+    fn: Callable[[List[str]], T],
+    *,
+    url_used: int = 0,
+    url_key: str = "",
+) -> Iterator[Tuple[List[str], T]]:
+    """
+    (часть, fn(часть)) по items батчами текущего размера (с учётом длины URL,
+    если элементы идут в query как url_key=<item>; url_used — длина остального URL). Размер
+    пересчитывается перед каждым батчем; батч, отвергнутый 413/414, делится
+    пополам и повторяется.
+    """
+    s = sizer(name)
+    items = list(items)
+    retry: Deque[List[str]] = deque()
+    i = 0
+    while retry or i < len(items):
+        if retry:
+            part = retry.popleft()
+        else:
+            part = items[i:i + s.fit(items, i, url_used, url_key)]
+            i += len(part)
+        try:
+            out = call(name, len(part), fn, part)
+        except HttpError as e:
+            if e.status in (413, 414) and len(part) > 1:
+                half = len(part) // 2
+                retry.extendleft([part[half:], part[:half]])
+                continue
+            raise
+        yield part, out
+
+
+def restore(cache_dir: str) -> None:
+    """Размеры, выученные прошлыми прогонами (до первого обращения к эндпоинтам)."""
+    try:
+        learned = cache.store(cache_dir, _STORE_NS).get_many(LIMITS)
+    except Exception:
+        return
+    with _lock:
+        _learned.update(learned)
+
+
+def report(logger: logging.Logger, cache_dir: str, job: str) -> None:
+    """
+    Итоговые размеры в лог и в кэш — следующий прогон начнёт с них. Пишутся только
+    изменившиеся: неизменные доживают свой срок и потом учатся заново.
+    """
+    with _lock:
+        sizers = dict(_sizers)
+    if not sizers:
+        return
+    summary = {name: s.summary() for name, s in sorted(sizers.items())}
+    log_json(logger, "batch_sizes", job=job, endpoints=summary)
+    if not ADAPTIVE:
+        return
+    with _lock:
+        changed = {
+            name: {"size": v["size"]}
+            for name, v in summary.items()
+            if (_learned.get(name) or {}).get("size") != v["size"]
+        }
+    if not changed:
+        return
+    try:
+        cache.store(cache_dir, _STORE_NS, ttl_s=_STORE_TTL_S).put_many(changed)
+        with _lock:
+            _learned.update(changed)
+    except Exception as e:
+        log_json(logger, "batch_sizes_save_failed", job=job, error=str(e))
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Tuple
+from urllib.parse import urlparse
+
+# Ozon читает через POST: такие методы считаем чтением, а не записью
+_OZON_READ_SUFFIXES = ("/list", "/get", "/items", "/info")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+@dataclass
+class CircuitOpenError(Exception):
+    host: str
+    endpoint_class: str
+    retry_in: float
+
+    def __str__(self) -> str:
+        return f"circuit open for {self.host} ({self.endpoint_class}), retry in {self.retry_in:.0f}s"
+
+
+def endpoint_class(method: str, url: str) -> str:
+    """read | write — чтобы отказ записи в МС не блокировал чтение и наоборот."""
+    if method.upper() == "GET":
+        return "read"
+    path = urlparse(url).path.rstrip("/")
+    if method.upper() == "POST" and path.endswith(_OZON_READ_SUFFIXES):
+        return "read"
+    return "write"
+
+
+class Breaker:
+    """
+    Скользящее окно последних `window` попыток. Доля сбоев >= threshold
+    (при хотя бы min_calls попытках) или `consecutive` сбоев подряд (хост лежит,
+    а запросы идут по одному) — открыт на cooldown секунд, дальше
+    полуоткрыт: пропускает один пробный запрос; успех закрывает, сбой снова открывает.
+    """
+
+    def __init__(self, threshold: float, min_calls: int, window: int, cooldown_s: float, consecutive: int):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.consecutive = consecutive
+        self.cooldown_s = cooldown_s
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes: Deque[bool] = deque(maxlen=window)  # True — сбой
+        self._streak = 0
+        self._probe_at = 0.0  # >0 — пробный запрос в полёте
+        self._lock = threading.Lock()
+
+    def before(self, host: str, cls: str) -> None:
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            left = self.opened_at + self.cooldown_s - now
+            if self.state == OPEN and left <= 0:
+                self.state = HALF_OPEN
+            # зависший пробный запрос (без record) не держит цепь вечно
+            if self.state == HALF_OPEN and (not self._probe_at or now - self._probe_at > self.cooldown_s):
+                self._probe_at = now
+                return
+            self.rejected += 1
+            raise CircuitOpenError(host, cls, max(0.0, left))
+
+    def record(self, failed: bool) -> None:
+        with self._lock:
+            if self.state == HALF_OPEN and self._probe_at:
+                self._probe_at = 0.0
+                if failed:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self.state != CLOSED:
+                return
+            self._outcomes.append(failed)
+            self._streak = self._streak + 1 if failed else 0
+            n = len(self._outcomes)
+            if self._streak >= self.consecutive or (
+                n >= self.min_calls and sum(self._outcomes) / n >= self.threshold
+            ):
+                self._open()
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == OPEN and time.monotonic() < self.opened_at + self.cooldown_s
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self._outcomes.clear()
+        self._streak = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "window_calls": len(self._outcomes),
+                "window_failures": sum(self._outcomes),
+            }
+
+
+THRESHOLD = float(os.getenv("BREAKER_THRESHOLD", "0.5") or 0.5)
+MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "20") or 20)
+WINDOW = int(os.getenv("BREAKER_WINDOW", "50") or 50)
+COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN", "30") or 30)
+CONSECUTIVE = int(os.getenv("BREAKER_CONSECUTIVE", "5") or 5)
+
+_breakers: Dict[Tuple[str, str], Breaker] = {}
+_reg_lock = threading.Lock()
+
+
+def _get(method: str, url: str) -> Tuple[Breaker, str, str]:
+    host = (urlparse(url).hostname or "").lower()
+    cls = endpoint_class(method, url)
+    b = _breakers.get((host, cls))
+    if b is None:
+        with _reg_lock:
+            b = _breakers.get((host, cls))
+            if b is None:
+                b = _breakers[(host, cls)] = Breaker(THRESHOLD, MIN_CALLS, WINDOW, COOLDOWN_S, CONSECUTIVE)
+    return b, host, cls
+
+
+def before(method: str, url: str) -> None:
+    """Бросает CircuitOpenError, если для host/класса эндпоинта цепь разомкнута."""
+    b, host, cls = _get(method, url)
+    b.before(host, cls)
+
+
+def record(method: str, url: str, failed: bool) -> None:
+    _get(method, url)[0].record(failed)
+
+
+def is_open(method: str, url: str) -> bool:
+    return _get(method, url)[0].is_open()
+
+
+def summary() -> List[Dict[str, Any]]:
+    with _reg_lock:
+        items = sorted(_breakers.items())
+    return [{"host": h, "class": c, **b.snapshot()} for (h, c), b in items]
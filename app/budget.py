@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Dict, Optional
+
+from . import cache
+
+
+class Budget:
+    """
+    Лимит времени на прогон (RUN_BUDGET_S), чтобы прогон не наезжал на следующий таймер.
+    seconds <= 0 — без лимита.
+    """
+
+    def __init__(self, seconds: float, started: Optional[float] = None):
+        self.seconds = float(seconds or 0)
+        self.started = time.monotonic() if started is None else started
+        self.exhausted_at: Optional[str] = None  # этап, на котором время кончилось
+
+    @property
+    def limited(self) -> bool:
+        return self.seconds > 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        if not self.limited:
+            return float("inf")
+        return self.seconds - self.elapsed()
+
+    def expired(self, reserve_s: float = 0.0, stage: str = "") -> bool:
+        """
+        True, если осталось меньше reserve_s. Первый сработавший этап запоминается
+        (для лога/сводки).
+        """
+        if self.remaining() >= reserve_s:
+            return False
+        if self.exhausted_at is None:
+            self.exhausted_at = stage or "unknown"
+        return True
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "budget_s": self.seconds or None,
+            "elapsed_s": round(self.elapsed(), 3),
+            "exhausted_at": self.exhausted_at,
+        }
+
+
+class Checkpoint:
+    """
+    Недоделанная работа прогона: запись <job> в кэше (пространство "checkpoint").
+    Пишется, когда бюджет кончился; удаляется после полного прогона.
+    """
+
+    def __init__(self, cache_dir: str, job: str):
+        self.job = job
+        self.store = cache.store(cache_dir, "checkpoint")
+
+    def load(self, max_age_s: Optional[float] = None) -> Dict[str, Any]:
+        try:
+            data = self.store.get(self.job)
+        except Exception:
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        if max_age_s is not None and time.time() - float(data.get("ts") or 0) > max_age_s:
+            return {}
+        return data.get("state") or {}
+
+    def save(self, state: Dict[str, Any]) -> None:
+        self.store.put(self.job, {"ts": time.time(), "state": state})
+
+    def clear(self) -> None:
+        self.store.delete(self.job)
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+from . import trace
+from .config import CabinetConfig, Config
+from .ozon_client import OzonClient, OzonCreds
+
+T = TypeVar("T")
+
+def ozon_clients(cfg: Config) -> List[Tuple[CabinetConfig, OzonClient]]:
+    """
+    Клиенты Ozon по всем кабинетам из конфига (в порядке конфига).
+    """
+    out: List[Tuple[CabinetConfig, OzonClient]] = []
+    for cab in cfg.cabinets:
+        creds = OzonCreds(cab.name, cab.client_id, cab.api_key, cab.warehouse_id)
+        out.append((cab, OzonClient(creds, cfg.cache_dir)))
+    return out
+
+def run_per_cabinet(
+    fn: Callable[[CabinetConfig, OzonClient], T],
+    clients: List[Tuple[CabinetConfig, OzonClient]],
+) -> Dict[str, Tuple[T | None, Exception | None]]:
+    """
+    Запускает fn параллельно по кабинетам (один поток на кабинет).
+    Возвращает name -> (result, error); исключение одного кабинета не роняет остальные.
+    """
+    out: Dict[str, Tuple[T | None, Exception | None]] = {}
+    if not clients:
+        return out
+
+    with ThreadPoolExecutor(max_workers=len(clients), thread_name_prefix="cab") as pool:
+        futs = {cab.name: pool.submit(trace.bind(fn), cab, oz) for cab, oz in clients}
+        for name, fut in futs.items():
+            try:
+                out[name] = (fut.result(), None)
+            except Exception as e:
+                out[name] = (None, e)
+    return out
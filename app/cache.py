@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from . import jsoncodec
+
+DB_FILE = "cache.sqlite3"
+
+# версия таблиц самого кэша: при смене база пересоздаётся
+_DB_VERSION = 1
+
+# потолок размера значений в базе; сверх него вытесняются давно не читанные записи
+MAX_BYTES = max(1, int(os.getenv("CACHE_MAX_MB", "256") or 256)) * 1024 * 1024
+
+# время чтения обновляется не чаще раза в столько секунд (чтение не должно писать каждый раз)
+_TOUCH_S = 60.0
+
+_SCHEMA_SQL = """
+CREATE TABLE entries (
+    ns       TEXT    NOT NULL,
+    key      TEXT    NOT NULL,
+    schema   INTEGER NOT NULL,
+    value    BLOB    NOT NULL,
+    size     INTEGER NOT NULL,
+    expires  REAL,
+    accessed REAL    NOT NULL,
+    PRIMARY KEY (ns, key)
+) WITHOUT ROWID;
+CREATE INDEX entries_accessed ON entries (accessed);
+"""
+
+
+class Cache:
+    """
+    Кэш прогонов в <cache_dir>/cache.sqlite3: пространства имён с ключами,
+    значения — JSON (orjson, если есть). Каждая запись — одна транзакция SQLite
+    (WAL), так что прерванный прогон не оставляет полузаписанного состояния,
+    а параллельные процессы (stock sync и orders sync) не мешают друг другу.
+    """
+
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = self._connect()
+        self._size = int(self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0])
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        if db.execute("PRAGMA user_version").fetchone()[0] != _DB_VERSION:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DROP TABLE IF EXISTS entries")
+            for stmt in _SCHEMA_SQL.split(";"):
+                if stmt.strip():
+                    db.execute(stmt)
+            db.execute(f"PRAGMA user_version={_DB_VERSION}")
+            db.execute("COMMIT")
+        return db
+
+    def get_many(self, ns: str, keys: Iterable[str], schema: int) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        now = time.time()
+        out: Dict[str, Any] = {}
+        stale: list = []
+        touch: list = []
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT key, schema, value, expires, accessed FROM entries"
+                    f" WHERE ns = ? AND key IN ({','.join('?' * len(part))})",
+                    (ns, *part),
+                ).fetchall()
+                for key, sch, value, expires, accessed in rows:
+                    if sch != schema or (expires is not None and expires <= now):
+                        stale.append((ns, key))
+                        continue
+                    try:
+                        out[key] = jsoncodec.loads(value)
+                    except Exception:
+                        stale.append((ns, key))
+                        continue
+                    if now - accessed > _TOUCH_S:
+                        touch.append((now, ns, key))
+            if stale or touch:
+                def write(db: sqlite3.Connection) -> int:
+                    freed = self._sizes(db, ns, [k for _, k in stale])
+                    db.executemany("DELETE FROM entries WHERE ns = ? AND key = ?", stale)
+                    db.executemany("UPDATE entries SET accessed = ? WHERE ns = ? AND key = ?", touch)
+                    return freed
+
+                self._size -= self._write(write)
+        return out
+
+    def put_many(
+        self,
+        ns: str,
+        items: Mapping[str, Any],
+        schema: int,
+        ttl_s: Optional[float],
+        replace: bool = False,
+    ) -> None:
+        now = time.time()
+        expires = now + ttl_s if ttl_s else None
+        rows = []
+        for key, value in items.items():
+            blob = jsoncodec.dumps_bytes(value)
+            rows.append((ns, str(key), schema, blob, len(blob), expires, now))
+
+        def write(db: sqlite3.Connection) -> int:
+            # перезаписываемые значения больше не занимают места
+            if replace:
+                freed = self._ns_size(db, ns)
+                db.execute("DELETE FROM entries WHERE ns = ?", (ns,))
+            else:
+                freed = self._sizes(db, ns, [r[1] for r in rows])
+            db.executemany(
+                "INSERT OR REPLACE INTO entries (ns, key, schema, value, size, expires, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            return freed
+
+        with self._lock:
+            self._size += sum(r[4] for r in rows) - self._write(write)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, ns: str, keys: Optional[Iterable[str]] = None) -> None:
+        def write(db: sqlite3.Connection) -> int:
+            if keys is None:
+                freed = self._ns_size(db, ns)
+                db.execute("DELETE FROM entries WHERE ns = ?", (ns,))
+            else:
+                names = [str(k) for k in keys]
+                freed = self._sizes(db, ns, names)
+                db.executemany("DELETE FROM entries WHERE ns = ? AND key = ?", [(ns, k) for k in names])
+            return freed
+
+        with self._lock:
+            self._size -= self._write(write)
+
+    @staticmethod
+    def _ns_size(db: sqlite3.Connection, ns: str) -> int:
+        return int(db.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE ns = ?", (ns,)).fetchone()[0])
+
+    @staticmethod
+    def _sizes(db: sqlite3.Connection, ns: str, keys: List[str]) -> int:
+        """Сколько сейчас занимают значения keys (для учёта размера при перезаписи/удалении)."""
+        total = 0
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            total += int(db.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE ns = ? AND key IN ({','.join('?' * len(part))})",
+                (ns, *part),
+            ).fetchone()[0])
+        return total
+
+    def _write(self, fn) -> Any:
+        """fn(db) одной транзакцией; возвращает результат fn."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            out = fn(self._db)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return out
+
+    def _evict(self) -> None:
+        """Просроченные записи, затем давно не читанные — до 90% потолка."""
+        target = int(self.max_bytes * 0.9)
+
+        def write(db: sqlite3.Connection) -> int:
+            db.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+            total = int(db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0])
+            victims = []
+            for ns, key, size in db.execute("SELECT ns, key, size FROM entries ORDER BY accessed"):
+                if total <= target:
+                    break
+                victims.append((ns, key))
+                total -= size
+            db.executemany("DELETE FROM entries WHERE ns = ? AND key = ?", victims)
+            return total
+
+        self._size = self._write(write)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class Store:
+    """
+    Пространство имён кэша. schema — версия формата значений: записи другой
+    версии считаются отсутствующими. ttl_s — срок жизни записи по умолчанию.
+    """
+
+    def __init__(self, cache: Cache, ns: str, schema: int = 1, ttl_s: Optional[float] = None):
+        self.cache = cache
+        self.ns = ns
+        self.schema = schema
+        self.ttl_s = ttl_s
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.cache.get_many(self.ns, [key], self.schema).get(key, default)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        return self.cache.get_many(self.ns, keys, self.schema)
+
+    def put(self, key: str, value: Any, ttl_s: Optional[float] = None) -> None:
+        self.cache.put_many(self.ns, {key: value}, self.schema, ttl_s or self.ttl_s)
+
+    def put_many(self, items: Mapping[str, Any], ttl_s: Optional[float] = None) -> None:
+        self.cache.put_many(self.ns, items, self.schema, ttl_s or self.ttl_s)
+
+    def replace(self, items: Mapping[str, Any], ttl_s: Optional[float] = None) -> None:
+        """Всё пространство имён целиком заменяется на items (одной транзакцией)."""
+        self.cache.put_many(self.ns, items, self.schema, ttl_s or self.ttl_s, replace=True)
+
+    def delete(self, key: str) -> None:
+        self.cache.delete(self.ns, [key])
+
+    def clear(self) -> None:
+        self.cache.delete(self.ns)
+
+
+_caches: Dict[str, Cache] = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(cache_dir: str) -> Cache:
+    """Один Cache на каталог в процессе; битая база пересоздаётся."""
+    path = os.path.join(os.path.abspath(cache_dir), DB_FILE)
+    with _caches_lock:
+        c = _caches.get(path)
+        if c is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                c = Cache(path)
+            except sqlite3.DatabaseError:
+                for suffix in ("", "-wal", "-shm"):
+                    try:
+                        os.remove(path + suffix)
+                    except FileNotFoundError:
+                        pass
+                c = Cache(path)
+            _caches[path] = c
+        return c
+
+
+def store(cache_dir: str, ns: str, schema: int = 1, ttl_s: Optional[float] = None) -> Store:
+    return Store(open_cache(cache_dir), ns, schema, ttl_s)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def legacy_json(path: str) -> Tuple[bool, Any]:
+    """
+    Прежний JSON-файл кэша (до cache.sqlite3): (found, data). Файл не удаляется —
+    это делает migrate_json после записи в Store. Нечитаемый файл удаляется сразу
+    (переносить нечего).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return True, json.load(f)
+    except FileNotFoundError:
+        return False, None
+    except Exception:
+        _remove(path)
+        return False, None
+
+
+def migrate_json(
+    path: str,
+    st: Store,
+    key: str,
+    convert: Callable[[Any], Any] = lambda data: data,
+    ttl_s: Optional[float] = None,
+) -> Any:
+    """
+    Переносит прежний JSON-файл в запись key пространства st: convert(data) — значение
+    (None — переносить нечего, например устарело). Файл удаляется только после
+    успешной записи: если она упала, следующий прогон перенесёт его снова.
+    Возвращает перенесённое значение (None — файла нет или нечего переносить).
+    """
+    found, data = legacy_json(path)
+    if not found:
+        return None
+    value = convert(data)
+    if value is not None:
+        st.put(key, value, ttl_s)
+    _remove(path)
+    return value
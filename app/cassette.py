@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Запись/воспроизведение HTTP для профилирования без сети:
+#   HTTP_CASSETTE_MODE=record|replay
+#   HTTP_CASSETTE_PATH=/path/run.jsonl.gz
+#   HTTP_CASSETTE_LATENCY=zero|recorded   (только для replay)
+
+# заголовки с секретами в файл не пишутся
+SECRET_HEADERS = {"authorization", "api-key", "client-id", "cookie", "set-cookie"}
+# заголовки ответа, которые теряют смысл после декодирования тела
+_DROP_RESP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+# "to": now() и подобные метки времени меняются от прогона к прогону
+_TS_RE = re.compile(rb"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})?")
+
+
+class CassetteMiss(Exception):
+    """В кассете нет ответа на такой запрос."""
+
+
+def _identity(headers: Any) -> str:
+    """
+    Кабинет Ozon различаем по Client-Id, но храним только хэш.
+    Api-Key/токен в ключ не входят: воспроизведение работает с фиктивными ключами.
+    """
+    cid = (headers or {}).get("Client-Id") or ""
+    return hashlib.sha256(cid.encode("utf-8")).hexdigest()[:12] if cid else ""
+
+
+def _body_bytes(prep: requests.PreparedRequest) -> bytes:
+    """
+    Тело в каноническом виде: без gzip, JSON с сортированными ключами —
+    чтобы кассета не зависела от кодека (orjson/json) и сжатия.
+    """
+    b = prep.body
+    if b is None:
+        return b""
+    raw = bytes(b) if isinstance(b, (bytes, bytearray)) else str(b).encode("utf-8")
+    if (prep.headers or {}).get("Content-Encoding") == "gzip":
+        raw = gzip.decompress(raw)
+    try:
+        return json.dumps(json.loads(raw), sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    except ValueError:
+        return raw
+
+
+def request_key(prep: requests.PreparedRequest) -> Tuple[str, str, str]:
+    """
+    (точный ключ, ключ без меток времени, identity).
+    Второй ключ нужен для запросов вида fbs/list с "to" = текущее время.
+    """
+    body = _body_bytes(prep)
+    exact = hashlib.sha256(body).hexdigest()[:16]
+    loose = hashlib.sha256(_TS_RE.sub(b"<ts>", body)).hexdigest()[:16]
+    url = prep.url or ""
+    return (
+        f"{prep.method} {url} {exact}",
+        f"{prep.method} {_TS_RE.sub(b'<ts>', url.encode('utf-8')).decode('utf-8')} {loose}",
+        _identity(prep.headers),
+    )
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, latency: str = "zero"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._out: Any = None
+        # key -> identity -> очередь ответов в порядке записи (отдельно точные и "loose" ключи)
+        self._tapes: Dict[str, Dict[str, Deque[Dict[str, Any]]]] = {}
+        self._loose: Dict[str, Dict[str, Deque[Dict[str, Any]]]] = {}
+        self._last: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._final: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        if mode == "replay":
+            self._load()
+
+    # -------- record --------
+    def record(self, prep: requests.PreparedRequest, resp: requests.Response, elapsed_s: float) -> None:
+        key, loose, ident = request_key(prep)
+        entry = {
+            "key": key,
+            "loose_key": loose,
+            "identity": ident,
+            "method": prep.method,
+            "url": prep.url,
+            "request_headers": {
+                k: ("<redacted>" if k.lower() in SECRET_HEADERS else v) for k, v in (prep.headers or {}).items()
+            },
+            "status": resp.status_code,
+            "headers": {k: v for k, v in resp.headers.items() if k.lower() not in _DROP_RESP_HEADERS | SECRET_HEADERS},
+            "body": resp.text,
+            "elapsed_s": round(elapsed_s, 4),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._out is None:
+                d = os.path.dirname(self.path)
+                if d:
+                    os.makedirs(d, exist_ok=True)
+                self._out = open(self.path, "wb")
+            # каждая запись — отдельный gzip-член, сразу на диск: прогон, убитый
+            # SIGTERM/таймаутом, оставляет читаемую кассету (gzip читает члены подряд)
+            self._out.write(gzip.compress(line.encode("utf-8")))
+            self._out.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+
+    # -------- replay --------
+    def _load(self) -> None:
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # оборванный хвост
+                    if line.strip():
+                        self._add(json.loads(line))
+            except (EOFError, gzip.BadGzipFile):
+                # запись прервали посреди последнего члена — он теряется, остальное цело
+                pass
+
+    def _add(self, e: Dict[str, Any]) -> None:
+        ident = e.get("identity") or ""
+        loose = e.get("loose_key") or e["key"]
+        self._tapes.setdefault(e["key"], {}).setdefault(ident, deque()).append(e)
+        self._loose.setdefault(loose, {}).setdefault(ident, deque()).append(e)
+        self._final[(e["key"], ident)] = e
+        self._final[(loose, ident)] = e
+
+    def replay(self, prep: requests.PreparedRequest) -> requests.Response:
+        key, loose, ident = request_key(prep)
+        with self._lock:
+            by_ident = self._tapes.get(key)
+            if not by_ident:
+                key, by_ident = loose, self._loose.get(loose)
+            if not by_ident:
+                raise CassetteMiss(f"{prep.method} {prep.url}")
+            # сначала тот же кабинет; если Client-Id другой (ноутбук) — любой записанный
+            pick = ident if ident in by_ident else next(iter(by_ident))
+            tape = by_ident[pick]
+            # запись лежит и в точной, и в loose-очереди — отдаём её только один раз
+            while tape and tape[0].get("_used"):
+                tape.popleft()
+            if tape:
+                e = tape.popleft()
+                e["_used"] = True
+                self._last[(key, pick)] = e
+            else:
+                # записи кончились — повторяем последний ответ (детерминированно)
+                e = self._last.get((key, pick)) or self._final[(key, pick)]
+
+        if self.latency == "recorded":
+            time.sleep(float(e.get("elapsed_s") or 0.0))
+
+        r = requests.Response()
+        r.status_code = int(e["status"])
+        r.headers = CaseInsensitiveDict(e.get("headers") or {})
+        r._content = (e.get("body") or "").encode("utf-8")
+        r.encoding = "utf-8"
+        r.url = prep.url or ""
+        r.request = prep
+        return r
+
+    def skip_sleeps(self) -> bool:
+        """При replay с нулевой латентностью backoff тоже не ждём."""
+        return self.mode == "replay" and self.latency != "recorded"
+
+
+_active: Optional[Cassette] = None
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def active() -> Optional[Cassette]:
+    global _active, _initialized
+    if _initialized:
+        return _active
+    with _init_lock:
+        if not _initialized:
+            mode = (os.getenv("HTTP_CASSETTE_MODE") or "").strip().lower()
+            path = (os.getenv("HTTP_CASSETTE_PATH") or "").strip()
+            if mode:
+                if not path:
+                    raise RuntimeError("HTTP_CASSETTE_MODE is set but HTTP_CASSETTE_PATH is empty")
+                _active = Cassette(path, mode, (os.getenv("HTTP_CASSETTE_LATENCY") or "zero").strip().lower())
+                atexit.register(_active.close)
+            _initialized = True
+    return _active
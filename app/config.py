@@ -1,10 +1,21 @@
 import os
+import socket
 from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
 from dotenv import load_dotenv
 
+from .orders_sync.constants import MS_SALES_CHANNEL_CAB1_ID, MS_SALES_CHANNEL_CAB2_ID
+
 ENV_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
 load_dotenv(ENV_PATH, override=True)
 
+# Каналы продаж для исторических кабинетов (раньше были захардкожены в sync_orders)
+_DEFAULT_SALES_CHANNELS = {
+    "OZON1": MS_SALES_CHANNEL_CAB1_ID,
+    "OZON2": MS_SALES_CHANNEL_CAB2_ID,
+}
+
 def _req(name: str) -> str:
     v = os.getenv(name)
     if not v:
@@ -14,36 +25,148 @@ def _req(name: str) -> str:
 def _opt(name: str, default: str) -> str:
     return os.getenv(name, default).strip()
 
+def store_key(store_ids: Iterable[str]) -> str:
+    """Ключ набора складов МС: один расчёт остатков на набор, сколько бы складов Ozon его ни брали."""
+    return "+".join(sorted(set(store_ids)))
+
+@dataclass(frozen=True)
+class WarehouseMap:
+    warehouse_id: int               # склад FBS в Ozon
+    store_ids: Tuple[str, ...]      # склады МС, остатки которых суммируются
+
+    @property
+    def key(self) -> str:
+        return store_key(self.store_ids)
+
+@dataclass(frozen=True)
+class CabinetConfig:
+    name: str               # префикс env-переменных: <NAME>_CLIENT_ID и т.д.
+    client_id: str
+    api_key: str
+    warehouse_id: int       # склад по умолчанию (первый из warehouses)
+    sales_channel_id: str
+    warehouses: Tuple[WarehouseMap, ...] = ()
+
+SHARD_MODES = ("cabinet", "hash", "window")
+
+@dataclass(frozen=True)
+class ShardConfig:
+    dir: str                # общий каталог с leases.sqlite3 (NFS или локальный — для тестов)
+    by: str = "cabinet"     # cabinet | hash (offer_id / posting_number) | window (время постингов)
+    buckets: int = 4        # шардов hash/window (у заказов — на кабинет)
+    workers: int = 1        # ожидаемое число воркеров: лимиты запросов делятся на max(workers, живых)
+    worker_id: str = ""
+    lease_s: float = 60.0   # аренда шарда; у упавшего воркера шард перехватят после истечения
+    round_s: float = 240.0  # шард, сделанный не раньше стольких секунд назад, в этом раунде не берётся
+
 @dataclass(frozen=True)
 class Config:
     moysklad_token: str
     moysklad_store_id: str
 
-    ozon1_client_id: str
-    ozon1_api_key: str
-    ozon1_warehouse_id: int
-
-    ozon2_client_id: str
-    ozon2_api_key: str
-    ozon2_warehouse_id: int
+    # порядок важен: при маршрутизации offer_id уходит в первый кабинет, где он есть
+    cabinets: Tuple[CabinetConfig, ...]
 
     log_level: str
     cache_dir: str
 
+    # >0 — отдавать /metrics по HTTP на этом порту, пока процесс жив
+    metrics_port: int
+
+    # состояния FBO-поставок, товар в которых вычитается из остатков FBS; пусто — выключено
+    supply_states: Tuple[str, ...] = ()
+
+    # лимит времени на прогон, сек (0 — без лимита); недоделанное — в checkpoint_<job>.json
+    run_budget_s: float = 0.0
+
+    # несколько воркеров делят работу по арендам шардов (SHARD_DIR); None — один воркер
+    shard: Optional[ShardConfig] = None
+
+    def store_sets(self) -> Dict[str, Tuple[str, ...]]:
+        """Все наборы складов МС, нужные кабинетам: ключ -> склады."""
+        out: Dict[str, Tuple[str, ...]] = {}
+        for cab in self.cabinets:
+            for wh in cab.warehouses:
+                out.setdefault(wh.key, tuple(sorted(set(wh.store_ids))))
+        return out
+
+def _parse_warehouses(name: str, raw: str, default_store: str) -> Tuple[WarehouseMap, ...]:
+    """
+    <NAME>_WAREHOUSES: "<warehouse_id>:<store_id>+<store_id>,<warehouse_id>:<store_id>".
+    Без ":..." — склад MOYSKLAD_STORE_ID.
+    """
+    out = []
+    for part in raw.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        wh, _, stores = part.partition(":")
+        try:
+            wid = int(wh.strip())
+        except ValueError:
+            raise RuntimeError(f"Bad warehouse id in {name}_WAREHOUSES: {wh!r}")
+        ids = tuple(x.strip() for x in stores.split("+") if x.strip()) or (default_store,)
+        out.append(WarehouseMap(wid, ids))
+    if not out:
+        raise RuntimeError(f"{name}_WAREHOUSES is empty")
+    wids = [w.warehouse_id for w in out]
+    if len(set(wids)) != len(wids):
+        raise RuntimeError(f"Duplicate warehouse ids in {name}_WAREHOUSES: {wids}")
+    return tuple(out)
+
+def _load_cabinet(name: str, default_store: str) -> CabinetConfig:
+    channel = os.getenv(f"{name}_SALES_CHANNEL_ID") or _DEFAULT_SALES_CHANNELS.get(name)
+    if not channel:
+        raise RuntimeError(f"Missing env var: {name}_SALES_CHANNEL_ID")
+    raw = os.getenv(f"{name}_WAREHOUSES")
+    if raw:
+        warehouses = _parse_warehouses(name, raw, default_store)
+    else:
+        warehouses = (WarehouseMap(int(_req(f"{name}_WAREHOUSE_ID")), (default_store,)),)
+    return CabinetConfig(
+        name=name,
+        client_id=_req(f"{name}_CLIENT_ID"),
+        api_key=_req(f"{name}_API_KEY"),
+        warehouse_id=warehouses[0].warehouse_id,
+        sales_channel_id=channel.strip(),
+        warehouses=warehouses,
+    )
+
+def _load_shard() -> Optional[ShardConfig]:
+    path = _opt("SHARD_DIR", "")
+    if not path:
+        return None
+    by = _opt("SHARD_BY", "cabinet").lower()
+    if by not in SHARD_MODES:
+        raise RuntimeError(f"SHARD_BY must be one of {SHARD_MODES}: {by!r}")
+    return ShardConfig(
+        dir=path,
+        by=by,
+        buckets=max(1, int(_opt("SHARD_BUCKETS", "4") or 4)),
+        workers=max(1, int(_opt("SHARD_WORKERS", "1") or 1)),
+        worker_id=_opt("SHARD_WORKER_ID", "") or f"{socket.gethostname()}-{os.getpid()}",
+        lease_s=float(_opt("SHARD_LEASE_S", "60") or 60),
+        round_s=float(_opt("SHARD_ROUND_S", "240") or 240),
+    )
+
 def load_config() -> Config:
+    names = [x.strip().upper() for x in _opt("OZON_CABINETS", "OZON1,OZON2").split(",") if x.strip()]
+    if not names:
+        raise RuntimeError("OZON_CABINETS is empty")
+    if len(set(names)) != len(names):
+        raise RuntimeError(f"Duplicate cabinet names in OZON_CABINETS: {names}")
+
+    store_id = _req("MOYSKLAD_STORE_ID")
     return Config(
         moysklad_token=_req("MOYSKLAD_TOKEN"),
-        moysklad_store_id=_req("MOYSKLAD_STORE_ID"),
-
-        ozon1_client_id=_req("OZON1_CLIENT_ID"),
-        ozon1_api_key=_req("OZON1_API_KEY"),
-        ozon1_warehouse_id=int(_req("OZON1_WAREHOUSE_ID")),
+        moysklad_store_id=store_id,
 
-        ozon2_client_id=_req("OZON2_CLIENT_ID"),
-        ozon2_api_key=_req("OZON2_API_KEY"),
-        ozon2_warehouse_id=int(_req("OZON2_WAREHOUSE_ID")),
+        cabinets=tuple(_load_cabinet(n, store_id) for n in names),
 
         log_level=_opt("LOG_LEVEL", "INFO").upper(),
         cache_dir=_opt("CACHE_DIR", "/var/tmp/ozon_ms_cache"),
-
+        metrics_port=int(_opt("METRICS_PORT", "0") or 0),
+        supply_states=tuple(x.strip() for x in _opt("OZON_SUPPLY_STATES", "").split(",") if x.strip()),
+        run_budget_s=float(_opt("RUN_BUDGET_S", "0") or 0),
+        shard=_load_shard(),
     )
@@ -1,12 +1,78 @@
 from __future__ import annotations
 
-import json
+import gzip
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
+from contextlib import nullcontext
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Deque, Dict, Optional, Set, Tuple, Union
+from urllib.parse import urlparse
 
 import requests
 
+from . import breaker, cassette, jsoncodec, ledger, ratelimit, trace
+from .breaker import CircuitOpenError  # noqa: F401 - реэкспорт для вызывающих
+from .metrics import REGISTRY, EndpointKey, endpoint_key
+
+# Хосты, которые принимают тело запроса в gzip (Content-Encoding: gzip).
+# По умолчанию выключено; если хост ответит 415 — для него отключаем до конца прогона.
+GZIP_HOSTS: Set[str] = {h.strip().lower() for h in os.getenv("HTTP_GZIP_HOSTS", "").split(",") if h.strip()}
+GZIP_MIN_BYTES = 4096
+
+_gzip_rejected: Set[str] = set()
+_gzip_lock = threading.Lock()
+
+# Таймаут чтения из хвоста латентности эндпоинта: max(5 с, 4 * p99), на ретраях удваивается;
+# timeout вызывающего — верхняя граница. До 20 замеров — timeout вызывающего как есть.
+ADAPTIVE_TIMEOUT = os.getenv("HTTP_ADAPTIVE_TIMEOUT", "1") != "0"
+TIMEOUT_MIN_S = 5.0
+TIMEOUT_P99_FACTOR = 4.0
+CONNECT_TIMEOUT_S = 10.0
+
+# Хедж: повтор чтения, если первый ответ не пришёл за p95. Только при свободном
+# слоте лимитера и не больше 5% запросов.
+HEDGE = os.getenv("HTTP_HEDGE", "0") == "1"
+HEDGE_MAX_FRACTION = 0.05
+
+LATENCY_SAMPLES = 256
+LATENCY_MIN_SAMPLES = 20
+
+
+class _LatencyTracker:
+    """Последние LATENCY_SAMPLES успешных латентностей по эндпоинту."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._samples: Dict[EndpointKey, Deque[float]] = {}
+
+    def observe(self, key: EndpointKey, latency_s: float) -> None:
+        with self._lock:
+            d = self._samples.get(key)
+            if d is None:
+                d = self._samples[key] = deque(maxlen=LATENCY_SAMPLES)
+            d.append(latency_s)
+
+    def quantile(self, key: EndpointKey, q: float) -> Optional[float]:
+        with self._lock:
+            d = self._samples.get(key)
+            if d is None or len(d) < LATENCY_MIN_SAMPLES:
+                return None
+            xs = sorted(d)
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+LATENCY = _LatencyTracker()
+
+# последняя попытка запроса в потоке (время и размер тела) — для подбора размера страниц (app/batching.py)
+_last_attempt = threading.local()
+
+_hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+_hedge_lock = threading.Lock()
+_hedge_budget = [0, 0]  # [запросов-кандидатов, хеджей]
+
 
 @dataclass
 class HttpError(Exception):
@@ -18,9 +84,177 @@ class HttpError(Exception):
         return f"HTTP {self.status} for {self.url}: {self.text}"
 
 
-def _is_json(text: str) -> bool:
-    t = (text or "").lstrip()
-    return t.startswith("{") or t.startswith("[")
+def _is_json(content: bytes) -> bool:
+    t = (content or b"").lstrip()
+    return t.startswith(b"{") or t.startswith(b"[")
+
+
+def _want_gzip(url: str, gzip_body: Optional[bool]) -> bool:
+    host = (urlparse(url).hostname or "").lower()
+    if host in _gzip_rejected:
+        return False
+    if gzip_body is not None:
+        return gzip_body
+    return host in GZIP_HOSTS
+
+
+def _encode_body(method: str, url: str, json_body: Any, use_gzip: bool) -> Tuple[Optional[bytes], Dict[str, str]]:
+    """
+    JSON через jsoncodec (orjson, если есть), большие тела — в gzip.
+    Время кодирования и степень сжатия уходят в метрики.
+    """
+    if json_body is None:
+        return None, {}
+    t0 = time.perf_counter()
+    raw = jsoncodec.dumps_bytes(json_body)
+    hdrs = {"Content-Type": "application/json"}
+    wire = raw
+    if use_gzip and len(raw) >= GZIP_MIN_BYTES:
+        wire = gzip.compress(raw, compresslevel=5)
+        hdrs["Content-Encoding"] = "gzip"
+    REGISTRY.record_codec(method, url, encode_s=time.perf_counter() - t0, raw_bytes=len(raw), wire_bytes=len(wire))
+    return wire, hdrs
+
+
+def _body_len(req: Any) -> int:
+    body = getattr(req, "body", None)
+    if not body:
+        return 0
+    return len(body) if isinstance(body, (bytes, bytearray)) else len(str(body).encode("utf-8"))
+
+
+def _backoff(method: str, url: str, sleep_s: float) -> None:
+    REGISTRY.record_retry(method, url, sleep_s)
+    if breaker.is_open(method, url):
+        # цепь разомкнулась — не спим, следующая попытка сразу упадёт с CircuitOpenError
+        return
+    cas = cassette.active()
+    if cas is not None and cas.skip_sleeps():
+        return
+    time.sleep(sleep_s)
+
+
+def _send(
+    s: requests.Session,
+    method: str,
+    url: str,
+    *,
+    headers: Optional[Dict[str, str]],
+    params: Optional[Dict[str, Any]],
+    data: Optional[bytes],
+    timeout: Union[float, Tuple[float, float]],
+    limited: bool = True,
+) -> requests.Response:
+    """
+    Одна попытка запроса. При HTTP_CASSETTE_MODE пишет/читает кассету (app/cassette.py).
+    Живые запросы идут через лимитер хоста (app/ratelimit.py); limited=False — слот
+    уже взят вызывающим (хедж).
+    """
+    prep = s.prepare_request(requests.Request(method, url, headers=headers, params=params, data=data))
+    cas = cassette.active()
+    if cas is not None and cas.mode == "replay":
+        return cas.replay(prep)
+
+    settings = s.merge_environment_settings(prep.url, {}, None, None, None)
+    with ratelimit.slot(url) if limited else nullcontext():
+        t0 = time.perf_counter()
+        r = s.send(prep, timeout=timeout, **settings)
+        # время самого запроса, без ожидания слота лимитера — для латентности эндпоинта
+        r.send_s = time.perf_counter() - t0
+    if cas is not None:
+        cas.record(prep, r, r.send_s)
+    return r
+
+
+def _timeout_for(method: str, url: str, key: EndpointKey, cap: float, attempt: int) -> Union[float, Tuple[float, float]]:
+    # запись по таймауту ретраится — короткий таймаут на медленной, но успешной
+    # записи дал бы дубль (заказ, отгрузка); для записей — timeout вызывающего
+    if not ADAPTIVE_TIMEOUT or breaker.endpoint_class(method, url) != "read":
+        return cap
+    p99 = LATENCY.quantile(key, 0.99)
+    if p99 is None:
+        return cap
+    read = min(float(cap), max(TIMEOUT_MIN_S, p99 * TIMEOUT_P99_FACTOR) * (2**attempt))
+    return (min(CONNECT_TIMEOUT_S, read), read)
+
+
+def _hedgeable(method: str, url: str) -> bool:
+    # кассета пишет/отдаёт запросы по порядку — дубли ей не нужны
+    return HEDGE and breaker.endpoint_class(method, url) == "read" and cassette.active() is None
+
+
+def _take_hedge_budget() -> bool:
+    with _hedge_lock:
+        if _hedge_budget[1] + 1 > HEDGE_MAX_FRACTION * _hedge_budget[0]:
+            return False
+        _hedge_budget[1] += 1
+        return True
+
+
+def _send_hedged(
+    method: str,
+    url: str,
+    key: EndpointKey,
+    *,
+    headers: Optional[Dict[str, str]],
+    params: Optional[Dict[str, Any]],
+    data: Optional[bytes],
+    timeout: Union[float, Tuple[float, float]],
+) -> requests.Response:
+    """
+    Первый запрос в фоне; если за p95 ответа нет — второй такой же (если есть
+    свободный слот лимитера и бюджет хеджей). Возвращается первый успешный ответ.
+    """
+    with _hedge_lock:
+        _hedge_budget[0] += 1
+    kw = dict(headers=headers, params=params, data=data, timeout=timeout)
+    p95 = LATENCY.quantile(key, 0.95)
+    if p95 is None:
+        return _send(requests.Session(), method, url, **kw)
+
+    primary = _hedge_pool.submit(_send, requests.Session(), method, url, **kw)
+    try:
+        return primary.result(timeout=p95)
+    except FutureTimeout:
+        pass
+
+    lim = ratelimit.limiter_for(url)
+    if not _take_hedge_budget():
+        return primary.result()
+    if lim is not None and not lim.try_acquire():
+        with _hedge_lock:
+            _hedge_budget[1] -= 1
+        return primary.result()
+
+    def hedge_send() -> requests.Response:
+        try:
+            return _send(requests.Session(), method, url, limited=False, **kw)
+        finally:
+            if lim is not None:
+                lim.release()
+
+    hedge = _hedge_pool.submit(hedge_send)
+    REGISTRY.record_hedge(method, url)
+    ledger.note_call(url)
+    for f in as_completed([primary, hedge]):
+        if f.exception() is None:
+            if f is hedge:
+                REGISTRY.record_hedge(method, url, won=True)
+            return f.result()
+    # оба упали — ошибка основного запроса
+    return primary.result()
+
+
+def last_attempt() -> Optional[Tuple[float, int]]:
+    """
+    Последняя попытка request_json в этом потоке: (секунды самого запроса — без
+    ретраев, backoff и ожидания лимитера; больший из размеров тела запроса/ответа).
+    """
+    return getattr(_last_attempt, "value", None)
+
+
+def clear_last_attempt() -> None:
+    _last_attempt.value = None
 
 
 def request_json(
@@ -32,6 +266,7 @@ def request_json(
     json_body: Any = None,
     timeout: int = 60,
     retries: int = 6,
+    gzip_body: Optional[bool] = None,
 ) -> Any:
     """
     Универсальный HTTP для проекта.
@@ -40,20 +275,39 @@ def request_json(
     - ретраи на 429 (MS rate limit) с экспоненциальным backoff
     - ретраи на сетевые таймауты/SSL handshake timeout
     - по умолчанию retries=6 достаточно для длинных прогонов
+    - gzip_body: None — по HTTP_GZIP_HOSTS, True/False — явно
+    - при массовых сбоях хоста (app/breaker.py) — сразу CircuitOpenError, без ретраев
+    - timeout — верхняя граница; для чтений фактический считается по p99 эндпоинта
+    - HTTP_HEDGE=1: чтения (GET, POST list/get Ozon) хеджируются после p95
     """
     s = requests.Session()
+    key = endpoint_key(method, url)
+    hedged = _hedgeable(method, url)
+
+    data, body_headers = _encode_body(method, url, json_body, _want_gzip(url, gzip_body))
+    # Content-Type вызывающего (если задан) важнее
+    send_headers = {**body_headers, **(headers or {})}
 
     last_err: Optional[Exception] = None
     for attempt in range(retries + 1):
+        breaker.before(method, url)
+        trace.note_api_call()
+        ledger.note_call(url)
+        t0 = time.perf_counter()
         try:
-            r = s.request(
-                method=method,
-                url=url,
-                headers=headers,
-                params=params,
-                json=json_body,
-                timeout=timeout,
-            )
+            tmo = _timeout_for(method, url, key, timeout, attempt)
+            if hedged:
+                r = _send_hedged(method, url, key, headers=send_headers, params=params, data=data, timeout=tmo)
+            else:
+                r = _send(s, method, url, headers=send_headers, params=params, data=data, timeout=tmo)
+            elapsed = getattr(r, "send_s", None) or time.perf_counter() - t0
+            bytes_out, bytes_in = _body_len(r.request), len(r.content or b"")
+            REGISTRY.record_request(method, url, r.status_code, elapsed, bytes_out=bytes_out, bytes_in=bytes_in)
+            _last_attempt.value = (elapsed, max(bytes_out, bytes_in))
+            if r.status_code < 500 and r.status_code != 429:
+                LATENCY.observe(key, elapsed)
+            # 4xx/429 — хост жив; сбой — только 5xx и сетевые ошибки
+            breaker.record(method, url, r.status_code >= 500)
 
             # 429: ограничение запросов (часто у МС)
             if r.status_code == 429:
@@ -66,37 +320,55 @@ def request_json(
                         sleep_s = 2.0
                 else:
                     sleep_s = min(30.0, 1.5 * (2**attempt))
-                time.sleep(sleep_s)
+                _backoff(method, url, sleep_s)
+                continue
+
+            # хост не принимает gzip-тело — шлём без сжатия и больше не пробуем
+            if r.status_code == 415 and send_headers.get("Content-Encoding") == "gzip":
+                with _gzip_lock:
+                    _gzip_rejected.add((urlparse(url).hostname or "").lower())
+                data, body_headers = _encode_body(method, url, json_body, False)
+                send_headers = {**body_headers, **(headers or {})}
                 continue
 
             if r.status_code >= 400:
                 raise HttpError(r.status_code, r.text, url)
 
-            if not r.text:
+            content = r.content
+            if not content:
                 return None
-            if _is_json(r.text):
-                return r.json()
+            if _is_json(content):
+                t1 = time.perf_counter()
+                out = jsoncodec.loads(content)
+                REGISTRY.record_codec(method, url, decode_s=time.perf_counter() - t1)
+                return out
             # иногда МС/Озон могут вернуть text/plain
             return r.text
 
         except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout) as e:
+            REGISTRY.record_request(method, url, None, time.perf_counter() - t0)
+            breaker.record(method, url, True)
             last_err = e
             # backoff
-            time.sleep(min(30.0, 1.5 * (2**attempt)))
+            _backoff(method, url, min(30.0, 1.5 * (2**attempt)))
             continue
         except requests.exceptions.SSLError as e:
+            REGISTRY.record_request(method, url, None, time.perf_counter() - t0)
+            breaker.record(method, url, True)
             last_err = e
-            time.sleep(min(30.0, 1.5 * (2**attempt)))
+            _backoff(method, url, min(30.0, 1.5 * (2**attempt)))
             continue
         except requests.exceptions.ConnectionError as e:
+            REGISTRY.record_request(method, url, None, time.perf_counter() - t0)
+            breaker.record(method, url, True)
             last_err = e
-            time.sleep(min(30.0, 1.5 * (2**attempt)))
+            _backoff(method, url, min(30.0, 1.5 * (2**attempt)))
             continue
         except HttpError as e:
             # 5xx можно ретраить, остальное — нет
             if 500 <= e.status < 600 and attempt < retries:
                 last_err = e
-                time.sleep(min(30.0, 1.5 * (2**attempt)))
+                _backoff(method, url, min(30.0, 1.5 * (2**attempt)))
                 continue
             raise
 
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import json
+from typing import Any, Union
+
+# orjson в 5-10 раз быстрее stdlib на больших отчётах МС; необязательная зависимость
+try:
+    import orjson as _orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    _orjson = None
+
+NAME = "orjson" if _orjson is not None else "json"
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """Компактный JSON в UTF-8 (тело запроса)."""
+    if _orjson is not None:
+        return _orjson.dumps(obj, default=str, option=_orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def dumps(obj: Any) -> str:
+    """JSON-строка для логов (кириллица как есть)."""
+    if _orjson is not None:
+        return _orjson.dumps(obj, default=str, option=_orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def loads(data: Union[bytes, bytearray, str]) -> Any:
+    if _orjson is not None:
+        return _orjson.loads(data)
+    return json.loads(data)
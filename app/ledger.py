@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import contextvars
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from .log import log_json
+
+# уровень расхода этапа относительно его бюджета вызовов
+OK = "ok"
+SOFT = "soft"  # мягкий лимит превышен — необязательная работа урезается
+HARD = "hard"  # жёсткий лимит превышен — необязательная работа пропускается
+
+OTHER = "other"
+
+_stage: contextvars.ContextVar[str] = contextvars.ContextVar("ledger_stage", default=OTHER)
+
+
+def _parse_budgets(spec: str) -> Dict[str, Tuple[Optional[int], Optional[int]]]:
+    """
+    CALL_BUDGETS="ensure_prices=300/600,demand_dedup=/400" — мягкий/жёсткий лимит
+    вызовов на этап за прогон; пустое значение — без лимита.
+    """
+    out: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        name, val = part.split("=", 1)
+        soft, _, hard = val.partition("/")
+        out[name.strip()] = (int(soft) if soft.strip() else None, int(hard) if hard.strip() else None)
+    return out
+
+
+class Ledger:
+    """
+    Учёт вызовов request_json (каждой попытки и хеджа — всё это тратит квоту аккаунта)
+    по логическим этапам прогона и хостам. Этап задаёт stage(...) вокруг кода;
+    вне этапов — "other".
+    """
+
+    def __init__(self, budgets: Dict[str, Tuple[Optional[int], Optional[int]]]):
+        self.budgets = budgets
+        self._calls: Dict[Tuple[str, str], int] = {}
+        self._by_stage: Dict[str, int] = {}
+        self._skipped: Dict[str, int] = {}
+        self._degraded: Dict[str, int] = {}
+        self._crossed: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def note(self, url: str) -> None:
+        name = _stage.get()
+        host = (urlparse(url).hostname or "").lower()
+        with self._lock:
+            self._calls[(name, host)] = self._calls.get((name, host), 0) + 1
+            self._by_stage[name] = self._by_stage.get(name, 0) + 1
+
+    def calls(self, name: str) -> int:
+        with self._lock:
+            return self._by_stage.get(name, 0)
+
+    def level(self, name: str) -> str:
+        soft, hard = self.budgets.get(name, (None, None))
+        n = self.calls(name)
+        if hard is not None and n >= hard:
+            return HARD
+        if soft is not None and n >= soft:
+            return SOFT
+        return OK
+
+    def crossed(self, name: str, lvl: str) -> bool:
+        """True один раз на этап и уровень — чтобы залогировать переход."""
+        with self._lock:
+            if (name, lvl) in self._crossed:
+                return False
+            self._crossed.add((name, lvl))
+            return True
+
+    def note_skipped(self, name: str) -> None:
+        with self._lock:
+            self._skipped[name] = self._skipped.get(name, 0) + 1
+
+    def note_degraded(self, name: str) -> None:
+        with self._lock:
+            self._degraded[name] = self._degraded.get(name, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = dict(self._calls)
+            by_stage = dict(self._by_stage)
+            skipped = dict(self._skipped)
+            degraded = dict(self._degraded)
+        stages: Dict[str, Dict[str, Any]] = {}
+        for name in sorted(set(by_stage) | set(skipped) | set(degraded) | set(self.budgets)):
+            soft, hard = self.budgets.get(name, (None, None))
+            row: Dict[str, Any] = {
+                "calls": by_stage.get(name, 0),
+                "by_host": {h: n for (s, h), n in sorted(calls.items()) if s == name},
+            }
+            if soft is not None or hard is not None:
+                row.update(soft=soft, hard=hard, level=self.level(name))
+            if skipped.get(name):
+                row["skipped"] = skipped[name]
+            if degraded.get(name):
+                row["degraded"] = degraded[name]
+            stages[name] = row
+        return {"total": sum(by_stage.values()), "stages": stages}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._calls.clear()
+            self._by_stage.clear()
+            self._skipped.clear()
+            self._degraded.clear()
+            self._crossed.clear()
+
+
+LEDGER = Ledger(_parse_budgets(os.getenv("CALL_BUDGETS", "")))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    with ledger.stage("resolve_articles"): ...
+    Вызовы внутри (и в потоках через trace.bind) списываются на этот этап.
+    """
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def note_call(url: str) -> None:
+    """Вызывается из request_json на каждую попытку запроса."""
+    LEDGER.note(url)
+
+
+def note_skipped(name: str) -> None:
+    LEDGER.note_skipped(name)
+
+
+def note_degraded(name: str) -> None:
+    LEDGER.note_degraded(name)
+
+
+def level(name: str, logger: Optional[logging.Logger] = None) -> str:
+    """Уровень расхода этапа; переход через лимит логируется один раз."""
+    lvl = LEDGER.level(name)
+    if lvl != OK and logger is not None and LEDGER.crossed(name, lvl):
+        soft, hard = LEDGER.budgets.get(name, (None, None))
+        log_json(logger, "call_budget_exceeded", stage=name, level=lvl, calls=LEDGER.calls(name), soft=soft, hard=hard)
+    return lvl
+
+
+def report(logger: logging.Logger, cache_dir: str, job: str) -> None:
+    """
+    Расход вызовов за прогон: call_ledger в лог + <cache_dir>/ledger_<job>.json.
+    """
+    summary = LEDGER.summary()
+    log_json(logger, "call_ledger", full=True, job=job, **summary)
+    path = os.path.join(cache_dir, f"ledger_{job}.json")
+    try:
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"job": job, **summary}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except Exception as e:
+        log_json(logger, "ledger_write_failed", job=job, error=str(e))
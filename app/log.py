@@ -1,19 +1,178 @@
-import json
+import atexit
 import logging
+import queue
+import random
 import sys
+import threading
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterable, List, Optional
+
+from . import jsoncodec
+# на INFO большие поля режутся; целиком — при DEBUG и в log_json(..., full=True)
+# на INFO большие поля режутся; целиком — только при DEBUG
+MAX_STR = 2000
+MAX_LIST = 50
+
+_listener: Optional[QueueListener] = None
+
+
+class _JsonLine:
+    """
+    Отложенная сериализация: json.dumps выполняется в потоке QueueListener,
+    а не в рабочем потоке синхронизации.
+    """
+
+    __slots__ = ("payload", "full")
+
+    def __init__(self, payload: Dict[str, Any], full: bool):
+        self.payload = payload
+        self.full = full
+
+    def __str__(self) -> str:
+        data = self.payload if self.full else _clip(self.payload)
+        return jsoncodec.dumps(data)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.msg, _JsonLine) and not record.args and not record.exc_info:
+            return record
+        return super().prepare(record)
+
+
+def _clip(v: Any, depth: int = 0) -> Any:
+    if isinstance(v, str):
+        if len(v) > MAX_STR:
+            return f"{v[:MAX_STR]}...(+{len(v) - MAX_STR} chars)"
+        return v
+    if isinstance(v, dict):
+        if depth >= 6:
+            return f"<dict {len(v)} keys>"
+        return {k: _clip(x, depth + 1) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        if depth >= 6:
+            return f"<list {len(v)} items>"
+        out = [_clip(x, depth + 1) for x in v[:MAX_LIST]]
+        if len(v) > MAX_LIST:
+            out.append(f"...(+{len(v) - MAX_LIST} items)")
+        return out
+    return v
+
 
 def setup_logging(level: str = "INFO") -> None:
-    logging.basicConfig(
-        level=getattr(logging, level, logging.INFO),
-        stream=sys.stdout,
-        format="%(message)s",
-    )
+    """
+    stdout через очередь: запись в journald не блокирует синхронизацию.
+    Очередь дописывается при выходе процесса (atexit).
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, level, logging.INFO))
+    root.handlers[:] = [_QueueHandler(q)]
+
+    _listener = QueueListener(q, stream, respect_handler_level=False)
+    _listener.start()
+    atexit.register(flush_logging)
+
+
+def flush_logging() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
 
-def log_json(logger: logging.Logger, msg: str, **fields) -> None:
+def log_json(logger: logging.Logger, msg: str, full: bool = False, **fields) -> None:
+    """full — без обрезки и на INFO (итоговые отчёты прогона: дерево таймингов, расход вызовов)."""
+    if not logger.isEnabledFor(logging.INFO):
+        return
     payload = {
         "ts": datetime.now(timezone.utc).isoformat(),
         "msg": msg,
         **fields,
     }
-    logger.info(json.dumps(payload, ensure_ascii=False))
+    logger.info(_JsonLine(payload, full=full or logger.isEnabledFor(logging.DEBUG)))
+
+
+def log_debug_json(logger: logging.Logger, msg: str, **fields) -> None:
+    """Подробности (полные ответы API и т.п.) — только при LOG_LEVEL=DEBUG."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    payload = {
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "msg": msg,
+        **fields,
+    }
+    logger.debug(_JsonLine(payload, full=True))
+
+
+class EventAggregator:
+    """
+    Вместо строки на каждое событие — одна строка на тип события за прогон:
+    count, разбивка по group_by-полям, суммы и несколько случайных примеров.
+    """
+
+    def __init__(self, samples: int = 5, seed: int = 0):
+        self.samples = samples
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._events: Dict[str, Dict[str, Any]] = {}
+
+    def add(
+        self,
+        event: str,
+        *,
+        group_by: Iterable[str] = (),
+        sums: Optional[Dict[str, float]] = None,
+        **fields: Any,
+    ) -> None:
+        with self._lock:
+            e = self._events.get(event)
+            if e is None:
+                e = self._events[event] = {"count": 0, "by": {}, "sums": {}, "examples": []}
+            e["count"] += 1
+            for g in group_by:
+                by = e["by"].setdefault(g, {})
+                k = str(fields.get(g))
+                by[k] = by.get(k, 0) + 1
+            for k, v in (sums or {}).items():
+                e["sums"][k] = e["sums"].get(k, 0) + v
+            # reservoir sampling: примеры равномерно по всему прогону
+            ex: List[Dict[str, Any]] = e["examples"]
+            if len(ex) < self.samples:
+                ex.append(fields)
+            else:
+                j = self._rng.randrange(e["count"])
+                if j < self.samples:
+                    ex[j] = fields
+
+    def flush(self, logger: logging.Logger) -> None:
+        with self._lock:
+            events, self._events = self._events, {}
+        for event, e in events.items():
+            out: Dict[str, Any] = {"aggregated": True, "count": e["count"]}
+            if e["by"]:
+                out["by"] = e["by"]
+            if e["sums"]:
+                out.update(e["sums"])
+            if e["examples"]:
+                out["examples"] = e["examples"]
+            log_json(logger, event, **out)
+
+
+AGGREGATOR = EventAggregator()
+
+
+def log_aggregate(event: str, **kwargs: Any) -> None:
+    AGGREGATOR.add(event, **kwargs)
+
+
+def flush_aggregates(logger: logging.Logger) -> None:
+    AGGREGATOR.flush(logger)
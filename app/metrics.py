@@ -0,0 +1,324 @@
+from __future__ import annotations
+
+import bisect
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from . import breaker, jsoncodec, ledger
+from .log import log_json
+
+# uuid МС, числовые id Ozon/постингов, номера отправлений вида 12345-0001-1
+_ID_SEG = re.compile(
+    r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+|\d+(-\d+)+)$",
+    re.IGNORECASE,
+)
+
+# границы бакетов гистограммы латентности, сек
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+EndpointKey = Tuple[str, str, str]  # (method, host, templated path)
+
+
+def endpoint_key(method: str, url: str) -> EndpointKey:
+    """
+    Ключ эндпоинта без идентификаторов:
+    GET https://api.moysklad.ru/.../customerorder/<uuid>/positions -> (GET, host, /.../customerorder/{id}/positions)
+    """
+    p = urlparse(url)
+    path = "/".join("{id}" if _ID_SEG.match(seg) else seg for seg in p.path.split("/"))
+    return method.upper(), p.netloc, path.rstrip("/") or "/"
+
+
+def status_class(status: Optional[int]) -> str:
+    if not status:
+        return "error"  # сетевой сбой/таймаут, ответа нет
+    return f"{status // 100}xx"
+
+
+@dataclass
+class EndpointStats:
+    count: int = 0
+    statuses: Dict[str, int] = field(default_factory=dict)
+    retries: int = 0
+    throttled: int = 0
+    sleep_s: float = 0.0
+    bytes_out: int = 0
+    bytes_in: int = 0
+    latency_sum: float = 0.0
+    encode_s: float = 0.0
+    decode_s: float = 0.0
+    raw_bytes_out: int = 0   # тело запроса до gzip
+    wire_bytes_out: int = 0  # то же тело после gzip (без учёта ретраев)
+    hedged: int = 0          # отправлено дублирующих запросов
+    hedge_wins: int = 0      # дубль ответил раньше основного
+    buckets: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по гистограмме (верхняя граница бакета)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        acc = 0
+        for i, n in enumerate(self.buckets):
+            acc += n
+            if acc >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """
+    Счётчики HTTP по эндпоинтам за процесс. Потокобезопасно.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats: Dict[EndpointKey, EndpointStats] = {}
+
+    def _get(self, key: EndpointKey) -> EndpointStats:
+        st = self._stats.get(key)
+        if st is None:
+            st = self._stats[key] = EndpointStats()
+        return st
+
+    def record_request(
+        self,
+        method: str,
+        url: str,
+        status: Optional[int],
+        latency_s: float,
+        bytes_out: int = 0,
+        bytes_in: int = 0,
+    ) -> None:
+        key = endpoint_key(method, url)
+        cls = status_class(status)
+        with self._lock:
+            st = self._get(key)
+            st.count += 1
+            st.statuses[cls] = st.statuses.get(cls, 0) + 1
+            if status == 429:
+                st.throttled += 1
+            st.bytes_out += int(bytes_out or 0)
+            st.bytes_in += int(bytes_in or 0)
+            st.latency_sum += latency_s
+            st.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency_s)] += 1
+
+    def record_retry(self, method: str, url: str, sleep_s: float) -> None:
+        key = endpoint_key(method, url)
+        with self._lock:
+            st = self._get(key)
+            st.retries += 1
+            st.sleep_s += sleep_s
+
+    def record_codec(
+        self,
+        method: str,
+        url: str,
+        encode_s: float = 0.0,
+        decode_s: float = 0.0,
+        raw_bytes: int = 0,
+        wire_bytes: int = 0,
+    ) -> None:
+        key = endpoint_key(method, url)
+        with self._lock:
+            st = self._get(key)
+            st.encode_s += encode_s
+            st.decode_s += decode_s
+            st.raw_bytes_out += int(raw_bytes or 0)
+            st.wire_bytes_out += int(wire_bytes or 0)
+
+    def record_hedge(self, method: str, url: str, won: bool = False) -> None:
+        key = endpoint_key(method, url)
+        with self._lock:
+            st = self._get(key)
+            if won:
+                st.hedge_wins += 1
+            else:
+                st.hedged += 1
+
+    def snapshot(self) -> Dict[EndpointKey, EndpointStats]:
+        with self._lock:
+            return {
+                k: EndpointStats(
+                    count=v.count,
+                    statuses=dict(v.statuses),
+                    retries=v.retries,
+                    throttled=v.throttled,
+                    sleep_s=v.sleep_s,
+                    bytes_out=v.bytes_out,
+                    bytes_in=v.bytes_in,
+                    latency_sum=v.latency_sum,
+                    encode_s=v.encode_s,
+                    decode_s=v.decode_s,
+                    raw_bytes_out=v.raw_bytes_out,
+                    wire_bytes_out=v.wire_bytes_out,
+                    hedged=v.hedged,
+                    hedge_wins=v.hedge_wins,
+                    buckets=list(v.buckets),
+                )
+                for k, v in self._stats.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    # -------- export --------
+    def summary(self, top: int = 15) -> Dict[str, Any]:
+        snap = self.snapshot()
+        rows = sorted(snap.items(), key=lambda kv: kv[1].latency_sum + kv[1].sleep_s, reverse=True)
+        return {
+            "requests": sum(v.count for v in snap.values()),
+            "retries": sum(v.retries for v in snap.values()),
+            "throttled": sum(v.throttled for v in snap.values()),
+            "sleep_s": round(sum(v.sleep_s for v in snap.values()), 3),
+            "http_s": round(sum(v.latency_sum for v in snap.values()), 3),
+            "bytes_out": sum(v.bytes_out for v in snap.values()),
+            "bytes_in": sum(v.bytes_in for v in snap.values()),
+            "json_codec": jsoncodec.NAME,
+            "encode_s": round(sum(v.encode_s for v in snap.values()), 4),
+            "decode_s": round(sum(v.decode_s for v in snap.values()), 4),
+            "hedged": sum(v.hedged for v in snap.values()),
+            "hedge_wins": sum(v.hedge_wins for v in snap.values()),
+            "endpoints": [
+                {
+                    "endpoint": f"{m} {h}{p}",
+                    "count": v.count,
+                    "statuses": v.statuses,
+                    "retries": v.retries,
+                    "throttled": v.throttled,
+                    "sleep_s": round(v.sleep_s, 3),
+                    "http_s": round(v.latency_sum, 3),
+                    "p50_s": v.quantile(0.5),
+                    "p95_s": v.quantile(0.95),
+                    "bytes_in": v.bytes_in,
+                    "decode_s": round(v.decode_s, 4),
+                    "encode_s": round(v.encode_s, 4),
+                    "compression": round(v.raw_bytes_out / v.wire_bytes_out, 2) if v.wire_bytes_out else None,
+                    "hedged": v.hedged,
+                    "hedge_wins": v.hedge_wins,
+                }
+                for (m, h, p), v in rows[:top]
+            ],
+        }
+
+    def to_prometheus(self, job: str) -> str:
+        snap = self.snapshot()
+        lines: List[str] = []
+
+        def lbl(key: EndpointKey, **extra: str) -> str:
+            m, h, p = key
+            pairs = {"job": job, "method": m, "host": h, "endpoint": p, **extra}
+            return ",".join(f'{k}="{_escape(v)}"' for k, v in pairs.items())
+
+        def family(name: str, typ: str, help_: str) -> None:
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {typ}")
+
+        family("ozon_ms_http_requests_total", "counter", "HTTP attempts by endpoint and status class")
+        for k, v in snap.items():
+            for cls, n in sorted(v.statuses.items()):
+                lines.append(f"ozon_ms_http_requests_total{{{lbl(k, status_class=cls)}}} {n}")
+
+        for name, attr, help_ in (
+            ("ozon_ms_http_retries_total", "retries", "Retried attempts"),
+            ("ozon_ms_http_throttled_total", "throttled", "429 responses"),
+            ("ozon_ms_http_sleep_seconds_total", "sleep_s", "Time spent in backoff sleeps"),
+            ("ozon_ms_http_request_bytes_total", "bytes_out", "Request body bytes sent"),
+            ("ozon_ms_http_response_bytes_total", "bytes_in", "Response body bytes received"),
+            ("ozon_ms_http_request_raw_bytes_total", "raw_bytes_out", "Request body bytes before compression"),
+            ("ozon_ms_http_encode_seconds_total", "encode_s", "JSON encode (and gzip) time"),
+            ("ozon_ms_http_decode_seconds_total", "decode_s", "JSON decode time"),
+            ("ozon_ms_http_hedged_total", "hedged", "Hedged duplicate requests sent"),
+            ("ozon_ms_http_hedge_wins_total", "hedge_wins", "Hedged requests that answered first"),
+        ):
+            family(name, "counter", help_)
+            for k, v in snap.items():
+                lines.append(f"{name}{{{lbl(k)}}} {getattr(v, attr)}")
+
+        name = "ozon_ms_http_request_duration_seconds"
+        family(name, "histogram", "HTTP attempt latency")
+        for k, v in snap.items():
+            acc = 0
+            for i, le in enumerate(LATENCY_BUCKETS):
+                acc += v.buckets[i]
+                lines.append(f"{name}_bucket{{{lbl(k, le=repr(le))}}} {acc}")
+            lines.append(f"{name}_bucket{{{lbl(k, le='+Inf')}}} {v.count}")
+            lines.append(f"{name}_sum{{{lbl(k)}}} {v.latency_sum:.6f}")
+            lines.append(f"{name}_count{{{lbl(k)}}} {v.count}")
+
+        name = "ozon_ms_circuit_open"
+        family(name, "gauge", "1 if the circuit breaker for host/class is not closed")
+        for b in breaker.summary():
+            lines.append(
+                f'{name}{{job="{_escape(job)}",host="{_escape(b["host"])}",class="{b["class"]}"}} '
+                f'{0 if b["state"] == breaker.CLOSED else 1}'
+            )
+
+        name = "ozon_ms_stage_calls_total"
+        family(name, "counter", "HTTP attempts by logical stage of the run (app/ledger.py)")
+        for st, row in ledger.LEDGER.summary()["stages"].items():
+            for host, n in row["by_host"].items():
+                lines.append(f'{name}{{job="{_escape(job)}",stage="{_escape(st)}",host="{_escape(host)}"}} {n}')
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str, job: str) -> None:
+        """
+        Атомарная запись для node_exporter textfile collector.
+        """
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus(job))
+        os.replace(tmp, path)
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Metrics()
+
+
+def serve(port: int, job: str, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """
+    Отдаёт /metrics в фоне — для долгоживущего режима (METRICS_PORT).
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            data = REGISTRY.to_prometheus(job).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+            pass
+
+    srv = ThreadingHTTPServer((host, port), _Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+    return srv
+
+
+def report_run(logger: logging.Logger, cache_dir: str, job: str) -> None:
+    """
+    Итог прогона: сводка в лог + textfile <cache_dir>/metrics_<job>.prom.
+    """
+    log_json(logger, "http_summary", job=job, **REGISTRY.summary(), breakers=breaker.summary())
+    try:
+        REGISTRY.write_textfile(os.path.join(cache_dir, f"metrics_{job}.prom"), job)
+    except Exception as e:
+        log_json(logger, "metrics_write_failed", job=job, error=str(e))
@@ -1,12 +1,19 @@
 from __future__ import annotations
 
+import os
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple
-from urllib.parse import urlparse
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+from urllib.parse import quote, urlparse
 
+from . import batching
 from .http import request_json
+from .paginate import offset_pages
 
-MS_BASE = "https://api.moysklad.ru/api/remap/1.2"
+# переопределяется только для стенда (bench/fake_api.py)
+MS_BASE = os.getenv("MOYSKLAD_BASE_URL", "https://api.moysklad.ru/api/remap/1.2").rstrip("/")
+
+# запас длины URL под остальные параметры (?filter=, limit, stockType, ...)
+_URL_PARAMS_RESERVE = 128
 
 @dataclass(frozen=True)
 class StockRow:
@@ -50,39 +57,100 @@ class MoySkladClient:
         return request_json("PUT", url, headers=self.headers, params=params, json_body=json, timeout=timeout)
 
     # -------- Stock report --------
-    def get_stock_bystore(self) -> Dict[str, Any]:
+    def get_stock_bystore(self, limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Отчёт целиком: страницы параллельно, по meta.size. Размер страницы — из
+        app/batching.py (до 1000, максимум МС), в пределах отчёта не меняется.
+        """
         url = f"{MS_BASE}/report/stock/bystore"
-        return request_json("GET", url, headers=self.headers, params={"stockMode": "all"})
+        name = "ms.report_stock_bystore"
+        rows: List[Dict[str, Any]] = []
+        for page in offset_pages(
+            lambda offset, lim: batching.call(name, lim, self._page, url, {"stockMode": "all"}, offset, lim),
+            limit or batching.size(name),
+        ):
+            rows.extend(page)
+        return {"rows": rows}
+
+    def _page(
+        self, url: str, params: Dict[str, Any], offset: int, limit: int
+    ) -> Tuple[List[Dict[str, Any]], int | None]:
+        data = request_json("GET", url, headers=self.headers, params={**params, "limit": limit, "offset": offset})
+        size = ((data or {}).get("meta") or {}).get("size")
+        return (data or {}).get("rows") or [], int(size) if size is not None else None
+
+    def get_free_stock_current(
+        self, assortment_ids: List[str], store_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        Текущий свободный остаток (stock - reserve) по конкретным позициям на складах:
+        /report/stock/bystore/current, все склады одним запросом на чанк; чанк режется
+        длиной URL (app/batching.py).
+        Возвращает store_id -> {assortment_id -> остаток}; позиции без строк в ответе — 0.
+        """
+        url = f"{MS_BASE}/report/stock/bystore/current"
+        ids = sorted({x for x in assortment_ids if x})
+        stores = sorted({x for x in store_ids if x})
+        out: Dict[str, Dict[str, float]] = {sid: {x: 0.0 for x in ids} for sid in stores}
+        store_flt = [f"storeId={sid}" for sid in stores]
+
+        def fetch(part: List[str]) -> Any:
+            flt = ";".join([f"assortmentId={x}" for x in part] + store_flt)
+            return request_json(
+                "GET", url, headers=self.headers,
+                params={"filter": flt, "stockType": "freeStock", "include": "zeroLines"},
+            )
+
+        used = len(url) + len(quote(";".join(store_flt), safe="")) + _URL_PARAMS_RESERVE
+        for _, rows in batching.batches("ms.stock_current", ids, fetch, url_used=used, url_key="assortmentId"):
+            for r in rows or []:
+                by_id = out.get(r.get("storeId") or "")
+                aid = r.get("assortmentId")
+                if by_id is not None and aid in by_id:
+                    by_id[aid] = max(0.0, float(r.get("stock") or 0))
+        return out
 
     def extract_store_rows(self, report: Dict[str, Any], store_id: str) -> List[StockRow]:
-        store_marker = f"/entity/store/{store_id}"
-        out: List[StockRow] = []
+        return self.extract_store_sets(report, {store_id: (store_id,)})[store_id]
+
+    def extract_store_sets(
+        self, report: Dict[str, Any], store_sets: Mapping[str, Iterable[str]]
+    ) -> Dict[str, List[StockRow]]:
+        """
+        Один проход по отчёту для всех наборов складов: ключ набора -> строки с суммой
+        по его складам. Свободный остаток считается по каждому складу отдельно
+        (резерв одного склада не закрывается остатком другого) и складывается.
+        """
+        sets = {k: set(v) for k, v in store_sets.items()}
+        out: Dict[str, List[StockRow]] = {k: [] for k in sets}
 
         for r in (report.get("rows") or []):
-            sbs = r.get("stockByStore") or []
-            store_entry = None
-            for s in sbs:
-                href = ((s.get("meta") or {}).get("href")) or ""
-                if store_marker in href:
-                    store_entry = s
-                    break
-            if not store_entry:
+            by_store: Dict[str, Tuple[float, float]] = {}
+            for s in r.get("stockByStore") or []:
+                shref = (((s.get("meta") or {}).get("href")) or "").split("?", 1)[0]
+                if "/entity/store/" not in shref:
+                    continue
+                by_store[shref.rstrip("/").rsplit("/", 1)[-1]] = (
+                    float(s.get("stock") or 0),
+                    float(s.get("reserve") or 0),
+                )
+            if not by_store:
                 continue
 
             href = ((r.get("meta") or {}).get("href")) or ""
             href = href.split("?", 1)[0]
             if not href:
                 continue
-
             article = (r.get("article") or "").strip()  # в отчёте обычно пусто
-            stock = float(store_entry.get("stock") or 0)
-            reserve = float(store_entry.get("reserve") or 0)
 
-            available = stock - reserve
-            if available < 0:
-                available = 0.0
-
-            out.append(StockRow(href=href, article=article, stock=stock, reserve=reserve, available=available))
+            for key, stores in sets.items():
+                hit = [by_store[x] for x in stores if x in by_store]
+                if not hit:
+                    continue
+                stock = sum(st for st, _ in hit)
+                reserve = sum(rs for _, rs in hit)
+                available = sum(max(0.0, st - rs) for st, rs in hit)
+                out[key].append(StockRow(href=href, article=article, stock=stock, reserve=reserve, available=available))
 
         return out
 
@@ -141,14 +209,15 @@ class MoySkladClient:
                     return v.strip()
             return ""
 
-        # chunk to keep URL reasonable
-        def chunks(lst: List[str], n: int = 100) -> List[List[str]]:
-            return [lst[i:i+n] for i in range(0, len(lst), n)]
-
         for ent_type, ids in by_type.items():
             uniq = sorted(set(ids))
-            for part in chunks(uniq, 100):
-                rows = self._get_entities_by_ids(ent_type, part)
+            # батчи режутся длиной URL: filter=id=...;id=... идёт в query
+            used = len(f"{MS_BASE}/entity/{ent_type}") + _URL_PARAMS_RESERVE
+            for _, rows in batching.batches(
+                "ms.entity_by_ids", uniq,
+                lambda part, t=ent_type: self._get_entities_by_ids(t, part),
+                url_used=used, url_key="id",
+            ):
                 for r in rows:
                     rid = r.get("id")
                     if not rid:
@@ -168,16 +237,14 @@ class MoySkladClient:
         return request_json("GET", url, headers=self.headers, params={"limit": limit, "offset": offset})
 
     def get_all_bundles_basic(self) -> List[Dict[str, Any]]:
+        url = f"{MS_BASE}/entity/bundle"
         out: List[Dict[str, Any]] = []
-        offset = 0
-        limit = 100
-        while True:
-            page = self.list_bundles(limit=limit, offset=offset)
-            rows = page.get("rows") or []
+        name = "ms.entity_bundle"
+        for rows in offset_pages(
+            lambda offset, limit: batching.call(name, limit, self._page, url, {}, offset, limit),
+            batching.size(name),
+        ):
             out.extend(rows)
-            if len(rows) < limit:
-                break
-            offset += limit
         return out
 
     def get_bundle(self, bundle_id: str) -> Dict[str, Any]:
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import threading
 from typing import Any
 from datetime import datetime, timezone
 
+from app import ledger
+
 from .constants import (
     MS_COUNTERPARTY_OZON_ID,
     MS_STORE_OZON_ID,
@@ -25,28 +28,38 @@ class CustomerOrderService:
     def __init__(self, ms):
         self.ms = ms
         self.ass = AssortmentResolver(ms)
+        # id позиций ассортимента, чей резерв поменялся (для точечной отправки остатков)
+        self.touched: set[str] = set()
+        self._touched_lock = threading.Lock()
+
+    def _touch(self, assortment: dict) -> None:
+        href = ((assortment or {}).get("meta") or {}).get("href") or ""
+        if href:
+            with self._touched_lock:
+                self.touched.add(href.split("?", 1)[0].rstrip("/").split("/")[-1])
 
     def find_by_name(self, name: str) -> dict | None:
         name = (name or "").strip()
         if not name:
             return None
 
-        # search (надёжнее, чем filter по name)
-        resp = self.ms.get("/entity/customerorder", params={"search": name, "limit": 100})
-        rows = resp.get("rows") or []
-        for x in rows:
-            if (x.get("name") or "").strip() == name:
-                return x
-
-        # fallback filter
-        for flt in (f'name="{name}"', f"name={name}"):
-            resp = self.ms.get("/entity/customerorder", params={"filter": flt, "limit": 50})
+        with ledger.stage("find_by_name"):
+            # search (надёжнее, чем filter по name)
+            resp = self.ms.get("/entity/customerorder", params={"search": name, "limit": 100})
             rows = resp.get("rows") or []
             for x in rows:
                 if (x.get("name") or "").strip() == name:
                     return x
 
-        return None
+            # fallback filter
+            for flt in (f'name="{name}"', f"name={name}"):
+                resp = self.ms.get("/entity/customerorder", params={"filter": flt, "limit": 50})
+                rows = resp.get("rows") or []
+                for x in rows:
+                    if (x.get("name") or "").strip() == name:
+                        return x
+
+            return None
 
     def ensure_prices(self, order: dict) -> None:
         """
@@ -86,8 +99,10 @@ class CustomerOrderService:
             offer_id = str(p["offer_id"]).strip()
             qty = float(p.get("quantity") or 0)
 
-            ass = self.ass.get_by_article(offer_id)
+            with ledger.stage("resolve_assortment"):
+                ass = self.ass.get_by_article(offer_id)
             price = extract_sale_price_cents(ass)
+            self._touch(ass)
 
             positions.append(
                 {
@@ -166,5 +181,6 @@ class CustomerOrderService:
                 href,
                 json={"reserve": 0},
             )
+            self._touch(r.get("assortment") or {})
 
         return self.ms.get(f"/entity/customerorder/{order_id}")
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+from app import jsoncodec
+
+T = TypeVar("T")
+
+INTENT = "intent"
+DONE = "done"
+
+# операция целиком: постинг обработан в этом статусе
+OP_POSTING = "posting"
+OP_ORDER_UPSERT = "order_upsert"
+OP_ENSURE_PRICES = "ensure_prices"
+OP_DEMAND_DEDUP = "demand_dedup"
+OP_DEMAND_CREATE = "demand_create"
+OP_REMOVE_RESERVE = "remove_reserve"
+
+
+def posting_key(posting_number: str, status: str) -> str:
+    """Ключ идемпотентности: один и тот же постинг в новом статусе — новая работа."""
+    return f"{posting_number}|{status}"
+
+
+def order_ref(order: Dict[str, Any]) -> Dict[str, Any]:
+    """Минимум заказа, нужный следующим шагам (id, meta) — без повторного чтения из МС."""
+    meta = order.get("meta") or {}
+    return {"id": order.get("id"), "meta": {"href": meta.get("href"), "type": meta.get("type")}}
+
+
+class Outbox:
+    """
+    Журнал записей в МС для sync_orders: <cache_dir>/orders_outbox.jsonl, только дозапись.
+
+    Перед записью в МС — строка intent, после успеха — done (с результатом, если он
+    нужен дальше). При перезапуске выполненные шаги не повторяются и не перепроверяются
+    запросами; незавершённые (intent без done) выполняются заново — сами шаги
+    идемпотентны по posting_number / externalCode.
+
+    Между процессами (ручной `postings` во время таймерного прогона) — flock на
+    <path>.lock: чтение и сжатие журнала — эксклюзивно, дозапись — разделяемо; файл,
+    подменённый сжатием, дописывающий открывает заново (сменился inode).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # (op, key) -> (phase, data)
+        self._state: Dict[Tuple[str, str], Tuple[str, Dict[str, Any]]] = {}
+        self._lf = open(f"{path}.lock", "a")
+        with self._flock(fcntl.LOCK_EX):
+            lines = self._load()
+            if lines > 2 * len(self._state) + 1000:
+                self._compact()
+            self._f = open(self.path, "a", encoding="utf-8")
+
+    @contextmanager
+    def _flock(self, mode: int) -> Iterator[None]:
+        fcntl.flock(self._lf.fileno(), mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lf.fileno(), fcntl.LOCK_UN)
+
+    def _reopen_if_replaced(self) -> None:
+        try:
+            if os.stat(self.path).st_ino == os.fstat(self._f.fileno()).st_ino:
+                return
+        except FileNotFoundError:
+            pass
+        self._f.close()
+        self._f = open(self.path, "a", encoding="utf-8")
+
+    def _load(self) -> int:
+        lines = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        rec = jsoncodec.loads(line)
+                    except Exception:
+                        # недописанная последняя строка после падения
+                        continue
+                    self._state[(rec["op"], rec["key"])] = (rec["phase"], rec.get("data") or {})
+        except FileNotFoundError:
+            pass
+        return lines
+
+    def _compact(self) -> None:
+        # у завершённых постингов шаги больше не нужны — оставляем одну строку на постинг
+        done_postings = {k for (op, k), (ph, _) in self._state.items() if op == OP_POSTING and ph == DONE}
+        self._state = {
+            (op, k): v for (op, k), v in self._state.items() if op == OP_POSTING or k not in done_postings
+        }
+        tmp = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for (op, key), (phase, data) in self._state.items():
+                f.write(jsoncodec.dumps({"op": op, "key": key, "phase": phase, "data": data}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _append(self, op: str, key: str, phase: str, data: Dict[str, Any]) -> None:
+        rec = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "op": op,
+            "key": key,
+            "phase": phase,
+            "data": data,
+        }
+        line = jsoncodec.dumps(rec) + "\n"
+        with self._lock, self._flock(fcntl.LOCK_SH):
+            self._reopen_if_replaced()
+            self._state[(op, key)] = (phase, data)
+            self._f.write(line)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def is_done(self, op: str, key: str) -> bool:
+        with self._lock:
+            st = self._state.get((op, key))
+        return st is not None and st[0] == DONE
+
+    def result(self, op: str, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            st = self._state.get((op, key))
+        return st[1] if st is not None and st[0] == DONE else None
+
+    def forget(self, key: str) -> None:
+        """
+        Шаги ключа — как не выполненные: следующий once вызовет fn. Только в памяти:
+        повторённые шаги допишут в журнал свои intent/done.
+        """
+        with self._lock:
+            for k in [k for k in self._state if k[1] == key]:
+                del self._state[k]
+
+    def intent(self, op: str, key: str, **data: Any) -> None:
+        self._append(op, key, INTENT, data)
+
+    def done(self, op: str, key: str, **data: Any) -> None:
+        self._append(op, key, DONE, data)
+
+    def once(
+        self,
+        op: str,
+        key: str,
+        fn: Callable[[], T],
+        *,
+        keep: Callable[[T], Dict[str, Any]] = lambda _: {},
+        done_if: Callable[[T], bool] = lambda _: True,
+        **data: Any,
+    ) -> Tuple[T | None, bool]:
+        """
+        Выполняет шаг, если он ещё не завершён. Возвращает (результат, replayed):
+        при replayed=True результат — сохранённый keep(...) из журнала, а fn не вызывается.
+        done_if(result) == False — шаг не считается выполненным (повторится в следующий раз).
+        """
+        saved = self.result(op, key)
+        if saved is not None:
+            return saved.get("result"), True  # type: ignore[return-value]
+        self.intent(op, key, **data)
+        res = fn()
+        if done_if(res):
+            self.done(op, key, result=keep(res), **data)
+        return res, False
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            items = list(self._state.items())
+        out = {"postings_done": 0, "incomplete": 0}
+        for (op, _), (phase, _) in items:
+            if op == OP_POSTING and phase == DONE:
+                out["postings_done"] += 1
+            elif phase == INTENT:
+                out["incomplete"] += 1
+        return out
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+            self._lf.close()
+
+
+def open_outbox(cache_dir: str) -> Outbox:
+    return Outbox(os.path.join(cache_dir, "orders_outbox.jsonl"))
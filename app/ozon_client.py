@@ -1,14 +1,39 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Any, Dict, List, Set
-import json
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import os
 import time
 
-from .http import request_json
-
-OZON_BASE = "https://api-seller.ozon.ru"
+from . import batching, cache
+from .http import HttpError, request_json
+from .paginate import cursor_pages, window_pages
+
+# переопределяется только для стенда (bench/fake_api.py)
+OZON_BASE = os.getenv("OZON_BASE_URL", "https://api-seller.ozon.ru").rstrip("/")
+
+# окна /v3/posting/fbs/list: начальное, минимальное (дальше — offset) и максимальное
+FBS_WINDOW_SPAN = timedelta(days=1)
+FBS_WINDOW_MIN = timedelta(minutes=10)
+FBS_WINDOW_MAX = timedelta(days=30)
+
+def _as_utc(dt: Any) -> datetime:
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def _norm_supply_items(items: Any) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    for it in items or []:
+        # try common fields
+        offer_id = it.get("offer_id") or it.get("offerId") or it.get("offerID")
+        qty = it.get("quantity") or it.get("qty") or it.get("count")
+        if offer_id and qty:
+            out.append({"offer_id": str(offer_id), "quantity": float(qty)})
+    return out
 
 @dataclass(frozen=True)
 class OzonCreds:
@@ -20,10 +45,11 @@ class OzonCreds:
 class OzonClient:
     def __init__(self, creds: OzonCreds, cache_dir: str):
         self.creds = creds
-        os.makedirs(cache_dir, exist_ok=True)
-        self.cache_path = os.path.join(
-            cache_dir, f"offer_ids_{creds.name.lower()}.json"
-        )
+        self._offers = cache.store(cache_dir, "offer_ids")
+        self._offers_key = creds.name.lower()
+        self._legacy_offers = os.path.join(cache_dir, f"offer_ids_{self._offers_key}.json")
+        # /v3/supply-order/items отсутствует у аккаунта — сразу идём в /get
+        self._supply_items_unsupported = False
 
     def _headers(self) -> Dict[str, str]:
         return {
@@ -33,116 +59,132 @@ class OzonClient:
         }
 
     def list_offer_ids(self, ttl_seconds: int = 7 * 60) -> Set[str]:
-        now = time.time()
+        cached = self._offers.get(self._offers_key)
+        if cached is None:
+            def fresh(data: Any) -> Any:
+                ok = isinstance(data, dict) and time.time() - float(data.get("ts", 0)) < ttl_seconds
+                return (data.get("offer_ids") or []) if ok else None
 
-        # cache
-        try:
-            if os.path.exists(self.cache_path):
-                with open(self.cache_path, "r", encoding="utf-8") as f:
-                    c = json.load(f)
-                if (now - float(c.get("ts", 0))) < ttl_seconds:
-                    return set(c.get("offer_ids", []))
-        except Exception:
-            pass
+            cached = cache.migrate_json(self._legacy_offers, self._offers, self._offers_key, fresh, ttl_s=ttl_seconds)
+        if cached is not None:
+            return set(cached)
 
         offer_ids: Set[str] = set()
-
-        last_id = ""
-        limit = 100  # безопасный лимит
-        seen_last_ids = set()
-
         url = f"{OZON_BASE}/v3/product/list"
+        name = "ozon.product_list"
 
-        while True:
-            if last_id in seen_last_ids:
-                break
-            seen_last_ids.add(last_id)
-
+        def fetch(last_id: str) -> Tuple[List[Dict[str, Any]], str]:
+            # курсор last_id не зависит от limit — размер подстраивается от страницы к странице
+            limit = batching.size(name)
             body: Dict[str, Any] = {
                 "filter": {},
                 "last_id": last_id,
                 "limit": limit,
             }
-
-            data = request_json(
+            data = batching.call(
+                name, limit, request_json,
                 "POST",
                 url,
                 headers=self._headers(),
                 json_body=body,
                 timeout=60,
             )
-
             result = data.get("result") or {}
-            items = result.get("items") or []
+            return result.get("items") or [], str(result.get("last_id") or "")
 
+        # следующая страница запрашивается, пока разбираем текущую
+        for items in cursor_pages(fetch):
             for it in items:
                 oid = it.get("offer_id")
                 if oid:
                     offer_ids.add(str(oid))
 
-            last_id = str(result.get("last_id") or "")
-            if not items or not last_id:
-                break
-
         try:
-            with open(self.cache_path, "w", encoding="utf-8") as f:
-                json.dump(
-                    {"ts": now, "offer_ids": sorted(offer_ids)},
-                    f,
-                    ensure_ascii=False,
-                )
+            self._offers.put(self._offers_key, sorted(offer_ids), ttl_s=ttl_seconds)
         except Exception:
             pass
 
         return offer_ids
 
+    def offer_ids_for(self, candidates: Iterable[str], ttl_seconds: int = 7 * 60) -> Set[str]:
+        """
+        offer_id кабинета для точечной отправки: полный список из кэша, если он свежий,
+        иначе — только среди candidates (фильтр /v3/product/list, без листания каталога).
+        """
+        cached = self._offers.get(self._offers_key)
+        if cached is not None:
+            return set(cached)
+        wanted = sorted({str(x) for x in candidates if x})
+        url = f"{OZON_BASE}/v3/product/list"
+
+        def lookup(part: List[str]) -> Set[str]:
+            # limit = размер фильтра, так что страница обычно одна; листаем в этом
+            # потоке — время запроса идёт в подбор размера (app/batching.py)
+            found: Set[str] = set()
+            last_id = ""
+            while True:
+                body = {"filter": {"offer_id": part}, "last_id": last_id, "limit": len(part)}
+                result = request_json("POST", url, headers=self._headers(), json_body=body, timeout=60).get("result") or {}
+                items = result.get("items") or []
+                found.update(str(it["offer_id"]) for it in items if it.get("offer_id"))
+                nxt = str(result.get("last_id") or "")
+                if not items or not nxt or nxt == last_id:
+                    return found
+                last_id = nxt
+
+        out: Set[str] = set()
+        for _, found in batching.batches("ozon.product_list_offers", wanted, lookup):
+            out |= found
+        return out
+
     # ---------------------------
     # FBO Supply Orders (v3)
     # ---------------------------
 
-    def list_supply_order_ids(self, states: List[str], limit: int = 100) -> List[int]:
+    def list_supply_order_ids(self, states: List[str], limit: Optional[int] = None) -> List[int]:
         """
         Returns list of supply order IDs (order_id) by states.
         Uses POST /v3/supply-order/list with pagination by last_id.
         """
-        url = f"{OZON_BASE}/v3/supply-order/list"
-
-        last_id = ""
         out: List[int] = []
-        seen_last_ids = set()
+        for ids in self.iter_supply_order_ids(states, limit=limit):
+            out.extend(ids)
+        return out
 
-        while True:
-            if last_id in seen_last_ids:
-                break
-            seen_last_ids.add(last_id)
+    def iter_supply_order_ids(self, states: List[str], limit: Optional[int] = None) -> Iterator[List[int]]:
+        """
+        То же постранично: следующая страница грузится в фоне,
+        пока вызывающий обрабатывает текущую. Без limit — размер из app/batching.py.
+        """
+        url = f"{OZON_BASE}/v3/supply-order/list"
+        name = "ozon.supply_order_list"
 
+        def fetch(last_id: str) -> Tuple[List[Any], str]:
+            lim = int(limit or batching.size(name))
             body: Dict[str, Any] = {
                 "filter": {"states": states},
-                "limit": int(limit),
+                "limit": lim,
                 "sort_by": "ORDER_CREATION",
                 "sort_dir": "DESC",
                 "last_id": last_id,
             }
-
-            data = request_json(
+            data = batching.call(
+                name, lim, request_json,
                 "POST", url,
                 headers=self._headers(),
                 json_body=body,
                 timeout=60,
             )
+            return data.get("order_ids") or [], str(data.get("last_id") or "")
 
-            ids = data.get("order_ids") or []
+        for ids in cursor_pages(fetch):
+            page: List[int] = []
             for x in ids:
                 try:
-                    out.append(int(x))
+                    page.append(int(x))
                 except Exception:
                     pass
-
-            last_id = str(data.get("last_id") or "")
-            if not ids or not last_id:
-                break
-
-        return out
+            yield page
 
     def get_supply_order(self, order_id: int) -> Dict[str, Any]:
         """
@@ -172,68 +214,58 @@ class OzonClient:
           [{"offer_id": "...", "quantity": N}, ...]
 
         Primary: POST /v3/supply-order/items
-        Fallback: try to extract from get_supply_order() payload if items are embedded.
+        Fallback: extract from get_supply_order() payload if items are embedded.
+        Fallback is used only when the items endpoint is unavailable (404/405 —
+        remembered per client, so later orders cost one call) or failed.
+        An empty items list is a valid answer and does not trigger a second call.
         """
-        # 1) Try dedicated items endpoint
-        url = f"{OZON_BASE}/v3/supply-order/items"
-        body = {"order_id": int(order_id), "limit": 1000, "offset": 0}
-
-        try:
-            data = request_json(
-                "POST", url,
-                headers=self._headers(),
-                json_body=body,
-                timeout=60,
-            )
-
-            # common shapes:
-            # {"items":[...]} OR {"result":{"items":[...]}}
-            items = data.get("items")
-            if items is None:
-                items = (data.get("result") or {}).get("items")
-
-            out: List[Dict[str, Any]] = []
-            for it in items or []:
-                # try common fields
-                offer_id = it.get("offer_id") or it.get("offerId") or it.get("offerID")
-                qty = it.get("quantity") or it.get("qty") or it.get("count")
-                if offer_id and qty:
-                    out.append({"offer_id": str(offer_id), "quantity": float(qty)})
-            if out:
-                return out
-        except Exception:
-            pass
-
-        # 2) Fallback: sometimes items are embedded in order/get response
+        if not self._supply_items_unsupported:
+            url = f"{OZON_BASE}/v3/supply-order/items"
+            body = {"order_id": int(order_id), "limit": 1000, "offset": 0}
+            try:
+                data = request_json(
+                    "POST", url,
+                    headers=self._headers(),
+                    json_body=body,
+                    timeout=60,
+                )
+                # common shapes:
+                # {"items":[...]} OR {"result":{"items":[...]}}
+                items = data.get("items")
+                if items is None:
+                    items = (data.get("result") or {}).get("items")
+                if items is not None:
+                    return _norm_supply_items(items)
+            except HttpError as e:
+                if e.status in (404, 405) and "not found" not in (e.text or "").lower():
+                    self._supply_items_unsupported = True
+            except Exception:
+                pass
+
+        # Fallback: sometimes items are embedded in order/get response
         core = self.get_supply_order(order_id) or {}
         candidates = (
             core.get("items")
             or (core.get("result") or {}).get("items")
             or (core.get("order_items") or [])
         )
+        return _norm_supply_items(candidates)
 
-        out2: List[Dict[str, Any]] = []
-        for it in candidates or []:
-            offer_id = it.get("offer_id") or it.get("offerId") or it.get("offerID")
-            qty = it.get("quantity") or it.get("qty") or it.get("count")
-            if offer_id and qty:
-                out2.append({"offer_id": str(offer_id), "quantity": float(qty)})
-
-        return out2
-    
     def set_stocks(self, stocks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Позиции могут быть на разных складах кабинета — warehouse_id у каждой своя."""
         url = f"{OZON_BASE}/v2/products/stocks"
         payload = {
             "stocks": [
                 {
                     "offer_id": s["offer_id"],
-                    "warehouse_id": self.creds.warehouse_id,
+                    "warehouse_id": int(s.get("warehouse_id") or self.creds.warehouse_id),
                     "stock": int(s["stock"]),
                 }
                 for s in stocks
             ]
         }
-        return request_json(
+        return batching.call(
+            "ozon.stocks", len(stocks), request_json,
             "POST",
             url,
             headers=self._headers(),
@@ -270,56 +302,64 @@ class OzonClient:
         date_from: Any,
         date_to: Any,
         statuses: List[str] | None = None,
-        limit: int = 1000,
+        limit: Optional[int] = None,
     ) -> List[Dict[str, Any]]:
         """
         Returns list of postings (short) for FBS.
         Uses /v3/posting/fbs/list with offset/limit pagination.
         """
-        url = f"{OZON_BASE}/v3/posting/fbs/list"
-
-        df = self._to_ozon_ts(date_from)
-        dt = self._to_ozon_ts(date_to)
-
-        offset = 0
         out: List[Dict[str, Any]] = []
+        for postings in self.iter_fbs_postings(date_from, date_to, statuses, limit):
+            out.extend(postings)
+        return out
 
-        while True:
+    def iter_fbs_postings(
+        self,
+        date_from: Any,
+        date_to: Any,
+        statuses: List[str] | None = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Постинги FBS страницами по мере загрузки: диапазон режется на окна по времени
+        (адаптивно, см. window_pages), окна грузятся параллельно, пока вызывающий
+        обрабатывает готовые; постинг с границы окон отдаётся один раз.
+        В памяти — не больше PAGE_PREFETCH страниц (плюс номера для дедупа).
+        Без limit — размер страницы из app/batching.py, на весь диапазон один.
+        """
+        url = f"{OZON_BASE}/v3/posting/fbs/list"
+        name = "ozon.fbs_list"
+
+        def fetch(since: datetime, to: datetime, offset: int, lim: int) -> List[Dict[str, Any]]:
             flt: Dict[str, Any] = {
-                "since": df,
-                "to": dt,
+                "since": self._to_ozon_ts(since),
+                "to": self._to_ozon_ts(to),
             }
             if statuses:
                 flt["status"] = statuses
-
             body: Dict[str, Any] = {
                 "filter": flt,
-                "limit": int(limit),
+                "limit": int(lim),
                 "offset": int(offset),
                 # with/analytics/financial_data включаем только если реально нужно
                 # "with": {"analytics_data": True, "financial_data": True},
             }
-
-            data = request_json(
+            data = batching.call(
+                name, int(lim), request_json,
                 "POST",
                 url,
                 headers=self._headers(),
                 json_body=body,
                 timeout=60,
             )
-
             result = data.get("result") or {}
-            postings = result.get("postings") or []
-            if postings:
-                out.extend(postings)
-
-            # Если вернулось меньше лимита — конец
-            if not postings or len(postings) < int(limit):
-                break
+            return result.get("postings") or []
 
-            offset += int(limit)
-
-        return out
+        return window_pages(
+            fetch, _as_utc(date_from), _as_utc(date_to), int(limit or batching.size(name)),
+            span=FBS_WINDOW_SPAN, min_span=FBS_WINDOW_MIN, max_span=FBS_WINDOW_MAX,
+            key=lambda p: p.get("posting_number"),
+        )
 
     def fbs_get(self, posting_number: str) -> Dict[str, Any]:
         """
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from . import trace
+
+T = TypeVar("T")
+
+# сколько страниц держим "в полёте"; реальную параллельность всё равно режет ratelimit
+PREFETCH = max(1, int(os.getenv("PAGE_PREFETCH", "4") or 4))
+
+# fetch(offset, limit) -> (rows, total | None)
+OffsetFetch = Callable[[int, int], Tuple[List[T], Optional[int]]]
+# fetch(cursor) -> (rows, next_cursor); пустой next_cursor — конец
+CursorFetch = Callable[[str], Tuple[List[T], str]]
+# fetch(since, to, offset, limit) -> rows
+WindowFetch = Callable[[datetime, datetime, int, int], List[T]]
+
+
+def offset_pages(fetch: OffsetFetch, limit: int, prefetch: int = PREFETCH) -> Iterator[List[T]]:
+    """
+    Страницы offset-пагинации по порядку, до `prefetch` запросов параллельно.
+
+    Если первая страница сообщила total (meta.size в МС) — запрашиваются ровно
+    нужные смещения. Иначе — спекулятивно на prefetch страниц вперёд до первой
+    неполной (лишние хвостовые запросы отбрасываются).
+    """
+    rows, total = fetch(0, limit)
+    yield rows
+    if len(rows) < limit or (total is not None and total <= limit):
+        return
+    if prefetch <= 1:
+        offset = limit
+        while True:
+            rows, _ = fetch(offset, limit)
+            yield rows
+            if len(rows) < limit:
+                return
+            offset += limit
+
+    pool = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="page")
+    inflight: Deque[Future] = deque()
+    next_offset = limit
+
+    def submit() -> None:
+        nonlocal next_offset
+        inflight.append(pool.submit(trace.bind(fetch), next_offset, limit))
+        next_offset += limit
+
+    def more() -> bool:
+        return total is None or next_offset < total
+
+    try:
+        while len(inflight) < prefetch and more():
+            submit()
+        while inflight:
+            rows, _ = inflight.popleft().result()
+            yield rows
+            if len(rows) < limit:
+                # конец данных: хвост спекулятивных запросов не нужен
+                return
+            if more():
+                submit()
+    finally:
+        for f in inflight:
+            f.cancel()
+        pool.shutdown(wait=False)
+
+
+def cursor_pages(fetch: CursorFetch, start: str = "") -> Iterator[List[T]]:
+    """
+    Страницы cursor-пагинации (last_id). Следующая страница запрашивается в фоне,
+    пока потребитель обрабатывает текущую. Повтор курсора — конец (защита от цикла).
+    """
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cursor")
+    seen = {start}
+    try:
+        fut: Optional[Future] = pool.submit(trace.bind(fetch), start)
+        while fut is not None:
+            rows, cursor = fut.result()
+            fut = None
+            if rows and cursor and cursor not in seen:
+                seen.add(cursor)
+                fut = pool.submit(trace.bind(fetch), cursor)
+            yield rows
+    finally:
+        if fut is not None:
+            fut.cancel()
+        pool.shutdown(wait=False)
+
+
+def window_pages(
+    fetch: WindowFetch,
+    since: datetime,
+    to: datetime,
+    limit: int,
+    *,
+    span: timedelta,
+    min_span: timedelta,
+    max_span: timedelta,
+    key: Callable[[T], Any],
+    workers: int = PREFETCH,
+) -> Iterator[List[T]]:
+    """
+    Диапазон since..to окнами по времени, до `workers` окон параллельно; страницы
+    отдаются по мере готовности (не по порядку времени).
+
+    Окно вернуло полную страницу — делится пополам, следующие окна вдвое короче;
+    вернуло меньше четверти страницы — следующие вдвое длиннее. Окно min_span
+    с полной страницей дочитывается offset-пагинацией. Строки с уже отданным key
+    (границы окон включительные) отбрасываются.
+    """
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="window")
+    inflight: Dict[Future, Tuple[datetime, datetime]] = {}
+    split: Deque[Tuple[datetime, datetime]] = deque()  # половинки — вне очереди
+    cursor = since
+    seen: Set[Any] = set()
+
+    def fresh(rows: List[T]) -> List[T]:
+        out = []
+        for r in rows:
+            k = key(r)
+            if k in seen:
+                continue
+            seen.add(k)
+            out.append(r)
+        return out
+
+    def fill() -> None:
+        nonlocal cursor
+        while len(inflight) < max(1, workers):
+            if split:
+                w = split.popleft()
+            elif cursor < to:
+                w = (cursor, min(to, cursor + span))
+                cursor = w[1]
+            else:
+                return
+            inflight[pool.submit(trace.bind(fetch), w[0], w[1], 0, limit)] = w
+
+    try:
+        fill()
+        while inflight:
+            done, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+            for f in done:
+                a, b = inflight.pop(f)
+                rows = f.result()
+                if len(rows) >= limit and b - a > min_span:
+                    mid = a + (b - a) / 2
+                    split.extend([(a, mid), (mid, b)])
+                    span = max(min_span, span / 2)
+                    continue
+                if len(rows) < limit / 4:
+                    span = min(max_span, span * 2)
+                page = fresh(rows)
+                if page:
+                    yield page
+                if len(rows) >= limit:
+                    # окно уже минимальное — дальше по offset внутри него
+                    for more in offset_pages(
+                        lambda off, lim, a=a, b=b: (fetch(a, b, limit + off, lim), None), limit
+                    ):
+                        page = fresh(more)
+                        if page:
+                            yield page
+            fill()
+    finally:
+        for f in inflight:
+            f.cancel()
+        pool.shutdown(wait=False)
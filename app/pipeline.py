@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from . import trace
+from .trace import SpanNode
+
+# задач в очереди одного потока; дальше submit ждёт (producer не убегает вперёд)
+QUEUE_SIZE = 32
+
+
+class KeyedPool:
+    """
+    Пул потоков с очередью на поток: задачи с одним ключом попадают в один поток
+    и выполняются строго по порядку, задачи с разными ключами — параллельно.
+    Очереди ограничены — submit блокируется, пока поток не разгребёт свою.
+
+    Исключение задачи не останавливает пул: первое сохраняется в error,
+    вызывающий решает, продолжать ли подавать задачи.
+    """
+
+    def __init__(self, workers: int, name: str = "worker", queue_size: int = QUEUE_SIZE):
+        self._queues: List["queue.Queue[Any]"] = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(max(1, workers))]
+        self._lock = threading.Lock()
+        self.error: Optional[BaseException] = None
+        self._tasks = 0
+        self._failed = 0
+        self._wait_s = 0.0
+        self._busy_s = 0.0
+        self._t0 = time.perf_counter()
+        self._elapsed: Optional[float] = None
+        self._threads = [
+            threading.Thread(target=self._loop, args=(q,), name=f"{name}_{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key: str, fn: Callable[..., Any], *args: Any) -> None:
+        q = self._queues[hash(key) % len(self._queues)]
+        q.put((trace.bind(fn), args, time.perf_counter()))
+
+    def _loop(self, q: "queue.Queue[Any]") -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            fn, args, queued = item
+            t0 = time.perf_counter()
+            failed = False
+            try:
+                fn(*args)
+            except BaseException as e:
+                failed = True
+                with self._lock:
+                    if self.error is None:
+                        self.error = e
+            t1 = time.perf_counter()
+            with self._lock:
+                self._tasks += 1
+                self._failed += failed
+                self._wait_s += t0 - queued
+                self._busy_s += t1 - t0
+
+    def close(self) -> None:
+        """Дожидается всех поданных задач и останавливает потоки."""
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        if self._elapsed is None:
+            self._elapsed = time.perf_counter() - self._t0
+
+    def __enter__(self) -> "KeyedPool":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def elapsed(self) -> float:
+        return self._elapsed if self._elapsed is not None else time.perf_counter() - self._t0
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = self.elapsed()
+        with self._lock:
+            tasks, failed, wait_s, busy_s = self._tasks, self._failed, self._wait_s, self._busy_s
+        return {
+            "workers": len(self._queues),
+            "tasks": tasks,
+            "failed": failed,
+            "elapsed_s": round(elapsed, 3),
+            "per_s": round(tasks / elapsed, 2) if elapsed > 0 else None,
+            "avg_wait_s": round(wait_s / tasks, 4) if tasks else None,
+            # доля времени, когда потоки были заняты (остальное — ждали задач)
+            "utilization": round(busy_s / (elapsed * len(self._queues)), 3) if elapsed > 0 else None,
+        }
+
+
+def stage_rates(node: Optional[SpanNode], elapsed: float) -> Dict[str, Dict[str, Any]]:
+    """
+    Пропускная способность этапов по дочерним спанам node (шаги задачи):
+    сколько раз выполнен, суммарное время и сколько в секунду за время пула.
+    """
+    out: Dict[str, Dict[str, Any]] = {}
+    if node is None:
+        return out
+    for child in list(node.children.values()):
+        out[child.name] = {
+            "count": child.count,
+            "busy_s": round(child.wall_s, 3),
+            "per_s": round(child.count / elapsed, 2) if elapsed > 0 else None,
+        }
+    return out
@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from . import trace
+from .log import log_json
+
+# интервал сэмплера стеков, сек
+SAMPLE_INTERVAL_S = 0.005
+# глубина стека для tracemalloc: по этапам группируем по строке (lineno),
+# больше одного кадра только замедляет прогон
+TRACEMALLOC_FRAMES = 1
+TOP_N = 25
+# tracemalloc замедляет прогон в разы; SYNC_PROFILE_MEMORY=0 — только время и RSS
+PROFILE_MEMORY = os.getenv("SYNC_PROFILE_MEMORY", "1") != "0"
+
+
+def enabled(flag: bool = False) -> bool:
+    """--profile (flag — разобранный аргумент) или SYNC_PROFILE=1."""
+    return flag or os.getenv("SYNC_PROFILE", "0") == "1"
+
+
+def profiles_dir(cache_dir: str) -> str:
+    return os.path.join(cache_dir, "profiles")
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except Exception:
+        return 0.0
+
+
+def _peak_rss_mb() -> float:
+    # Linux: KiB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+_names: Dict[Any, str] = {}
+
+
+def _func(code: Any) -> str:
+    name = _names.get(code)
+    if name is None:
+        fn = code.co_filename
+        if fn.startswith(_ROOT):
+            fn = fn[len(_ROOT):]
+        name = _names[code] = f"{code.co_name} ({fn}:{code.co_firstlineno})"
+    return name
+
+
+def _idle(leaf: str) -> bool:
+    """Поток пула ждёт работу (Condition.wait / queue.get в _worker) — не сэмпл."""
+    return (leaf.startswith("wait (") and "threading.py" in leaf) or (
+        leaf.startswith("_worker (") and os.path.join("concurrent", "futures", "thread.py") in leaf
+    )
+
+
+class _Sampler(threading.Thread):
+    """
+    Сэмплирующий профилировщик всех потоков (cProfile видит только свой поток,
+    а работа идёт в пулах кабинетов/страниц): стек каждого потока раз в interval.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._halt = threading.Event()
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        while not self._halt.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                f = frame
+                while f is not None:
+                    stack.append(_func(f.f_code))
+                    f = f.f_back
+                if _idle(stack[0]):
+                    continue
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self._halt.set()
+        self.join(timeout=1.0)
+
+    def top(self, n: int) -> List[Dict[str, Any]]:
+        self_n: Counter = Counter()
+        total_n: Counter = Counter()
+        for stack, c in self.stacks.items():
+            self_n[stack[-1]] += c
+            for fn in set(stack):
+                total_n[fn] += c
+        all_n = sum(self.stacks.values()) or 1
+        return [
+            {"func": fn, "self": c, "self_pct": round(100.0 * c / all_n, 2), "total_pct": round(100.0 * total_n[fn] / all_n, 2)}
+            for fn, c in self_n.most_common(n)
+        ]
+
+    def folded(self) -> List[str]:
+        return [f"{';'.join(stack)} {c}" for stack, c in self.stacks.most_common()]
+
+
+class Session:
+    """
+    Профиль одного прогона: cProfile основного потока, сэмплер всех потоков,
+    tracemalloc по этапам (спаны глубины 1) и пиковый RSS.
+    Результат — <cache_dir>/profiles/<run_id>/: summary.json, cprofile.pstats, samples.folded.
+    """
+
+    def __init__(self, cache_dir: str, job: str, logger: logging.Logger):
+        self.job = job
+        self.logger = logger
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        self.run_id = f"{job}-{stamp}-{os.getpid()}"
+        self.dir = os.path.join(profiles_dir(cache_dir), self.run_id)
+        self.stages: List[Dict[str, Any]] = []
+        self._prof = cProfile.Profile()
+        self._sampler = _Sampler(SAMPLE_INTERVAL_S)
+        self._snap: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+        self._t0 = 0.0
+        self._c0 = 0.0
+
+    def __enter__(self) -> "Session":
+        if PROFILE_MEMORY:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._snap = tracemalloc.take_snapshot()
+        trace.on_stage_exit(self._stage_done)
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+        self._sampler.start()
+        self._prof.enable()
+        return self
+
+    def _stage_done(self, name: str) -> None:
+        """
+        Что этап оставил в памяти (разница снимков tracemalloc) и пик за этап.
+        Этапы кабинетов идут параллельно — их аллокации перемешиваются.
+        """
+        with self._lock:
+            row: Dict[str, Any] = {
+                "stage": name,
+                "at_s": round(time.perf_counter() - self._t0, 3),
+                "rss_mb": _rss_mb(),
+            }
+            if self._snap is not None:
+                snap = tracemalloc.take_snapshot()
+                cur, peak = tracemalloc.get_traced_memory()
+                row.update(
+                    traced_mb=round(cur / 1024 / 1024, 2),
+                    peak_traced_mb=round(peak / 1024 / 1024, 2),
+                    top_allocs=[
+                        {
+                            "where": f"{st.traceback[0].filename}:{st.traceback[0].lineno}",
+                            "size_diff_kb": round(st.size_diff / 1024, 1),
+                            "count_diff": st.count_diff,
+                        }
+                        for st in snap.compare_to(self._snap, "lineno")[:10]
+                    ],
+                )
+                self._snap = snap
+                tracemalloc.reset_peak()
+            self.stages.append(row)
+
+    def __exit__(self, *exc: Any) -> None:
+        self._prof.disable()
+        self._sampler.stop()
+        trace.on_stage_exit(None)
+        wall = time.perf_counter() - self._t0
+        cpu = time.process_time() - self._c0
+        if self._snap is not None:
+            tracemalloc.stop()
+            self._snap = None
+        try:
+            self._write(wall, cpu)
+        except Exception as e:
+            log_json(self.logger, "profile_write_failed", job=self.job, error=str(e))
+
+    def _write(self, wall: float, cpu: float) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        pstats_path = os.path.join(self.dir, "cprofile.pstats")
+        self._prof.dump_stats(pstats_path)
+        with open(os.path.join(self.dir, "samples.folded"), "w", encoding="utf-8") as f:
+            f.write("\n".join(self._sampler.folded()) + "\n")
+
+        st = pstats.Stats(pstats_path)
+        rows = []
+        for (fname, line, fn), (_, ncalls, tottime, cumtime, _) in st.stats.items():  # type: ignore[attr-defined]
+            rows.append({"func": f"{fn} ({fname}:{line})", "ncalls": ncalls, "tottime": round(tottime, 4), "cumtime": round(cumtime, 4)})
+        rows.sort(key=lambda r: r["tottime"], reverse=True)
+
+        summary = {
+            "run_id": self.run_id,
+            "job": self.job,
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3),
+            "peak_rss_mb": _peak_rss_mb(),
+            "samples": self._sampler.samples,
+            "sample_interval_s": SAMPLE_INTERVAL_S,
+            "sampled_top": self._sampler.top(TOP_N),
+            "cprofile_top": rows[:TOP_N],
+            "stages": self.stages,
+        }
+        with open(os.path.join(self.dir, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        log_json(
+            self.logger, "profile_written",
+            run_id=self.run_id, path=self.dir, wall_s=summary["wall_s"], peak_rss_mb=summary["peak_rss_mb"],
+        )
+
+
+def session(cache_dir: str, job: str, logger: logging.Logger, flag: bool = False) -> Optional[Session]:
+    """Session, если профилирование включено (flag — --profile / SYNC_PROFILE=1), иначе None."""
+    return Session(cache_dir, job, logger) if enabled(flag) else None
+
+
+# -------- сравнение двух прогонов --------
+
+def _load(ref: str, cache_dir: str) -> Dict[str, Any]:
+    path = ref if os.path.isdir(ref) else os.path.join(profiles_dir(cache_dir), ref)
+    with open(os.path.join(path, "summary.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _pct(a: float, b: float) -> str:
+    if not a:
+        return "n/a"
+    return f"{100.0 * (b - a) / a:+.1f}%"
+
+
+def diff(a: Dict[str, Any], b: Dict[str, Any], top: int = 15) -> List[str]:
+    out = [f"A: {a['run_id']}", f"B: {b['run_id']}", ""]
+    for k in ("wall_s", "cpu_s", "peak_rss_mb"):
+        out.append(f"{k:<12} {a.get(k, 0):>10} -> {b.get(k, 0):<10} {_pct(a.get(k, 0), b.get(k, 0))}")
+
+    # доля сэмплов (self) — сравнима между прогонами разной длины
+    sa = {r["func"]: r["self_pct"] for r in a.get("sampled_top") or []}
+    sb = {r["func"]: r["self_pct"] for r in b.get("sampled_top") or []}
+    moved = sorted(set(sa) | set(sb), key=lambda f: abs(sb.get(f, 0.0) - sa.get(f, 0.0)), reverse=True)
+    out += ["", "sampled self% (all threads), largest moves:"]
+    for fn in moved[:top]:
+        out.append(f"  {sa.get(fn, 0.0):>6.2f} -> {sb.get(fn, 0.0):<6.2f} {sb.get(fn, 0.0) - sa.get(fn, 0.0):+6.2f}  {fn}")
+
+    ca = {r["func"]: r["tottime"] for r in a.get("cprofile_top") or []}
+    cb = {r["func"]: r["tottime"] for r in b.get("cprofile_top") or []}
+    moved = sorted(set(ca) | set(cb), key=lambda f: abs(cb.get(f, 0.0) - ca.get(f, 0.0)), reverse=True)
+    out += ["", "cProfile tottime, s (main thread), largest moves:"]
+    for fn in moved[:top]:
+        out.append(f"  {ca.get(fn, 0.0):>8.4f} -> {cb.get(fn, 0.0):<8.4f} {_pct(ca.get(fn, 0.0), cb.get(fn, 0.0)):>8}  {fn}")
+
+    ma = {s["stage"]: s for s in a.get("stages") or []}
+    mb = {s["stage"]: s for s in b.get("stages") or []}
+    out += ["", "stages: peak traced MB / RSS MB:"]
+    for name in list(dict.fromkeys([*ma, *mb])):
+        x, y = ma.get(name) or {}, mb.get(name) or {}
+        out.append(
+            f"  {name:<24} {x.get('peak_traced_mb', '-'):>8} -> {y.get('peak_traced_mb', '-'):<8}"
+            f" rss {x.get('rss_mb', '-')} -> {y.get('rss_mb', '-')}"
+        )
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.profiling", description="Профили прогонов (--profile / SYNC_PROFILE=1)")
+    ap.add_argument("--cache-dir", default=os.getenv("CACHE_DIR", "/var/tmp/ozon_ms_cache"))
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list", help="run_id профилей")
+    d = sub.add_parser("diff", help="сравнить два прогона (run_id или путь)")
+    d.add_argument("a")
+    d.add_argument("b")
+    d.add_argument("--top", type=int, default=15)
+    a = ap.parse_args(argv)
+
+    if a.cmd == "list":
+        root = profiles_dir(a.cache_dir)
+        for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            print(name)
+        return 0
+    print("\n".join(diff(_load(a.a, a.cache_dir), _load(a.b, a.cache_dir), a.top)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
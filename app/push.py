@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from typing import AbstractSet, Any, Dict, List, Optional, Tuple
+
+from . import cache
+
+# Порядок отправки: чем раньше класс, тем выше риск перепродажи на Ozon
+ZERO = "zero"            # товар закончился
+DROP = "drop"            # крупное уменьшение
+CHANGE = "change"        # рост, мелкое уменьшение, новый offer
+UNCHANGED = "unchanged"  # подтверждение прежнего значения
+
+PRIORITY = (ZERO, DROP, CHANGE, UNCHANGED)
+
+# "крупное" уменьшение: на LARGE_DROP_ABS штук или хотя бы вдвое
+LARGE_DROP_ABS = 5
+LARGE_DROP_RATIO = 0.5
+
+
+def row_key(row: Dict[str, Any]) -> str:
+    """Ключ позиции отправки: один offer на разных складах Ozon — разные остатки."""
+    return f"{row.get('warehouse_id') or ''}:{row['offer_id']}"
+
+
+def accepted(part: List[Dict[str, Any]], rejected: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Позиции батча, которые Ozon принял (ошибка без warehouse_id — на всех складах offer)."""
+    bad = {row_key(r) for r in rejected if r.get("warehouse_id")}
+    bad_any = {str(r.get("offer_id")) for r in rejected if not r.get("warehouse_id")}
+    return [r for r in part if row_key(r) not in bad and str(r["offer_id"]) not in bad_any]
+
+
+def classify(new: int, prev: Optional[int]) -> str:
+    if new <= 0:
+        return UNCHANGED if prev == 0 else ZERO
+    if prev is None:
+        return CHANGE
+    if new == prev:
+        return UNCHANGED
+    if new < prev and (prev - new >= LARGE_DROP_ABS or new <= prev * LARGE_DROP_RATIO):
+        return DROP
+    return CHANGE
+
+
+def prioritized_batches(
+    payload: List[Dict[str, Any]],
+    prev: Dict[str, int],
+    size: int,
+    first: AbstractSet[str] = frozenset(),
+) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Батчи по классам в порядке PRIORITY; классы в одном батче не смешиваются.
+    Внутри DROP — сначала самые большие падения. Позиции из `first` (row_key, не успели
+    уйти в прошлый раз) идут первыми внутри своего класса — чтобы хвост не голодал.
+    """
+    by_cls: Dict[str, List[Tuple[bool, int, Dict[str, Any]]]] = {c: [] for c in PRIORITY}
+    for row in payload:
+        key = row_key(row)
+        p = prev.get(key)
+        new = int(row["stock"])
+        by_cls[classify(new, p)].append((key not in first, new - (p or 0), row))
+    for c in PRIORITY:
+        by_cls[c].sort(key=lambda x: (x[0], x[1]) if c == DROP else x[0])
+
+    out: List[Tuple[str, List[Dict[str, Any]]]] = []
+    for c in PRIORITY:
+        rows = [r for _, _, r in by_cls[c]]
+        for i in range(0, len(rows), size):
+            out.append((c, rows[i:i + size]))
+    return out
+
+
+def load_snapshot(cache_dir: str, cabinet: str) -> Dict[str, int]:
+    """row_key -> остаток, который Ozon последним принял (для классификации)."""
+    key = cabinet.lower()
+    try:
+        stocks = cache.store(cache_dir, "pushed_stock").get(key) or {}
+        return {str(k): int(v) for k, v in stocks.items()}
+    except Exception:
+        return {}
+
+
+def save_snapshot(cache_dir: str, cabinet: str, stocks: Dict[str, int]) -> None:
+    cache.store(cache_dir, "pushed_stock").put(cabinet.lower(), stocks)
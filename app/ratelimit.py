@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+# host -> (запросов в секунду, параллельных запросов)
+# МС: 45 запросов за 3 секунды и не больше 5 параллельных на пользователя.
+# Ozon: лимиты по методам разные, держим общий консервативный.
+DEFAULT_LIMITS: Dict[str, Tuple[float, int]] = {
+    "api.moysklad.ru": (15.0, 5),
+    "api-seller.ozon.ru": (20.0, 8),
+}
+
+
+class HostLimiter:
+    """
+    Token bucket + семафор на параллельность. Общий для всех потоков процесса.
+    """
+
+    def __init__(self, rate_per_s: float, max_concurrent: int, burst: Optional[float] = None):
+        self.rate = float(rate_per_s)
+        self.max_concurrent = int(max_concurrent)
+        self.burst = float(burst if burst is not None else max(1.0, rate_per_s))
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+        self._sem = threading.BoundedSemaphore(self.max_concurrent)
+
+    def _take_token(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        """Без ожидания: есть и токен, и свободный слот."""
+        if not self._sem.acquire(blocking=False):
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+        self._sem.release()
+        return False
+
+    def release(self) -> None:
+        self._sem.release()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self._sem.acquire()
+        try:
+            self._take_token()
+            yield
+        finally:
+            self._sem.release()
+
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[float, int]]:
+    """
+    RATE_LIMITS="api.moysklad.ru=15/5,api-seller.ozon.ru=20/8" (rps/параллельность)
+    """
+    out: Dict[str, Tuple[float, int]] = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        host, val = part.split("=", 1)
+        rate, _, conc = val.partition("/")
+        out[host.strip().lower()] = (float(rate), int(conc or 1))
+    return out
+
+
+_limits: Dict[str, Tuple[float, int]] = {**DEFAULT_LIMITS, **_parse_limits(os.getenv("RATE_LIMITS", ""))}
+_limiters: Dict[str, HostLimiter] = {}
+_reg_lock = threading.Lock()
+# доля лимитов аккаунта у этого процесса (несколько воркеров на одни ключи API)
+_share = 1.0
+
+
+def set_share(share: float) -> None:
+    """
+    Лимиты хостов этого процесса — доля share от общих: rps и параллельность
+    делятся (параллельность не меньше 1). Вызывать до первых запросов.
+    """
+    global _share
+    with _reg_lock:
+        _share = min(1.0, max(0.01, float(share)))
+        _limiters.clear()
+
+
+def limiter_for(url: str) -> Optional[HostLimiter]:
+    host = (urlparse(url).hostname or "").lower()
+    lim = _limiters.get(host)
+    if lim is not None:
+        return lim
+    cfg = _limits.get(host)
+    if cfg is None:
+        return None
+    with _reg_lock:
+        lim = _limiters.get(host)
+        if lim is None:
+            rate, conc = cfg
+            lim = _limiters[host] = HostLimiter(rate * _share, max(1, int(conc * _share)))
+    return lim
+
+
+@contextmanager
+def slot(url: str) -> Iterator[None]:
+    lim = limiter_for(url)
+    if lim is None:
+        yield
+        return
+    with lim.slot():
+        yield
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from . import ratelimit
+from .budget import Budget
+from .config import Config, ShardConfig
+from .log import log_json
+
+LEASE_FILE = "leases.sqlite3"
+
+CABINET = "cabinet"
+HASH = "hash"
+WINDOW = "window"
+
+
+def bucket(key: str, count: int) -> int:
+    """Стабильный между процессами и хостами (hash() строк — нет)."""
+    return zlib.crc32(key.encode("utf-8")) % count
+
+
+@dataclass(frozen=True)
+class Shard:
+    cabinet: str  # "" — все кабинеты
+    mode: str     # cabinet | hash | window
+    index: int = 0
+    count: int = 1
+
+    @property
+    def name(self) -> str:
+        return f"{self.cabinet or '*'}:{self.mode}:{self.index}/{self.count}"
+
+    def has_key(self, key: str) -> bool:
+        return self.mode != HASH or bucket(key, self.count) == self.index
+
+    def window(self, since: datetime, to: datetime) -> Tuple[datetime, datetime]:
+        """
+        Своя часть since..to. Границы — от начала диапазона с шагом по суткам конца,
+        чтобы у воркеров одного раунда (to отличается на секунды) они совпадали;
+        последняя часть открыта до to.
+        """
+        if self.mode != WINDOW:
+            return since, to
+        end = datetime.combine(to.date() + timedelta(days=1), datetime.min.time(), tzinfo=to.tzinfo)
+        step = (end - since) / self.count
+        a = since + step * self.index
+        b = to if self.index == self.count - 1 else min(to, since + step * (self.index + 1))
+        return a, max(a, b)
+
+
+class ShardSet:
+    """Шарды, взятые воркером в аренду: фильтры для прогона."""
+
+    def __init__(self, shards: Iterable[Shard]):
+        self.shards = tuple(shards)
+
+    @property
+    def tag(self) -> str:
+        """Короткий ключ набора — для checkpoint этого набора."""
+        return f"{zlib.crc32(','.join(sorted(s.name for s in self.shards)).encode()):08x}"
+
+    @property
+    def keyed(self) -> bool:
+        """Есть hash-шарды: ключи делятся между воркерами (иначе — только кабинеты/окна)."""
+        return any(s.mode == HASH for s in self.shards)
+
+    def cabinets(self, names: Iterable[str]) -> Set[str]:
+        names = list(names)
+        if any(not s.cabinet for s in self.shards):
+            return set(names)
+        return {s.cabinet for s in self.shards if s.cabinet in names}
+
+    def _of(self, cabinet: str) -> List[Shard]:
+        # cabinet "" — ключ без кабинета (stock sync): подходит любой свой шард
+        return [s for s in self.shards if not cabinet or s.cabinet in ("", cabinet)]
+
+    def has_key(self, key: str, cabinet: str = "") -> bool:
+        return any(s.has_key(key) for s in self._of(cabinet))
+
+    def windows(self, cabinet: str, since: datetime, to: datetime) -> List[Tuple[datetime, datetime]]:
+        own = self._of(cabinet)
+        if not own:
+            return []
+        if any(s.mode != WINDOW for s in own):
+            return [(since, to)]
+        return sorted(w for w in (s.window(since, to) for s in own) if w[0] < w[1])
+
+
+def plan_stock(cfg: Config) -> List[Shard]:
+    """
+    Шарды stock sync: по кабинетам (отправка и комплекты своих кабинетов) или
+    по hash(id товара/комплекта МС) — ключ известен до резолва артикулов, так что
+    воркер резолвит только свои. Окон времени у остатков нет — window считается как hash.
+    """
+    sh = cfg.shard
+    assert sh is not None
+    if sh.by == CABINET:
+        return [Shard(cab.name, CABINET) for cab in cfg.cabinets]
+    return [Shard("", HASH, i, sh.buckets) for i in range(sh.buckets)]
+
+
+def plan_orders(cfg: Config) -> List[Shard]:
+    """
+    Шарды sync_orders: кабинет целиком, hash(posting_number) или окно времени внутри
+    кабинета. Вперемешку по кабинетам — чтобы доля воркера не была одним кабинетом.
+    """
+    sh = cfg.shard
+    assert sh is not None
+    if sh.by == CABINET:
+        return [Shard(cab.name, CABINET) for cab in cfg.cabinets]
+    return [Shard(cab.name, sh.by, i, sh.buckets) for i in range(sh.buckets) for cab in cfg.cabinets]
+
+
+class LeaseStore:
+    """
+    Аренды шардов в общей SQLite (<SHARD_DIR>/leases.sqlite3). Журнал — DELETE,
+    не WAL: WAL не работает на сетевых ФС. Каждое решение — одна транзакция
+    BEGIN IMMEDIATE, так что два воркера не возьмут один шард.
+
+    Строка шарда: владелец и срок аренды, время последнего завершения (done_at).
+    Воркеры — строки "@<job>:<worker_id>" с той же арендой (сколько их живо).
+    """
+
+    def __init__(self, path: str, owner: str, lease_s: float):
+        self.owner = owner
+        self.lease_s = lease_s
+        self.held: Set[str] = set()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " name TEXT PRIMARY KEY, owner TEXT, expires REAL NOT NULL DEFAULT 0, done_at REAL NOT NULL DEFAULT 0)"
+        )
+
+    def _tx(self, fn: Callable[[sqlite3.Connection], object]) -> object:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return out
+
+    def _rows(self, db: sqlite3.Connection, names: Sequence[str]) -> Dict[str, Tuple[Optional[str], float, float]]:
+        rows = db.execute(
+            f"SELECT name, owner, expires, done_at FROM leases WHERE name IN ({','.join('?' * len(names))})",
+            tuple(names),
+        ).fetchall()
+        return {n: (o, e, d) for n, o, e, d in rows}
+
+    def join(self, job: str) -> None:
+        self.held.add(f"@{job}:{self.owner}")
+        self.renew()
+
+    def live(self, job: str) -> int:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM leases WHERE name LIKE ? AND expires > ?", (f"@{job}:%", time.time())
+            ).fetchone()
+        return int(row[0])
+
+    def claim(
+        self, names: Sequence[str], limit: int, round_s: float, exclude: Set[str] = frozenset(),
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Берёт до limit шардов: не сделанных в этом раунде, свободных или с истёкшей
+        арендой. Возвращает (взятые, из них перехваченные у другого воркера).
+        """
+        def fn(db: sqlite3.Connection) -> Tuple[List[str], List[str]]:
+            now = time.time()
+            rows = self._rows(db, names)
+            got: List[str] = []
+            taken: List[str] = []
+            for name in names:
+                if len(got) >= limit:
+                    break
+                if name in exclude:
+                    continue
+                owner, expires, done_at = rows.get(name, (None, 0.0, 0.0))
+                if done_at > now - round_s:
+                    continue
+                if owner and owner != self.owner and expires > now:
+                    continue
+                db.execute(
+                    "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)"
+                    " ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires",
+                    (name, self.owner, now + self.lease_s),
+                )
+                got.append(name)
+                if owner and owner != self.owner:
+                    taken.append(name)
+            return got, taken
+
+        got, taken = self._tx(fn)  # type: ignore[misc]
+        self.held.update(got)
+        return got, taken
+
+    def renew(self) -> List[str]:
+        """Продлевает все свои аренды; возвращает потерянные (их уже перехватили)."""
+        held = list(self.held)
+
+        def fn(db: sqlite3.Connection) -> List[str]:
+            exp = time.time() + self.lease_s
+            lost = []
+            for name in held:
+                cur = db.execute(
+                    "UPDATE leases SET expires = ? WHERE name = ? AND owner = ?", (exp, name, self.owner)
+                )
+                if cur.rowcount == 0:
+                    if name.startswith("@"):
+                        db.execute("INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)", (name, self.owner, exp))
+                    else:
+                        lost.append(name)
+            return lost
+
+        lost = self._tx(fn)  # type: ignore[assignment]
+        self.held.difference_update(lost)
+        return lost  # type: ignore[return-value]
+
+    def finish(self, names: Iterable[str], done: bool) -> None:
+        """Снимает аренду; done — шард сделан в этом раунде."""
+        names = [n for n in names if n in self.held]
+
+        def fn(db: sqlite3.Connection) -> None:
+            now = time.time()
+            for name in names:
+                if done:
+                    db.execute(
+                        "UPDATE leases SET owner = NULL, expires = 0, done_at = ? WHERE name = ? AND owner = ?",
+                        (now, name, self.owner),
+                    )
+                elif name.startswith("@"):
+                    db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+                else:
+                    db.execute("UPDATE leases SET owner = NULL, expires = 0 WHERE name = ? AND owner = ?", (name, self.owner))
+
+        self._tx(fn)
+        self.held.difference_update(names)
+
+    def wait_s(self, names: Sequence[str], round_s: float, exclude: Set[str] = frozenset()) -> Optional[float]:
+        """
+        Сколько ждать до истечения ближайшей чужой аренды несделанного шарда;
+        None — ждать нечего (всё сделано или осталось только exclude).
+        """
+        with self._lock:
+            rows = self._rows(self._db, names)
+        now = time.time()
+        waits = []
+        for name in names:
+            if name in exclude:
+                continue
+            owner, expires, done_at = rows.get(name, (None, 0.0, 0.0))
+            if done_at > now - round_s:
+                continue
+            waits.append(max(0.0, expires - now) if owner and owner != self.owner else 0.0)
+        return min(waits) if waits else None
+
+    @contextmanager
+    def keepalive(self) -> Iterator[None]:
+        """Фоновое продление аренд каждые lease_s/3."""
+        halt = threading.Event()
+
+        def loop() -> None:
+            while not halt.wait(self.lease_s / 3):
+                try:
+                    lost = self.renew()
+                except sqlite3.Error:
+                    continue
+                for name in lost:
+                    logging.getLogger("shard").warning("lease lost: %s", name)
+
+        t = threading.Thread(target=loop, name="lease", daemon=True)
+        t.start()
+        try:
+            yield
+        finally:
+            halt.set()
+            t.join()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def run_sharded(
+    sh: ShardConfig,
+    job: str,
+    plan: List[Shard],
+    fn: Callable[[ShardSet], Optional[int]],
+    logger: logging.Logger,
+    budget: Budget,
+) -> int:
+    """
+    Воркер: берёт свою долю шардов (поровну на max(SHARD_WORKERS, живых)), прогоняет
+    fn по ним, затем добирает несделанные — свободные и брошенные упавшими воркерами
+    (после истечения аренды) — пока они есть и не кончился бюджет времени.
+    Возвращает наибольший код fn.
+    """
+    os.makedirs(sh.dir, exist_ok=True)
+    store = LeaseStore(os.path.join(sh.dir, LEASE_FILE), sh.worker_id, sh.lease_s)
+    by_name = {s.name: s for s in plan}
+    names = list(by_name)
+    member = f"@{job}:{sh.worker_id}"
+    tried: Set[str] = set()
+    rc = 0
+    try:
+        store.join(job)
+        workers = max(sh.workers, store.live(job))
+        ratelimit.set_share(1.0 / workers)
+        log_json(logger, "shard_worker_started", job=job, worker=sh.worker_id, workers=workers, shards=len(plan), by=sh.by)
+        limit = max(1, math.ceil(len(plan) / workers))
+        with store.keepalive():
+            while True:
+                got, taken = store.claim(names, limit, sh.round_s, exclude=tried)
+                if got:
+                    tried.update(got)
+                    log_json(logger, "shards_claimed", job=job, worker=sh.worker_id, shards=got, taken_over=taken)
+                    code = None
+                    try:
+                        code = fn(ShardSet(by_name[n] for n in got)) or 0
+                        rc = max(rc, code)
+                    finally:
+                        # ненулевой код — шард не сделан: аренда снимается, его возьмёт другой воркер
+                        store.finish(got, done=code == 0)
+                    # дальше — по одному: остальное уже разобрали другие воркеры
+                    limit = 1
+                    continue
+                wait = store.wait_s(names, sh.round_s, exclude=tried)
+                if wait is None or budget.remaining() < wait:
+                    break
+                time.sleep(min(max(wait, 0.5), 5.0))
+    finally:
+        try:
+            store.finish([member], done=False)
+        finally:
+            store.close()
+    log_json(logger, "shard_worker_done", job=job, worker=sh.worker_id, shards=sorted(tried), code=rc)
+    return rc
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from . import cache, trace
+from .log import log_aggregate, log_json
+from .ozon_client import OzonClient
+
+# параллельных запросов items на кабинет; реальный темп режет ratelimit
+WORKERS = 8
+
+Items = List[Dict[str, float]]
+
+
+def _load_cache(cache_dir: str, cabinet: str) -> Dict[str, Items]:
+    key = cabinet.lower()
+    return cache.store(cache_dir, "supply_items").get(key) or {}
+
+
+def _save_cache(cache_dir: str, cabinet: str, orders: Dict[str, Items]) -> None:
+    cache.store(cache_dir, "supply_items").put(cabinet.lower(), orders)
+
+
+def _transit_key(cabinet: str, states: Sequence[str]) -> str:
+    return f"{cabinet.lower()}:{','.join(sorted(states))}"
+
+
+def in_transit(
+    oz: OzonClient,
+    cabinet: str,
+    states: Sequence[str],
+    cache_dir: str,
+    logger: logging.Logger,
+    max_age_s: Optional[float] = None,
+) -> Dict[str, float]:
+    """
+    offer_id -> количество в FBO-поставках в состояниях `states`.
+
+    Состав поставки в заданном состоянии не меняется, поэтому кэш по ключу
+    "<order_id>:<state>" бессрочный; в кэше остаются только поставки, активные
+    в этом прогоне. Items для новых поставок грузятся параллельно, пока
+    список поставок ещё дочитывается постранично.
+
+    max_age_s — можно взять итог прошлого полного подсчёта, если он не старше
+    (точечные отправки: список поставок ради пары SKU не листаем).
+    """
+    totals = cache.store(cache_dir, "supply_in_transit")
+    tkey = _transit_key(cabinet, states)
+    if max_age_s is not None:
+        try:
+            prev = totals.get(tkey)
+        except Exception:
+            prev = None
+        if prev is not None and time.time() - float(prev.get("ts") or 0) <= max_age_s:
+            return {str(k): float(v) for k, v in (prev.get("offers") or {}).items()}
+    try:
+        cached = _load_cache(cache_dir, cabinet)
+    except Exception as e:
+        cached = {}
+        log_json(logger, "supply_cache_read_failed", cabinet=cabinet, error=str(e))
+    fresh: Dict[str, Items] = {}
+    pending: List[Tuple[str, Future]] = []
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="supply") as pool:
+        # список по каждому состоянию отдельно: так состояние поставки известно без /get
+        for state in states:
+            for ids in oz.iter_supply_order_ids([state]):
+                for oid in ids:
+                    key = f"{oid}:{state}"
+                    if key in fresh:
+                        continue
+                    if key in cached:
+                        fresh[key] = cached[key]
+                    else:
+                        fresh[key] = []
+                        pending.append((key, pool.submit(trace.bind(oz.get_supply_order_items), oid)))
+
+        for key, fut in pending:
+            try:
+                fresh[key] = fut.result()
+            except Exception as e:
+                # без кэша: в следующем прогоне попробуем снова
+                del fresh[key]
+                failed += 1
+                log_aggregate("supply_items_failed", group_by=("cabinet",), cabinet=cabinet, order=key, error=str(e))
+
+    try:
+        _save_cache(cache_dir, cabinet, fresh)
+    except Exception as e:
+        log_json(logger, "supply_cache_write_failed", cabinet=cabinet, error=str(e))
+
+    out: Dict[str, float] = {}
+    for items in fresh.values():
+        for it in items:
+            out[it["offer_id"]] = out.get(it["offer_id"], 0.0) + float(it["quantity"])
+
+    if not failed:
+        # неполный итог (часть items не загрузилась) для повторного использования не годится
+        try:
+            totals.put(tkey, {"ts": time.time(), "offers": out})
+        except Exception as e:
+            log_json(logger, "supply_cache_write_failed", cabinet=cabinet, error=str(e))
+
+    log_json(
+        logger, "supply_in_transit_loaded",
+        cabinet=cabinet, orders=len(fresh), fetched=len(pending) - failed,
+        failed=failed, offers=len(out), quantity=sum(out.values()),
+    )
+    return out
+
+
+def subtract_in_transit(payload: List[Dict[str, object]], transit: Dict[str, float]) -> int:
+    """
+    Вычитает товар в пути на FBO из остатков payload (на месте, не ниже нуля).
+    Если offer есть на нескольких складах — количество в пути вычитается один раз:
+    по складам в порядке payload, пока не кончится. Возвращает число изменённых позиций.
+    """
+    left = {k: int(v) for k, v in transit.items() if v}
+    changed = 0
+    for row in payload:
+        oid = str(row["offer_id"])
+        qty = left.get(oid)
+        if not qty:
+            continue
+        stock = int(row["stock"])
+        take = min(qty, stock)
+        row["stock"] = stock - take
+        left[oid] = qty - take
+        changed += 1
+    return changed
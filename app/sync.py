@@ -1,142 +1,443 @@
 from __future__ import annotations
 
+import argparse
 import os
 import logging
-from typing import Dict, Any, List
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, Any, List, Optional, Sequence, Set, Tuple
 
-from .config import load_config
-from .log import setup_logging, log_json
+from . import batching, ledger, metrics, profiling, shard, trace
+from .assortment_index import bundle_entry, fresh_articles, href_id, save_index
+from .budget import Budget, Checkpoint
+from .breaker import CircuitOpenError
+from .cabinets import ozon_clients, run_per_cabinet
+from .config import CabinetConfig, Config, load_config
+from .log import flush_aggregates, log_aggregate, log_debug_json, log_json, setup_logging
 from .moysklad_client import MoySkladClient
-from .ozon_client import OzonClient, OzonCreds
+from .ozon_client import OzonClient
+from .push import accepted, load_snapshot, prioritized_batches, row_key, save_snapshot
+from .shard import ShardSet
 from .stock_calc import availability_by_href, compute_bundle_stock
+from .supply import in_transit, subtract_in_transit
+
+METRICS_JOB = "stock_sync"
+
+# при лимите времени комплекты считаем, пока на отправку остаётся хотя бы эта доля бюджета
+PUSH_RESERVE_SHARE = 0.25
+# недоотправленное старше часа уже неактуально
+CHECKPOINT_MAX_AGE_S = 3600
+# шарды по кабинетам: артикулы из индекса, если полный резолв был не раньше часа назад
+SHARD_ARTICLES_MAX_AGE_S = 3600
 
 def chunked(seq: List[Dict[str, Any]], n: int):
     for i in range(0, len(seq), n):
         yield seq[i:i+n]
 
-def main() -> int:
+def stocks_rejected(resp: Any) -> List[Dict[str, Any]]:
+    """
+    Позиции, которые Ozon не принял, из ответа /v2/products/stocks.
+    """
+    out: List[Dict[str, Any]] = []
+    rows = (resp or {}).get("result") if isinstance(resp, dict) else None
+    for r in rows or []:
+        if r.get("updated") and not r.get("errors"):
+            continue
+        out.append({
+            "offer_id": r.get("offer_id"),
+            "warehouse_id": r.get("warehouse_id"),
+            "errors": [e.get("code") or e.get("message") for e in (r.get("errors") or [])],
+        })
+    return out
+
+# Нормализация "похожих" кириллических букв -> латиница
+_CONFUSABLES = str.maketrans({
+    "А":"A","В":"B","Е":"E","К":"K","М":"M","Н":"H","О":"O","Р":"P","С":"C","Т":"T","Х":"X","У":"Y",
+    "а":"a","в":"b","е":"e","к":"k","м":"m","н":"h","о":"o","р":"p","с":"c","т":"t","х":"x","у":"y",
+})
+
+def norm_offer_id(s: str) -> str:
+    return (s or "").strip().translate(_CONFUSABLES)
+
+def route_items(
+    items: List[Dict[str, Any]],
+    cabinets: Sequence[CabinetConfig],
+    ids_by_cab: Dict[str, Set[str]],
+    logger: logging.Logger,
+) -> Tuple[Dict[str, List[Dict[str, Any]]], int]:
+    """
+    Раскладывает позиции МС по кабинетам: offer_id уходит в первый (по конфигу)
+    кабинет, где он есть, — на каждый склад кабинета с остатком своего набора складов МС
+    (it["stocks"]: ключ набора -> остаток). Возвращает (cabinet -> payload, число ненайденных).
+    """
+    payloads: Dict[str, List[Dict[str, Any]]] = {cab.name: [] for cab in cabinets}
+    missing = 0
+
+    # Мапы: нормализованный offer_id -> реальный offer_id Ozon (в порядке кабинетов из конфига)
+    norm_by_cab = [(cab, {norm_offer_id(x): x for x in ids_by_cab.get(cab.name) or ()}) for cab in cabinets]
+
+    for it in items:
+        ms_oid = it["offer_id"]
+        key = norm_offer_id(ms_oid)
+
+        for cab, mapping in norm_by_cab:
+            real = mapping.get(key)
+            if real:
+                stocks = it["stocks"]
+                payloads[cab.name].extend(
+                    {"offer_id": real, "warehouse_id": wh.warehouse_id, "stock": int(stocks.get(wh.key, 0))}
+                    for wh in cab.warehouses
+                )
+                break
+        else:
+            missing += 1
+            log_aggregate("not_in_ozon", group_by=("kind",), offer_id=ms_oid, kind=it.get("kind"))
+
+    return payloads, missing
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(prog="python -m app.sync", description="Остатки МС -> Ozon")
+    ap.add_argument("--profile", action="store_true", help="профиль прогона (как SYNC_PROFILE=1)")
+    sub = ap.add_subparsers(dest="cmd")
+    p = sub.add_parser("offers", help="только указанные товары и их комплекты")
+    p.add_argument("offer_ids", nargs="*", help="offer_id (артикул МС)")
+    p.add_argument("--id", dest="assortment_ids", action="append", default=[], help="id ассортимента МС")
+    p.add_argument("--profile", action="store_true", default=argparse.SUPPRESS, help=argparse.SUPPRESS)
+    a = ap.parse_args(argv)
+    if a.cmd == "offers" and not (a.offer_ids or a.assortment_ids):
+        ap.error("offers: нужен хотя бы один offer_id или --id")
+    return a
+
+def main(argv: Optional[List[str]] = None) -> int:
+    a = parse_args(argv)
     cfg = load_config()
     setup_logging(cfg.log_level)
     logger = logging.getLogger("sync")
     os.makedirs(cfg.cache_dir, exist_ok=True)
+    # частичный прогон — свои метрики/трейс, чтобы не затирать итоги полного
+    job = METRICS_JOB if a.cmd is None else f"{METRICS_JOB}_partial"
+    if cfg.metrics_port:
+        metrics.serve(cfg.metrics_port, job)
+
+    batching.restore(cfg.cache_dir)
+    budget = Budget(cfg.run_budget_s)
+    prof = profiling.session(cfg.cache_dir, job, logger, a.profile)
+    root = trace.span(job)
+    try:
+        with prof or nullcontext(), root:
+            if a.cmd == "offers":
+                # targeted импортирует этот модуль
+                from .targeted import sync_offers
+                res = sync_offers(cfg, logger, a.offer_ids, a.assortment_ids)
+                return 1 if res.get("errors") else 0
+            if cfg.shard is not None:
+                return shard.run_sharded(
+                    cfg.shard, job, shard.plan_stock(cfg),
+                    lambda owned: run(cfg, logger, budget, owned), logger, budget,
+                )
+            return run(cfg, logger, budget)
+    except CircuitOpenError as e:
+        # API лежит: выходим сразу, а не висим в ретраях до следующего таймера
+        log_json(logger, "sync_aborted", reason="circuit_open", host=e.host, endpoint_class=e.endpoint_class)
+        return 4
+    finally:
+        if budget.limited:
+            log_json(logger, "run_budget", **budget.summary())
+        flush_aggregates(logger)
+        trace.report(logger, root, cfg.cache_dir, job)
+        metrics.report_run(logger, cfg.cache_dir, job)
+        ledger.report(logger, cfg.cache_dir, job)
+        batching.report(logger, cfg.cache_dir, job)
 
+def run(
+    cfg: Config,
+    logger: logging.Logger,
+    budget: Budget | None = None,
+    shards: ShardSet | None = None,
+) -> int:
+    """
+    shards — шарды этого воркера (SHARD_DIR): считаются и отправляются только
+    позиции своих hash-корзин (по id МС, артикулы резолвятся только для них) и
+    кабинетов (артикулы — из индекса, пока он свежий); отчёт МС и offer_id
+    грузятся целиком.
+    """
+    budget = budget or Budget(0)
+    t_run = budget.started
     ms = MoySkladClient(cfg.moysklad_token)
+    clients = ozon_clients(cfg)
+    store_sets = cfg.store_sets()
+    own = shards.cabinets(cab.name for cab, _ in clients) if shards is not None else {cab.name for cab, _ in clients}
+    own_clients = [(cab, oz) for cab, oz in clients if cab.name in own]
 
-    oz1 = OzonClient(OzonCreds("OZON1", cfg.ozon1_client_id, cfg.ozon1_api_key, cfg.ozon1_warehouse_id), cfg.cache_dir)
-    oz2 = OzonClient(OzonCreds("OZON2", cfg.ozon2_client_id, cfg.ozon2_api_key, cfg.ozon2_warehouse_id), cfg.cache_dir)
+    # что не успели в прошлый раз: позиция в списке комплектов и неотправленные offer_id
+    checkpoint = Checkpoint(cfg.cache_dir, METRICS_JOB if shards is None else f"{METRICS_JOB}@{shards.tag}")
+    resume = checkpoint.load(max_age_s=CHECKPOINT_MAX_AGE_S)
+    if resume:
+        log_json(
+            logger, "checkpoint_loaded",
+            bundle_cursor=resume.get("bundle_cursor"),
+            pending_push={k: len(v) for k, v in (resume.get("pending_push") or {}).items()},
+        )
+    bundle_cursor: str | None = None
+    pending_push: Dict[str, List[str]] = {}
 
-    # 1) Загружаем offer_id из Ozon (для маршрутизации) — отдельно по кабинетам
-    oz1_ids = set()
-    oz2_ids = set()
+    def load_report() -> Dict[str, Any]:
+        with trace.span("stock_report"), ledger.stage("stock_report"):
+            return ms.get_stock_bystore()
 
-    try:
-        oz1_ids = oz1.list_offer_ids()
-        log_json(logger, "ozon_offer_ids_loaded", cabinet="OZON1", count=len(oz1_ids))
-    except Exception as e:
-        log_json(logger, "ozon_offer_ids_failed", cabinet="OZON1", error=str(e))
+    def load_offer_ids(cab: CabinetConfig, oz: OzonClient) -> Set[str]:
+        with trace.span(f"offer_ids[{cab.name}]") as sp, ledger.stage("offer_ids"):
+            ids = oz.list_offer_ids()
+            sp.add_items(len(ids))
+            return ids
 
-    try:
-        oz2_ids = oz2.list_offer_ids()
-        log_json(logger, "ozon_offer_ids_loaded", cabinet="OZON2", count=len(oz2_ids))
-    except Exception as e:
-        log_json(logger, "ozon_offer_ids_failed", cabinet="OZON2", error=str(e))
+    def load_transit(cab: CabinetConfig, oz: OzonClient) -> Dict[str, float]:
+        with trace.span(f"supplies[{cab.name}]") as sp, ledger.stage("supplies"):
+            transit = in_transit(oz, cab.name, cfg.supply_states, cfg.cache_dir, logger)
+            sp.add_items(len(transit))
+            return transit
 
-    if not oz1_ids and not oz2_ids:
-        # оба кабинета недоступны — продолжать бессмысленно
-        return 2
+    def load_supplies() -> Dict[str, Tuple[Dict[str, float] | None, Exception | None]]:
+        with trace.span("supplies"):
+            return run_per_cabinet(load_transit, own_clients)
 
-    # 2) Остатки МойСклад по складу
-    try:
-        report = ms.get_stock_bystore()
-        rows = ms.extract_store_rows(report, cfg.moysklad_store_id)
-        log_json(logger, "moysklad_stock_loaded", rows=len(rows))
-    except Exception as e:
-        log_json(logger, "moysklad_stock_failed", error=str(e))
-        return 3
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="bg") as pool:
+        # отчёт МС общий для всех кабинетов — грузим его параллельно с offer_id
+        report_fut = pool.submit(trace.bind(load_report))
+        # товар в пути на FBO — тоже в фоне, нужен только к маршрутизации
+        supplies_fut = pool.submit(trace.bind(load_supplies)) if cfg.supply_states else None
 
-    avail_by_href = availability_by_href(rows)
+        # 1) Загружаем offer_id из Ozon (для маршрутизации) — параллельно по кабинетам
+        with trace.span("offer_ids"):
+            loaded = run_per_cabinet(load_offer_ids, clients)
+        ids_by_cab: Dict[str, Set[str]] = {}
+        for cab, _ in clients:
+            ids, err = loaded[cab.name]
+            if err is not None:
+                ids_by_cab[cab.name] = set()
+                log_json(logger, "ozon_offer_ids_failed", cabinet=cab.name, error=str(err))
+            else:
+                ids_by_cab[cab.name] = ids or set()
+                log_json(logger, "ozon_offer_ids_loaded", cabinet=cab.name, count=len(ids_by_cab[cab.name]))
 
-    # 3) Резолвим offer_id (article) по meta.href через карточки товаров
-    hrefs = [r.href for r in rows]
-    href_to_article = ms.resolve_articles_by_hrefs(hrefs)
+        if not any(ids_by_cab.values()):
+            # все кабинеты недоступны — продолжать бессмысленно
+            report_fut.cancel()
+            if supplies_fut is not None:
+                supplies_fut.cancel()
+            return 2
 
-    items: List[Dict[str, Any]] = []
-    for r in rows:
-        art = (href_to_article.get(r.href) or "").strip()
-        if not art:
-            # если у товара нет артикула — просто пропускаем (можно логировать отдельно)
-            continue
-        items.append({"offer_id": art, "stock": int(r.available), "kind": "product"})
+        # 2) Остатки МойСклад — один проход по отчёту для всех наборов складов
+        try:
+            with trace.span("stock_report_wait") as sp:
+                report = report_fut.result()
+                rows_by_set = ms.extract_store_sets(report, store_sets)
+                sp.add_items(sum(len(v) for v in rows_by_set.values()))
+            log_json(
+                logger, "moysklad_stock_loaded",
+                rows={k: len(v) for k, v in rows_by_set.items()} if len(rows_by_set) > 1
+                else sum(len(v) for v in rows_by_set.values()),
+            )
+        except Exception as e:
+            log_json(logger, "moysklad_stock_failed", error=str(e))
+            return 3
 
-    # 4) Комплекты (bundle)
-    try:
-        bundles = ms.get_all_bundles_basic()
-        log_json(logger, "moysklad_bundles_loaded", bundles=len(bundles))
-        for b in bundles:
-            bid = b.get("id")
-            article = (b.get("article") or "").strip()
-            if not bid or not article:
-                continue
-            # вычисляем только если есть в каком-то кабинете
-            if (article not in oz1_ids) and (article not in oz2_ids):
-                continue
-            full = ms.get_bundle(str(bid))
-            stock_val = compute_bundle_stock(full, avail_by_href)
-            items.append({"offer_id": article, "stock": int(stock_val), "kind": "bundle"})
-    except Exception as e:
-        log_json(logger, "moysklad_bundles_failed", error=str(e))
+        transit_by_cab: Dict[str, Dict[str, float]] = {}
+        if supplies_fut is not None:
+            with trace.span("supplies_wait"):
+                for name, (transit, err) in supplies_fut.result().items():
+                    if err is not None:
+                        # без данных о поставках отправляем остатки как есть
+                        log_json(logger, "supply_in_transit_failed", cabinet=name, error=str(err))
+                    else:
+                        transit_by_cab[name] = transit or {}
 
-        # 5) Маршрутизация по кабинетам
-    oz1_payload: List[Dict[str, Any]] = []
-    oz2_payload: List[Dict[str, Any]] = []
-    missing = 0
+    avail_by_set = {k: availability_by_href(rows) for k, rows in rows_by_set.items()}
+    # href -> {набор складов -> свободный остаток}
+    stocks_by_href: Dict[str, Dict[str, int]] = {}
+    for k, rows in rows_by_set.items():
+        for r in rows:
+            stocks_by_href.setdefault(r.href, {})[k] = int(r.available)
 
-    # Нормализация "похожих" кириллических букв -> латиница
-    conf = str.maketrans({
-        "А":"A","В":"B","Е":"E","К":"K","М":"M","Н":"H","О":"O","Р":"P","С":"C","Т":"T","Х":"X","У":"Y",
-        "а":"a","в":"b","е":"e","к":"k","м":"m","н":"h","о":"o","р":"p","с":"c","т":"t","х":"x","у":"y",
-    })
+    # offer_id уходит в первый кабинет, где он есть (как в route_items); с шардами —
+    # только свои: hash-корзина (по id МС) и кабинет. Ненайденные нигде считает первый кабинет.
+    norm_by_cab = [(cab.name, {norm_offer_id(x) for x in ids_by_cab.get(cab.name) or ()}) for cab, _ in clients]
 
-    def norm(s: str) -> str:
-        return (s or "").strip().translate(conf)
+    def wanted(ms_id: str, article: str) -> bool:
+        if shards is None:
+            return True
+        if not shards.has_key(ms_id):
+            return False
+        key = norm_offer_id(article)
+        return next((name for name, norms in norm_by_cab if key in norms), clients[0][0].name) in own
 
-    # Мапы: нормализованный offer_id -> реальный offer_id Ozon
-    oz1_norm = {norm(x): x for x in oz1_ids}
-    oz2_norm = {norm(x): x for x in oz2_ids}
+    # 3) Резолвим offer_id (article) по meta.href через карточки товаров; с шардами —
+    #    только свои hash-корзины, а при шардах по кабинетам известные артикулы берём
+    #    из индекса (его пишет воркер, резолвивший целиком) — иначе каждый воркер
+    #    повторял бы самый тяжёлый этап МС со своей долей лимита
+    hrefs = list(stocks_by_href)
+    known: Dict[str, str] = {}
+    if shards is not None:
+        if shards.keyed:
+            hrefs = [h for h in hrefs if shards.has_key(href_id(h))]
+        else:
+            known = fresh_articles(cfg.cache_dir, SHARD_ARTICLES_MAX_AGE_S)
+    with trace.span("resolve_articles") as sp, ledger.stage("resolve_articles"):
+        href_to_article = {h: known[href_id(h)] for h in hrefs if href_id(h) in known}
+        unknown = [h for h in hrefs if href_id(h) not in known]
+        href_to_article.update(ms.resolve_articles_by_hrefs(unknown))
+        partial_index = shards is not None and (shards.keyed or len(unknown) < len(hrefs))
 
-    for it in items:
-        ms_oid = it["offer_id"]
-        key = norm(ms_oid)
+        items: List[Dict[str, Any]] = []
+        for href in hrefs:
+            stocks = stocks_by_href[href]
+            art = (href_to_article.get(href) or "").strip()
+            if not art:
+                # если у товара нет артикула — просто пропускаем (можно логировать отдельно)
+                continue
+            if not wanted(href_id(href), art):
+                continue
+            items.append({"offer_id": art, "stocks": stocks, "kind": "product"})
+        sp.add_items(len(items))
 
-        real1 = oz1_norm.get(key)
-        real2 = oz2_norm.get(key)
+    # 4) Комплекты (bundle)
+    bundle_idx: Dict[str, Dict[str, Any]] = {}
+    with trace.span("bundles") as sp, ledger.stage("bundles"):
+        try:
+            with trace.span("list"):
+                bundles = ms.get_all_bundles_basic()
+            log_json(logger, "moysklad_bundles_loaded", bundles=len(bundles))
+            # продолжаем с комплекта, на котором прошлый прогон упёрся в лимит времени
+            start = next((i for i, b in enumerate(bundles) if b.get("id") == resume.get("bundle_cursor")), 0)
+            bundles = bundles[start:] + bundles[:start]
+            push_reserve = budget.seconds * PUSH_RESERVE_SHARE
+            for bi, b in enumerate(bundles):
+                bid = b.get("id")
+                article = (b.get("article") or "").strip()
+                if not bid or not article:
+                    continue
+                if budget.expired(push_reserve, "bundles"):
+                    bundle_cursor = str(bid)
+                    log_json(logger, "bundles_budget_exhausted", done=bi, left=len(bundles) - bi)
+                    break
+                # вычисляем только если есть в каком-то кабинете
+                if not any(article in ids for ids in ids_by_cab.values()) or not wanted(str(bid), article):
+                    continue
+                with trace.span("details"):
+                    full = ms.get_bundle(str(bid))
+                bundle_idx[str(bid)] = bundle_entry(full, article)
+                stocks = {k: int(compute_bundle_stock(full, avail)) for k, avail in avail_by_set.items()}
+                items.append({"offer_id": article, "stocks": stocks, "kind": "bundle"})
+                sp.add_items(1)
+        except Exception as e:
+            log_json(logger, "moysklad_bundles_failed", error=str(e))
 
-        if real1:
-            oz1_payload.append({"offer_id": real1, "stock": it["stock"]})
-        elif real2:
-            oz2_payload.append({"offer_id": real2, "stock": it["stock"]})
-        else:
-            missing += 1
-            log_json(logger, "not_in_ozon", offer_id=ms_oid, kind=it.get("kind"))
+    # индекс для точечного пересчёта после sync_orders (app/targeted.py)
+    try:
+        save_index(cfg.cache_dir, {href_id(h): a for h, a in href_to_article.items() if a}, bundle_idx, partial=partial_index)
+    except Exception as e:
+        log_json(logger, "assortment_index_write_failed", error=str(e))
 
-    log_json(logger, "routing_done", ozon1=len(oz1_payload), ozon2=len(oz2_payload), missing=missing)
+    # 5) Маршрутизация по кабинетам
+    with trace.span("routing") as sp:
+        payloads, missing = route_items(items, [cab for cab, _ in clients], ids_by_cab, logger)
+        reduced = {name: subtract_in_transit(payloads[name], t) for name, t in transit_by_cab.items()}
+        sp.add_items(len(items))
+    log_json(
+        logger, "routing_done",
+        cabinets={k: len(v) for k, v in payloads.items()}, missing=missing,
+        **({"in_transit_reduced": reduced} if reduced else {}),
+    )
 
 
-    # 6) Отправка остатков батчами
-    def push(client: OzonClient, payload: List[Dict[str, Any]], name: str):
+    # 6) Отправка остатков батчами — параллельно по кабинетам;
+    #    сначала обнулившиеся и сильно упавшие, потом остальное
+    def push(cab: CabinetConfig, client: OzonClient):
+        payload = payloads[cab.name]
         if not payload:
             return
-        for part in chunked(payload, 100):
+        prev = load_snapshot(cfg.cache_dir, cab.name)
+        first = set((resume.get("pending_push") or {}).get(cab.name) or ())
+        batches = prioritized_batches(payload, prev, batching.size("ozon.stocks"), first)
+        t_push = time.monotonic()
+        # класс -> [offers, batches, failed]
+        progress: Dict[str, List[int]] = {}
+        left_in_cls = Counter(c for c, _ in batches)
+
+        with trace.span(f"push[{cab.name}]") as sp, ledger.stage("push"):
             try:
-                resp = client.set_stocks(part)
-                log_json(logger, "ozon_stocks_sent", cabinet=name, count=len(part), response=resp)
-            except Exception as e:
-                log_json(logger, "ozon_stocks_failed", cabinet=name, count=len(part), error=str(e))
+                for i, (cls, part) in enumerate(batches):
+                    if budget.expired(0, "push"):
+                        pending_push[cab.name] = [row_key(r) for _, x in batches[i:] for r in x]
+                        log_json(logger, "push_budget_exhausted", cabinet=cab.name, priority=cls, left=len(pending_push[cab.name]))
+                        break
+                    st = progress.setdefault(cls, [0, 0, 0])
+                    try:
+                        resp = client.set_stocks(part)
+                        log_debug_json(logger, "ozon_stocks_response", cabinet=cab.name, response=resp)
+                        rejected = stocks_rejected(resp)
+                        for r in rejected:
+                            log_aggregate("ozon_stock_rejected", group_by=("cabinet",), cabinet=cab.name, **r)
+                        for row in accepted(part, rejected):
+                            prev[row_key(row)] = int(row["stock"])
+                        log_aggregate(
+                            "ozon_stocks_sent",
+                            group_by=("cabinet", "priority"),
+                            sums={"offers": len(part), "rejected": len(rejected)},
+                            cabinet=cab.name,
+                            priority=cls,
+                            count=len(part),
+                        )
+                    except CircuitOpenError as e:
+                        # Ozon не принимает запись — остальные батчи кабинета не шлём
+                        left = sum(len(x) for _, x in batches[i:])
+                        log_json(logger, "ozon_stocks_aborted", cabinet=cab.name, priority=cls, count=left, error=str(e))
+                        break
+                    except Exception as e:
+                        st[2] += len(part)
+                        log_json(logger, "ozon_stocks_failed", cabinet=cab.name, priority=cls, count=len(part), error=str(e))
+                    st[0] += len(part)
+                    st[1] += 1
+                    sp.add_items(len(part))
+                    left_in_cls[cls] -= 1
+                    if left_in_cls[cls] == 0:
+                        now = time.monotonic()
+                        log_json(
+                            logger, "ozon_push_class_done",
+                            cabinet=cab.name, priority=cls, offers=st[0], batches=st[1], failed=st[2],
+                            push_s=round(now - t_push, 3), since_start_s=round(now - t_run, 3),
+                        )
+            finally:
+                try:
+                    save_snapshot(cfg.cache_dir, cab.name, prev)
+                except Exception as e:
+                    log_json(logger, "push_snapshot_write_failed", cabinet=cab.name, error=str(e))
+
+    with trace.span("push"):
+        pushed = run_per_cabinet(push, own_clients)
+    rc = 0
+    for name, (_, err) in pushed.items():
+        if err is not None:
+            # отправка кабинета упала целиком (не отдельный батч) — прогон неуспешный
+            log_json(logger, "cabinet_failed", cabinet=name, error=str(err))
+            rc = 5
 
-    push(oz1, oz1_payload, "OZON1")
-    push(oz2, oz2_payload, "OZON2")
+    state: Dict[str, Any] = {}
+    if bundle_cursor:
+        state["bundle_cursor"] = bundle_cursor
+    if pending_push:
+        state["pending_push"] = pending_push
+    try:
+        if state:
+            checkpoint.save(state)
+        else:
+            checkpoint.clear()
+    except Exception as e:
+        log_json(logger, "checkpoint_write_failed", error=str(e))
 
-    return 0
+    return rc
 
 if __name__ == "__main__":
     raise SystemExit(main())
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import logging
+import math
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import batching, ledger, trace
+from .assortment_index import bundle_entry, href_id, load_index
+from .cabinets import ozon_clients, run_per_cabinet
+from .config import CabinetConfig, Config
+from .log import log_aggregate, log_json
+from .moysklad_client import MS_BASE, MoySkladClient
+from .orders_sync.assortment import AssortmentResolver
+from .ozon_client import OzonClient
+from .push import accepted, load_snapshot, row_key, save_snapshot
+from .supply import in_transit, subtract_in_transit
+from .sync import chunked, norm_offer_id, route_items, stocks_rejected
+
+# товар в пути для точечной отправки — из итога последнего полного подсчёта, если он
+# не старше (полный список поставок ради нескольких SKU не листаем)
+TRANSIT_MAX_AGE_S = 30 * 60
+
+def free_by_set(
+    free_by_store: Dict[str, Dict[str, float]],
+    store_sets: Dict[str, Tuple[str, ...]],
+) -> Dict[str, Dict[str, float]]:
+    """Свободный остаток по наборам складов: сумма по складам набора."""
+    out: Dict[str, Dict[str, float]] = {}
+    for key, stores in store_sets.items():
+        acc: Dict[str, float] = {}
+        for sid in stores:
+            for aid, qty in (free_by_store.get(sid) or {}).items():
+                acc[aid] = acc.get(aid, 0.0) + qty
+        out[key] = acc
+    return out
+
+
+def affected_items(
+    touched: Iterable[str],
+    index: Dict[str, Any],
+    free: Dict[str, Dict[str, float]],
+) -> List[Dict[str, Any]]:
+    """
+    Позиции для отправки: затронутые товары и все комплекты, где они входят в состав.
+    free — свободный остаток по наборам складов (ключ набора -> id -> остаток);
+    должен покрывать компоненты этих комплектов.
+    """
+    articles: Dict[str, str] = index.get("articles") or {}
+    bundles: Dict[str, Dict[str, Any]] = index.get("bundles") or {}
+    ids = set(touched)
+
+    items: List[Dict[str, Any]] = []
+    for pid in sorted(ids):
+        art = articles.get(pid)
+        if art:
+            stocks = {k: int(f.get(pid, 0.0)) for k, f in free.items()}
+            items.append({"offer_id": art, "stocks": stocks, "kind": "product"})
+
+    for b in bundles.values():
+        comps = b.get("components") or []
+        if not any(cid in ids for cid, _ in comps):
+            continue
+        stocks = {}
+        for k, f in free.items():
+            mins = [f.get(cid, 0.0) / qty for cid, qty in comps if qty > 0]
+            stocks[k] = int(max(0, math.floor(min(mins)))) if mins else 0
+        items.append({"offer_id": b["article"], "stocks": stocks, "kind": "bundle"})
+    return items
+
+
+def needed_ids(touched: Iterable[str], index: Dict[str, Any]) -> Tuple[Set[str], Set[str]]:
+    """
+    (затронутые товары с учётом состава затронутых комплектов, все id для запроса остатков)
+    """
+    bundles: Dict[str, Dict[str, Any]] = index.get("bundles") or {}
+    ids: Set[str] = set()
+    for x in touched:
+        if x in bundles:
+            # комплект в заказе резервирует компоненты
+            ids.update(cid for cid, _ in bundles[x].get("components") or [])
+        else:
+            ids.add(x)
+    fetch = set(ids)
+    for b in bundles.values():
+        comps = b.get("components") or []
+        if any(cid in ids for cid, _ in comps):
+            fetch.update(cid for cid, _ in comps)
+    return ids, fetch
+
+
+def recompute_and_push(
+    cfg: Config,
+    ms: MoySkladClient,
+    clients: List[Tuple[CabinetConfig, OzonClient]],
+    touched: Iterable[str],
+    logger: logging.Logger,
+    index: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Сразу после sync_orders: свободный остаток затронутых товаров и их комплектов
+    из /report/stock/bystore/current -> set_stocks только по ним, не дожидаясь полного прогона.
+    index — индекс ассортимента, если уже загружен (по умолчанию — из кэша).
+    """
+    touched = {x for x in touched if x}
+    if not touched:
+        return {}
+    if index is None:
+        index = load_index(cfg.cache_dir)
+    if not index:
+        log_json(logger, "targeted_push_skipped", reason="no_index", touched=len(touched))
+        return {}
+
+    with trace.span("targeted_push") as sp, ledger.stage("targeted_push"):
+        ids, fetch = needed_ids(touched, index)
+        store_sets = cfg.store_sets()
+        with trace.span("stock_current"):
+            free_by_store = ms.get_free_stock_current(
+                sorted(fetch), {sid for stores in store_sets.values() for sid in stores}
+            )
+        items = affected_items(ids, index, free_by_set(free_by_store, store_sets))
+        sp.add_items(len(items))
+
+        # и исходный артикул МС, и нормализованный: route_items сравнивает нормализованные
+        candidates = {x for it in items for x in (it["offer_id"], norm_offer_id(it["offer_id"]))}
+        ids_by_cab = {cab.name: oz.offer_ids_for(candidates) for cab, oz in clients}
+        payloads, missing = route_items(items, [cab for cab, _ in clients], ids_by_cab, logger)
+
+        def push(cab: CabinetConfig, oz: OzonClient) -> int:
+            payload = payloads[cab.name]
+            if not payload:
+                return 0
+            if cfg.supply_states:
+                transit = in_transit(
+                    oz, cab.name, cfg.supply_states, cfg.cache_dir, logger, max_age_s=TRANSIT_MAX_AGE_S,
+                )
+                subtract_in_transit(payload, transit)
+            prev = load_snapshot(cfg.cache_dir, cab.name)
+            sent = 0
+            try:
+                for part in chunked(payload, batching.size("ozon.stocks")):
+                    resp = oz.set_stocks(part)
+                    for row in accepted(part, stocks_rejected(resp)):
+                        prev[row_key(row)] = int(row["stock"])
+                        log_aggregate("targeted_stock_sent", group_by=("cabinet",), cabinet=cab.name, **row)
+                    sent += len(part)
+            finally:
+                save_snapshot(cfg.cache_dir, cab.name, prev)
+            return sent
+
+        results = run_per_cabinet(push, clients)
+
+    summary = {
+        "touched": len(touched), "fetched": len(fetch), "items": len(items), "missing": missing,
+        "sent": {k: v for k, (v, _) in results.items()},
+        "errors": {k: str(e) for k, (_, e) in results.items() if e is not None},
+    }
+    log_json(logger, "targeted_push_done", **summary)
+    return summary
+
+
+def resolve_targets(
+    ms: MoySkladClient,
+    index: Dict[str, Any],
+    offer_ids: Iterable[str],
+    assortment_ids: Iterable[str],
+) -> Tuple[Set[str], List[str]]:
+    """
+    id ассортимента МС по offer_id (= артикул) и id: сначала по индексу полного
+    прогона, неизвестные — запросами в МС. Найденные товары и комплекты (с составом)
+    дописываются в index (в памяти). Возвращает (ids, не найденные).
+    """
+    articles: Dict[str, str] = index.setdefault("articles", {})
+    bundles: Dict[str, Dict[str, Any]] = index.setdefault("bundles", {})
+    by_article = {a: pid for pid, a in articles.items()}
+    by_article.update({b["article"]: bid for bid, b in bundles.items() if b.get("article")})
+
+    ids: Set[str] = set()
+    not_found: List[str] = []
+
+    def add(kind: str, aid: str, article: str) -> None:
+        if kind == "bundle":
+            if aid not in bundles:
+                bundles[aid] = bundle_entry(ms.get_bundle(aid), article)
+        else:
+            articles[aid] = article
+        ids.add(aid)
+
+    resolver = AssortmentResolver(ms)
+    for off in {str(x).strip() for x in offer_ids if x}:
+        if off in by_article:
+            ids.add(by_article[off])
+            continue
+        try:
+            row = resolver.get_by_article(off)
+        except KeyError:
+            not_found.append(off)
+            continue
+        add(((row.get("meta") or {}).get("type") or "product"), str(row["id"]), off)
+
+    unknown: List[str] = []
+    for aid in {str(x).strip() for x in assortment_ids if x}:
+        if aid in articles or aid in bundles:
+            ids.add(aid)
+        else:
+            unknown.append(aid)
+    if unknown:
+        # тип по id не известен — спрашиваем и товары, и комплекты
+        hrefs = [f"{MS_BASE}/entity/{kind}/{aid}" for kind in ("product", "bundle") for aid in unknown]
+        for href, article in ms.resolve_articles_by_hrefs(hrefs).items():
+            add("bundle" if "/entity/bundle/" in href else "product", href_id(href), article)
+        not_found.extend(aid for aid in unknown if aid not in ids)
+
+    return ids, sorted(not_found)
+
+
+def sync_offers(
+    cfg: Config,
+    logger: logging.Logger,
+    offer_ids: Iterable[str] = (),
+    assortment_ids: Iterable[str] = (),
+) -> Dict[str, Any]:
+    """
+    Частичный stock sync: остатки только указанных offer_id / id ассортимента МС
+    и комплектов, в которые они входят (для комплекта — его компонентов и их комплектов).
+    Тем же путём, что и отправка после sync_orders, — без прохода по каталогу.
+    """
+    ms = MoySkladClient(cfg.moysklad_token)
+    clients = ozon_clients(cfg)
+    index = load_index(cfg.cache_dir)
+    with trace.span("resolve_targets"), ledger.stage("resolve_targets"):
+        ids, not_found = resolve_targets(ms, index, offer_ids, assortment_ids)
+    if not_found:
+        log_json(logger, "partial_sync_not_found", items=not_found)
+    summary = recompute_and_push(cfg, ms, clients, ids, logger, index=index)
+    return {**summary, "not_found": not_found}
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from .log import log_json
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+
+
+class SpanNode:
+    """
+    Узел дерева таймингов. Одноимённые спаны под одним родителем (например,
+    шаги каждого постинга) складываются в один узел: count растёт, время суммируется.
+    """
+
+    def __init__(self, name: str, depth: int = 0):
+        self.name = name
+        self.depth = depth  # 0 — корень прогона
+        self.children: Dict[str, SpanNode] = {}
+        self.count = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.items = 0
+        self.api_calls = 0  # только свои, без детей
+        self.attrs: Dict[str, Any] = {}
+
+    def child(self, name: str) -> "SpanNode":
+        with _lock:
+            node = self.children.get(name)
+            if node is None:
+                node = self.children[name] = SpanNode(name, self.depth + 1)
+            return node
+
+    def total_api_calls(self) -> int:
+        return self.api_calls + sum(c.total_api_calls() for c in list(self.children.values()))
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "name": self.name,
+            "count": self.count,
+            "wall_s": round(self.wall_s, 4),
+            "cpu_s": round(self.cpu_s, 4),
+            "api_calls": self.total_api_calls(),
+        }
+        if self.items:
+            out["items"] = self.items
+        if self.attrs:
+            out["attrs"] = self.attrs
+        if self.children:
+            out["children"] = [c.to_dict() for c in self.children.values()]
+        return out
+
+    def folded(self, prefix: str = "") -> List[str]:
+        """
+        Формат collapsed stacks (flamegraph.pl / speedscope): "a;b;c <self_us>".
+        """
+        path = f"{prefix};{self.name}" if prefix else self.name
+        children = list(self.children.values())
+        self_us = int(max(0.0, self.wall_s - sum(c.wall_s for c in children)) * 1_000_000)
+        lines = [f"{path} {self_us}"] if self_us else []
+        for c in children:
+            lines.extend(c.folded(path))
+        return lines
+
+
+_current: contextvars.ContextVar[Optional[SpanNode]] = contextvars.ContextVar("trace_span", default=None)
+
+# вызывается на выходе из спанов этапов (глубина 1) — для профилировщика
+_stage_hook: Optional[Callable[[str], None]] = None
+
+
+def on_stage_exit(fn: Optional[Callable[[str], None]]) -> None:
+    global _stage_hook
+    _stage_hook = fn
+
+
+class Span:
+    """
+    with span("bundles") as sp:
+        ...
+        sp.add_items(len(bundles))
+
+    Меряет wall/CPU (CPU — текущего потока), считает вызовы request_json внутри.
+    """
+
+    def __init__(self, name: str, **attrs: Any):
+        self.name = name
+        self.attrs = attrs
+        self.node: Optional[SpanNode] = None
+        self._token: Optional[contextvars.Token] = None
+        self._w0 = 0.0
+        self._c0 = 0.0
+
+    def __enter__(self) -> "Span":
+        parent = _current.get()
+        self.node = parent.child(self.name) if parent is not None else SpanNode(self.name)
+        if self.attrs:
+            with _lock:
+                self.node.attrs.update(self.attrs)
+        self._token = _current.set(self.node)
+        self._w0 = time.perf_counter()
+        self._c0 = time.thread_time()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        wall = time.perf_counter() - self._w0
+        cpu = time.thread_time() - self._c0
+        node = self.node
+        assert node is not None and self._token is not None
+        with _lock:
+            node.count += 1
+            node.wall_s += wall
+            node.cpu_s += cpu
+        _current.reset(self._token)
+        hook = _stage_hook
+        if hook is not None and node.depth == 1:
+            hook(node.name)
+
+    def add_items(self, n: int) -> None:
+        if self.node is not None:
+            with _lock:
+                self.node.items += int(n)
+
+    def set(self, **attrs: Any) -> None:
+        if self.node is not None:
+            with _lock:
+                self.node.attrs.update(attrs)
+
+
+def span(name: str, **attrs: Any) -> Span:
+    return Span(name, **attrs)
+
+
+def note_api_call() -> None:
+    """Вызывается из request_json на каждую попытку запроса."""
+    node = _current.get()
+    if node is not None:
+        with _lock:
+            node.api_calls += 1
+
+
+def bind(fn: Callable[..., T]) -> Callable[..., T]:
+    """
+    Переносит текущий спан в другой поток: pool.submit(trace.bind(fn), ...).
+    """
+    ctx = contextvars.copy_context()
+
+    def run(*args: Any, **kwargs: Any) -> T:
+        return ctx.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def report(logger: logging.Logger, root: Span, cache_dir: str, job: str) -> None:
+    """
+    Дерево таймингов в лог (timing_tree) + <cache_dir>/trace_<job>.folded для flamegraph.
+    """
+    if root.node is None:
+        return
+    log_json(logger, "timing_tree", full=True, job=job, tree=root.node.to_dict())
+    path = os.path.join(cache_dir, f"trace_{job}.folded")
+    try:
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(root.node.folded()) + "\n")
+        os.replace(tmp, path)
+    except Exception as e:
+        log_json(logger, "trace_write_failed", job=job, error=str(e))
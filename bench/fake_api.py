@@ -0,0 +1,676 @@
+"""
+Локальный стенд вместо МойСклад и Ozon для бенчмарков.
+
+Один HTTP-сервер обслуживает оба API:
+  /ms/api/remap/1.2/...   — МойСклад (MOYSKLAD_BASE_URL)
+  /ozon/...               — Ozon Seller API (OZON_BASE_URL)
+  /__stats, /__reset      — счётчики запросов по эндпоинтам
+
+Каталог синтетический и детерминированный (seed), поэтому прогоны
+на разных коммитах сравнимы. Можно добавить задержку и долю ответов 429.
+
+Запуск отдельно:
+    python -m bench.fake_api --skus 10000 --port 8765
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+MS_PREFIX = "/ms/api/remap/1.2"
+OZON_PREFIX = "/ozon"
+
+STORE_ID = "42db7535-5bb6-11ef-0a80-1589000daaa3"
+# второй склад МС (BenchSpec.stores=2): остаток выводится из основного, без резерва
+STORE2_ID = "5a1c0e2e-5bb6-11ef-0a80-1589000daaa4"
+
+OZON_STATUSES = ["awaiting_packaging", "awaiting_deliver", "delivering", "delivered", "cancelled"]
+SUPPLY_STATES = [
+    "ORDER_STATE_READY_TO_SUPPLY",
+    "ORDER_STATE_IN_TRANSIT",
+    "ORDER_STATE_ACCEPTANCE_AT_STORAGE_WAREHOUSE",
+    "ORDER_STATE_COMPLETED",
+]
+
+_ID_SEG = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)$")
+
+
+def template_path(path: str) -> str:
+    """/entity/product/<uuid>/x -> /entity/product/{id}/x"""
+    return "/".join("{id}" if _ID_SEG.match(p) else p for p in path.split("/"))
+
+
+@dataclass(frozen=True)
+class CabinetSpec:
+    name: str
+    client_id: str
+    warehouse_id: int
+
+
+@dataclass
+class BenchSpec:
+    skus: int = 1000
+    bundles: int = 100
+    postings: int = 200          # на кабинет
+    cabinets: int = 2
+    seed: int = 42
+    latency_ms: float = 0.0      # средняя задержка ответа
+    rate_429: float = 0.0        # доля ответов 429
+    retry_after: float = 0.05    # Retry-After для 429, сек
+    supplies: int = 0            # FBO-поставок на кабинет
+    stores: int = 1              # складов МС в отчёте об остатках (1 или 2)
+
+    def cabinet_specs(self) -> List[CabinetSpec]:
+        return [
+            CabinetSpec(f"OZON{i + 1}", str(100000 + i), 22000000000000 + i)
+            for i in range(self.cabinets)
+        ]
+
+
+@dataclass
+class Catalog:
+    products: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    bundles: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    by_article: Dict[str, Tuple[str, str]] = field(default_factory=dict)  # article -> (type, id)
+    offers: Dict[str, List[str]] = field(default_factory=dict)            # client_id -> offer_ids
+    postings: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    supplies: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)  # client_id -> поставки
+
+
+def _store_stock(p: Dict[str, Any], store_id: str) -> Tuple[float, float]:
+    """(stock, reserve) товара на складе МС."""
+    if store_id == STORE_ID:
+        return p["stock"], p["reserve"]
+    return float(int(p["stock"]) % 7), 0.0
+
+
+def _uid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def build_catalog(spec: BenchSpec) -> Catalog:
+    rng = random.Random(spec.seed)
+    cat = Catalog()
+
+    for i in range(spec.skus):
+        pid = _uid(rng)
+        art = f"ART-{i:06d}"
+        cat.products[pid] = {
+            "id": pid,
+            "article": art,
+            "stock": float(rng.choice([0, 0, 1, 2, 5, 10, 25, 100])),
+            "reserve": float(rng.choice([0, 0, 0, 1])),
+            "price": rng.randint(100, 10000) * 100,
+        }
+        cat.by_article[art] = ("product", pid)
+
+    pids = list(cat.products)
+    for i in range(spec.bundles):
+        bid = _uid(rng)
+        art = f"BND-{i:05d}"
+        comps = [(rng.choice(pids), float(rng.randint(1, 3))) for _ in range(rng.randint(2, 3))] if pids else []
+        cat.bundles[bid] = {"id": bid, "article": art, "components": comps, "price": rng.randint(100, 10000) * 100}
+        cat.by_article[art] = ("bundle", bid)
+
+    # офферы: кабинеты делят каталог по кругу, ~5% артикулов нет ни в одном кабинете
+    cabs = spec.cabinet_specs()
+    for c in cabs:
+        cat.offers[c.client_id] = []
+    articles = sorted(cat.by_article)
+    for i, art in enumerate(articles):
+        if rng.random() < 0.05 or not cabs:
+            continue
+        cat.offers[cabs[i % len(cabs)].client_id].append(art)
+
+    base = datetime(2025, 12, 10, tzinfo=timezone.utc)
+    span_s = int((datetime.now(timezone.utc) - base).total_seconds())
+    for ci, c in enumerate(cabs):
+        offers = [o for o in cat.offers[c.client_id] if o.startswith("ART-")] or ["ART-000000"]
+        out: List[Dict[str, Any]] = []
+        for n in range(spec.postings):
+            at = base + timedelta(seconds=rng.randint(0, max(1, span_s)))
+            products = [
+                {"offer_id": rng.choice(offers), "quantity": rng.randint(1, 2), "sku": 1000 + n, "price": "100.00"}
+                for _ in range(rng.randint(1, 3))
+            ]
+            out.append({
+                "posting_number": f"{ci + 1}{n:08d}-0001-1",
+                "order_number": f"{ci + 1}{n:08d}-0001",
+                "status": rng.choice(OZON_STATUSES),
+                "in_process_at": at.isoformat().replace("+00:00", "Z"),
+                "shipment_date": (at + timedelta(days=1)).isoformat().replace("+00:00", "Z"),
+                "products": products,
+            })
+        out.sort(key=lambda p: p["in_process_at"])
+        cat.postings[c.client_id] = out
+
+        cat.supplies[c.client_id] = [
+            {
+                "order_id": 70000000 + ci * 1000000 + n,
+                "state": rng.choice(SUPPLY_STATES),
+                "items": [
+                    {"offer_id": o, "quantity": rng.randint(1, 20)}
+                    for o in rng.sample(offers, min(len(offers), rng.randint(1, 10)))
+                ],
+            }
+            for n in range(spec.supplies)
+        ]
+
+    return cat
+
+
+def _parse_filter(flt: str) -> Dict[str, List[str]]:
+    out: Dict[str, List[str]] = {}
+    for part in (flt or "").split(";"):
+        if "=" not in part:
+            continue
+        k, v = part.split("=", 1)
+        out.setdefault(k.strip(), []).append(v.strip().strip('"'))
+    return out
+
+
+def _parse_ts(s: str) -> datetime:
+    return datetime.fromisoformat(s.replace("Z", "+00:00"))
+
+
+class FakeState:
+    def __init__(self, spec: BenchSpec, catalog: Catalog):
+        self.spec = spec
+        self.cat = catalog
+        self.base_url = ""  # http://host:port, выставляет сервер
+        self.lock = threading.Lock()
+        self.rng = random.Random(spec.seed + 1)
+        self.counts: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.orders: Dict[str, Dict[str, Any]] = {}
+        self.demands: Dict[str, Dict[str, Any]] = {}
+        self.stock_pushes = 0
+
+    # ---- helpers ----
+    def ms_href(self, path: str) -> str:
+        return f"{self.base_url}{MS_PREFIX}{path}"
+
+    def ms_meta(self, path: str, typ: str) -> Dict[str, Any]:
+        return {"href": self.ms_href(path), "type": typ}
+
+    def new_id(self) -> str:
+        with self.lock:
+            return _uid(self.rng)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counts.clear()
+            self.statuses.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": dict(self.counts),
+                "statuses": dict(self.statuses),
+                "total": sum(self.counts.values()),
+                "orders": len(self.orders),
+                "demands": len(self.demands),
+                "stock_pushes": self.stock_pushes,
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "FakeApi/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self) -> FakeState:
+        return self.server.state  # type: ignore[attr-defined]
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+    # ---- plumbing ----
+    def _body(self) -> Any:
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        if not raw:
+            return None
+        if (self.headers.get("Content-Encoding") or "").lower() == "gzip":
+            import gzip
+            raw = gzip.decompress(raw)
+        return json.loads(raw)
+
+    def _send(self, status: int, payload: Any = None, headers: Optional[Dict[str, str]] = None) -> None:
+        data = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def _dispatch(self, method: str) -> None:
+        u = urlparse(self.path)
+        path = u.path
+        q = {k: v[-1] for k, v in parse_qs(u.query).items()}
+
+        if path == "/__stats":
+            return self._send(200, self.state.stats())
+        if path == "/__reset":
+            self.state.reset()
+            return self._send(200, {"ok": True})
+
+        key = f"{method} {template_path(path)}"
+        spec = self.state.spec
+        if spec.latency_ms > 0:
+            time.sleep(self.state.rng.expovariate(1.0 / (spec.latency_ms / 1000.0)))
+
+        body = self._body() if method in ("POST", "PUT") else None
+
+        with self.state.lock:
+            self.state.counts[key] += 1
+            throttled = spec.rate_429 > 0 and self.state.rng.random() < spec.rate_429
+        if throttled:
+            with self.state.lock:
+                self.state.statuses["429"] += 1
+            return self._send(429, {"errors": [{"error": "rate limit"}]}, {"Retry-After": str(spec.retry_after)})
+
+        try:
+            if path.startswith(MS_PREFIX):
+                status, payload = self._ms(method, path[len(MS_PREFIX):], q, body)
+            elif path.startswith(OZON_PREFIX):
+                status, payload = self._ozon(method, path[len(OZON_PREFIX):], body)
+            else:
+                status, payload = 404, {"error": "unknown prefix"}
+        except Exception as e:  # ошибка стенда не должна ронять сервер
+            status, payload = 500, {"error": repr(e)}
+
+        with self.state.lock:
+            self.state.statuses[str(status)] += 1
+        self._send(status, payload)
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def do_PUT(self) -> None:
+        self._dispatch("PUT")
+
+    def do_DELETE(self) -> None:
+        self._dispatch("DELETE")
+
+    # ---- MoySklad ----
+    def _product_row(self, p: Dict[str, Any]) -> Dict[str, Any]:
+        st = self.state
+        return {
+            "id": p["id"],
+            "meta": st.ms_meta(f"/entity/product/{p['id']}", "product"),
+            "article": p["article"],
+            "salePrices": [{"value": p["price"], "priceType": {"name": "Цена продажи"}}],
+        }
+
+    def _bundle_row(self, b: Dict[str, Any]) -> Dict[str, Any]:
+        st = self.state
+        comps_href = f"/entity/bundle/{b['id']}/components"
+        return {
+            "id": b["id"],
+            "meta": st.ms_meta(f"/entity/bundle/{b['id']}", "bundle"),
+            "article": b["article"],
+            "salePrices": [{"value": b["price"], "priceType": {"name": "Цена продажи"}}],
+            "components": {
+                "meta": {"href": st.ms_href(comps_href), "size": len(b["components"])},
+                "rows": self._bundle_components(b),
+            },
+        }
+
+    def _bundle_components(self, b: Dict[str, Any]) -> List[Dict[str, Any]]:
+        st = self.state
+        return [
+            {"quantity": qty, "assortment": {"meta": st.ms_meta(f"/entity/product/{pid}", "product")}}
+            for pid, qty in b["components"]
+        ]
+
+    def _store_ids(self) -> List[str]:
+        return [STORE_ID, STORE2_ID][:max(1, self.state.spec.stores)]
+
+    def _list(self, rows: List[Dict[str, Any]], q: Dict[str, str]) -> Dict[str, Any]:
+        limit = int(q.get("limit") or 1000)
+        offset = int(q.get("offset") or 0)
+        return {"meta": {"size": len(rows), "limit": limit, "offset": offset}, "rows": rows[offset:offset + limit]}
+
+    def _ms(self, method: str, path: str, q: Dict[str, str], body: Any) -> Tuple[int, Any]:
+        st = self.state
+        cat = st.cat
+        parts = [x for x in path.split("/") if x]
+        flt = _parse_filter(q.get("filter", ""))
+
+        if parts[:3] == ["report", "stock", "bystore"] and method == "GET":
+            if parts[3:] == ["current"]:
+                ids = set(flt.get("assortmentId") or [])
+                stores = set(flt.get("storeId") or []) or {STORE_ID}
+                out = []
+                for pid in ids or set(cat.products):
+                    p = cat.products.get(pid)
+                    if not p:
+                        continue
+                    for sid in stores:
+                        if sid not in self._store_ids():
+                            continue
+                        stock, reserve = _store_stock(p, sid)
+                        val = stock - reserve if q.get("stockType") == "freeStock" else stock
+                        out.append({"assortmentId": pid, "storeId": sid, "stock": max(0.0, val)})
+                return 200, out
+            rows = []
+            for p in cat.products.values():
+                by_store = []
+                for sid in self._store_ids():
+                    stock, reserve = _store_stock(p, sid)
+                    by_store.append({
+                        "meta": st.ms_meta(f"/entity/store/{sid}", "store"),
+                        "name": "Ozon" if sid == STORE_ID else "Ozon-2",
+                        "stock": stock,
+                        "reserve": reserve,
+                        "inTransit": 0,
+                    })
+                rows.append({
+                    "meta": {"href": st.ms_href(f"/entity/product/{p['id']}") + "?expand=supplier", "type": "product"},
+                    "stockByStore": by_store,
+                })
+            # как в МС: без limit — первые 1000 строк, meta.size — полный размер
+            return 200, self._list(rows, q)
+
+        if parts[:1] != ["entity"] or len(parts) < 2:
+            return 404, {"errors": [{"error": f"unknown path {path}"}]}
+
+        ent = parts[1]
+        rest = parts[2:]
+
+        if ent in ("product", "bundle") and method == "GET":
+            src = cat.products if ent == "product" else cat.bundles
+            to_row = self._product_row if ent == "product" else self._bundle_row
+            if not rest:
+                if "id" in flt:
+                    rows = [to_row(src[i]) for i in flt["id"] if i in src]
+                elif "article" in flt:
+                    rows = []
+                    for art in flt["article"]:
+                        t, i = cat.by_article.get(art, ("", ""))
+                        if t == ent:
+                            rows.append(to_row(src[i]))
+                else:
+                    rows = [to_row(x) for x in src.values()]
+                return 200, self._list(rows, q)
+            obj = src.get(rest[0])
+            if not obj:
+                return 404, {"errors": [{"error": "not found"}]}
+            if rest[1:] == ["components"]:
+                return 200, self._list(self._bundle_components(obj), q)
+            return 200, to_row(obj)
+
+        if ent == "customerorder":
+            return self._ms_doc(method, rest, q, flt, body, st.orders, "customerorder")
+        if ent == "demand":
+            return self._ms_doc(method, rest, q, flt, body, st.demands, "demand")
+
+        return 404, {"errors": [{"error": f"unknown entity {ent}"}]}
+
+    def _ms_doc(
+        self,
+        method: str,
+        rest: List[str],
+        q: Dict[str, str],
+        flt: Dict[str, List[str]],
+        body: Any,
+        docs: Dict[str, Dict[str, Any]],
+        typ: str,
+    ) -> Tuple[int, Any]:
+        st = self.state
+
+        def public(d: Dict[str, Any]) -> Dict[str, Any]:
+            return {k: v for k, v in d.items() if k != "positions"}
+
+        def pos_row(doc_id: str, p: Dict[str, Any]) -> Dict[str, Any]:
+            return {
+                "id": p["id"],
+                "meta": st.ms_meta(f"/entity/{typ}/{doc_id}/positions/{p['id']}", f"{typ}position"),
+                **{k: v for k, v in p.items() if k != "id"},
+            }
+
+        def make_positions(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            return [{"id": st.new_id(), **r} for r in rows or []]
+
+        def reserve(p: Dict[str, Any], delta: float) -> None:
+            # резерв заказа покупателя уменьшает свободный остаток товара (под st.lock)
+            if typ != "customerorder" or not delta:
+                return
+            href = (((p.get("assortment") or {}).get("meta") or {}).get("href")) or ""
+            prod = self.state.cat.products.get(href.rstrip("/").split("/")[-1])
+            if prod is not None:
+                prod["reserve"] = max(0.0, prod["reserve"] + delta)
+
+        if not rest:
+            if method == "GET":
+                with st.lock:
+                    items = list(docs.values())
+                if q.get("search"):
+                    items = [d for d in items if q["search"] in (d.get("name") or "")]
+                for k, vals in flt.items():
+                    if k == "customerOrder":
+                        items = [d for d in items if ((d.get("customerOrder") or {}).get("meta") or {}).get("href") in vals]
+                    else:
+                        items = [d for d in items if str(d.get(k) or "") in vals]
+                return 200, self._list([public(d) for d in items], q)
+            if method == "POST":
+                did = st.new_id()
+                now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                doc = {
+                    **{k: v for k, v in (body or {}).items() if k != "positions"},
+                    "id": did,
+                    "meta": st.ms_meta(f"/entity/{typ}/{did}", typ),
+                    "created": now,
+                    "moment": (body or {}).get("moment") or now,
+                    "positions": make_positions(((body or {}).get("positions") or {}).get("rows") or []),
+                }
+                with st.lock:
+                    docs[did] = doc
+                    for p in doc["positions"]:
+                        reserve(p, float(p.get("reserve") or 0))
+                return 200, public(doc)
+            return 405, {"errors": [{"error": "method"}]}
+
+        did = rest[0]
+        with st.lock:
+            doc = docs.get(did)
+        if not doc:
+            return 404, {"errors": [{"error": "not found"}]}
+
+        if len(rest) == 1:
+            if method == "GET":
+                return 200, public(doc)
+            if method == "PUT":
+                with st.lock:
+                    doc.update({k: v for k, v in (body or {}).items() if k != "positions"})
+                return 200, public(doc)
+            if method == "DELETE":
+                with st.lock:
+                    docs.pop(did, None)
+                return 200, None
+
+        if rest[1] == "positions":
+            if len(rest) == 2:
+                if method == "GET":
+                    return 200, self._list([pos_row(did, p) for p in doc["positions"]], q)
+                if method == "POST":
+                    rows = body.get("rows") if isinstance(body, dict) else body
+                    new = make_positions(rows or [])
+                    with st.lock:
+                        doc["positions"].extend(new)
+                    return 200, [pos_row(did, p) for p in new]
+            else:
+                for p in doc["positions"]:
+                    if p["id"] == rest[2]:
+                        if method == "PUT":
+                            with st.lock:
+                                if "reserve" in (body or {}):
+                                    reserve(p, float(body["reserve"] or 0) - float(p.get("reserve") or 0))
+                                p.update(body or {})
+                        return 200, pos_row(did, p)
+                return 404, {"errors": [{"error": "position not found"}]}
+
+        return 404, {"errors": [{"error": "unknown doc path"}]}
+
+    # ---- Ozon ----
+    def _ozon(self, method: str, path: str, body: Any) -> Tuple[int, Any]:
+        st = self.state
+        cat = st.cat
+        body = body or {}
+        cid = self.headers.get("Client-Id") or ""
+        if method != "POST":
+            return 405, {"message": "method"}
+        if cid not in cat.offers:
+            return 403, {"code": 7, "message": "unknown Client-Id"}
+
+        if path == "/v3/product/list":
+            offers = cat.offers[cid]
+            only = (body.get("filter") or {}).get("offer_id")
+            if only:
+                wanted = set(only)
+                offers = [o for o in offers if o in wanted]
+            limit = min(int(body.get("limit") or 100), 1000)
+            start = int(body.get("last_id") or 0)
+            chunk = offers[start:start + limit]
+            nxt = start + len(chunk)
+            items = [{"offer_id": o, "product_id": 1000000 + start + i} for i, o in enumerate(chunk)]
+            return 200, {"result": {"items": items, "total": len(offers), "last_id": str(nxt) if nxt < len(offers) else ""}}
+
+        if path == "/v2/products/stocks":
+            stocks = body.get("stocks") or []
+            if len(stocks) > 100:
+                return 400, {"code": 3, "message": "too many stocks, max 100"}
+            with st.lock:
+                st.stock_pushes += len(stocks)
+            return 200, {"result": [
+                {"offer_id": s.get("offer_id"), "product_id": 0, "warehouse_id": s.get("warehouse_id"), "updated": True, "errors": []}
+                for s in stocks
+            ]}
+
+        if path == "/v3/posting/fbs/list":
+            flt = body.get("filter") or {}
+            since = _parse_ts(flt["since"])
+            to = _parse_ts(flt["to"])
+            statuses = set(flt.get("status") or []) if isinstance(flt.get("status"), list) else ({flt["status"]} if flt.get("status") else set())
+            limit = int(body.get("limit") or 0)
+            offset = int(body.get("offset") or 0)
+            if not 1 <= limit <= 1000:
+                return 400, {"code": 3, "message": "limit must be in 1..1000"}
+            if offset > 20000:
+                return 400, {"code": 3, "message": "offset too big"}
+            rows = [
+                p for p in cat.postings[cid]
+                if since <= _parse_ts(p["in_process_at"]) <= to and (not statuses or p["status"] in statuses)
+            ]
+            page = rows[offset:offset + limit]
+            short = [{k: p[k] for k in ("posting_number", "order_number", "status", "in_process_at", "shipment_date")} for p in page]
+            return 200, {"result": {"postings": short, "has_next": offset + limit < len(rows)}}
+
+        if path == "/v3/posting/fbs/get":
+            pn = body.get("posting_number")
+            for p in cat.postings[cid]:
+                if p["posting_number"] == pn:
+                    return 200, {"result": p}
+            return 404, {"code": 5, "message": "posting not found"}
+
+        if path == "/v3/supply-order/list":
+            states = set((body.get("filter") or {}).get("states") or [])
+            limit = int(body.get("limit") or 0)
+            if not 1 <= limit <= 100:
+                return 400, {"code": 3, "message": "limit must be in 1..100"}
+            rows = [x for x in reversed(cat.supplies[cid]) if not states or x["state"] in states]
+            start = int(body.get("last_id") or 0)
+            chunk = rows[start:start + limit]
+            nxt = start + len(chunk)
+            return 200, {"order_ids": [x["order_id"] for x in chunk], "last_id": str(nxt) if nxt < len(rows) else ""}
+
+        if path in ("/v3/supply-order/get", "/v3/supply-order/items"):
+            oid = int(body.get("order_id") or 0)
+            for x in cat.supplies[cid]:
+                if x["order_id"] == oid:
+                    if path.endswith("/get"):
+                        return 200, {"orders": [{"order_id": oid, "state": x["state"]}]}
+                    return 200, {"items": x["items"]}
+            return 404, {"code": 5, "message": "supply order not found"}
+
+        return 404, {"code": 5, "message": f"unknown method {path}"}
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, spec: BenchSpec, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), Handler)
+        self.state = FakeState(spec, build_catalog(spec))
+        self.state.base_url = f"http://{host}:{self.server_address[1]}"
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return self.state.base_url
+
+    @property
+    def ms_base(self) -> str:
+        return f"{self.base_url}{MS_PREFIX}"
+
+    @property
+    def ozon_base(self) -> str:
+        return f"{self.base_url}{OZON_PREFIX}"
+
+    def start(self) -> "FakeApiServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Fake MoySklad/Ozon API for benchmarks")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--skus", type=int, default=1000)
+    ap.add_argument("--bundles", type=int, default=100)
+    ap.add_argument("--postings", type=int, default=200)
+    ap.add_argument("--cabinets", type=int, default=2)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    a = ap.parse_args()
+
+    spec = BenchSpec(
+        skus=a.skus, bundles=a.bundles, postings=a.postings, cabinets=a.cabinets,
+        seed=a.seed, latency_ms=a.latency_ms, rate_429=a.rate_429,
+    )
+    srv = FakeApiServer(spec, a.host, a.port)
+    print(json.dumps({"ms_base": srv.ms_base, "ozon_base": srv.ozon_base, "store_id": STORE_ID,
+                      "cabinets": [c.__dict__ for c in spec.cabinet_specs()]}))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
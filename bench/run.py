@@ -0,0 +1,211 @@
+"""
+Сквозной бенчмарк синхронизации против локального стенда (bench/fake_api.py).
+
+Для каждого размера каталога поднимает стенд, запускает в отдельных процессах
+`python -m app.sync` и `scripts/sync_orders.py` и пишет в JSON:
+время, число запросов по эндпоинтам, пиковый RSS, коммит.
+
+    python -m bench.run --sizes 1k,10k --latency-ms 5 --rate-429 0.01
+    python -m bench.run --compare bench/results/a.json bench/results/b.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from .fake_api import STORE2_ID, STORE_ID, SUPPLY_STATES, BenchSpec, FakeApiServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRYPOINTS = {
+    "stock": [sys.executable, "-m", "app.sync"],
+    "orders": [sys.executable, os.path.join("scripts", "sync_orders.py")],
+}
+
+
+def parse_size(s: str) -> int:
+    s = s.strip().lower()
+    if s.endswith("k"):
+        return int(float(s[:-1]) * 1000)
+    return int(s)
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except Exception:
+        return "unknown"
+
+
+def _http_json(url: str) -> Dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=10) as r:
+        return json.loads(r.read())
+
+
+def child_env(srv: FakeApiServer, spec: BenchSpec, cache_dir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    cabs = spec.cabinet_specs()
+    env.update({
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "MOYSKLAD_BASE_URL": srv.ms_base,
+        "OZON_BASE_URL": srv.ozon_base,
+        "MOYSKLAD_TOKEN": "bench",
+        "MOYSKLAD_STORE_ID": STORE_ID,
+        "OZON_CABINETS": ",".join(c.name for c in cabs),
+        "CACHE_DIR": cache_dir,
+        "LOG_LEVEL": "INFO",
+    })
+    if spec.supplies:
+        env["OZON_SUPPLY_STATES"] = ",".join(SUPPLY_STATES[:-1])
+    for i, c in enumerate(cabs):
+        env[f"{c.name}_CLIENT_ID"] = c.client_id
+        env[f"{c.name}_API_KEY"] = "bench"
+        env[f"{c.name}_WAREHOUSE_ID"] = str(c.warehouse_id)
+        if spec.stores > 1:
+            # второй склад Ozon кормится суммой двух складов МС
+            env[f"{c.name}_WAREHOUSES"] = f"{c.warehouse_id}:{STORE_ID},{c.warehouse_id + 100}:{STORE_ID}+{STORE2_ID}"
+        env[f"{c.name}_SALES_CHANNEL_ID"] = f"00000000-0000-0000-0000-{i:012d}"
+    return env
+
+
+def run_entrypoint(name: str, env: Dict[str, str], log_path: str) -> Dict[str, Any]:
+    """
+    Запуск в отдельном процессе: так пиковый RSS считается честно (wait4 -> ru_maxrss).
+    """
+    t0 = time.perf_counter()
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen(ENTRYPOINTS[name], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "exit_code": proc.returncode,
+        "wall_s": round(wall, 3),
+        "cpu_user_s": round(usage.ru_utime, 3),
+        "cpu_sys_s": round(usage.ru_stime, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024.0, 1),  # Linux: KiB
+        "log": log_path,
+    }
+
+
+def run_scenario(spec: BenchSpec, workdir: str) -> Dict[str, Any]:
+    srv = FakeApiServer(spec).start()
+    try:
+        cache_dir = os.path.join(workdir, "cache")
+        env = child_env(srv, spec, cache_dir)
+        out: Dict[str, Any] = {"spec": spec.__dict__, "runs": {}}
+        # stock и orders дважды: холодный и тёплый (кэш offer_id, журнал записей заказов)
+        for run_name, ep in (
+            ("stock_cold", "stock"), ("stock_warm", "stock"), ("orders", "orders"), ("orders_warm", "orders"),
+        ):
+            _http_json(f"{srv.base_url}/__reset")
+            res = run_entrypoint(ep, env, os.path.join(workdir, f"{run_name}.log"))
+            st = _http_json(f"{srv.base_url}/__stats")
+            res["requests_total"] = st["total"]
+            res["requests"] = dict(sorted(st["requests"].items()))
+            res["statuses"] = st["statuses"]
+            out["runs"][run_name] = res
+            print(
+                f"  {run_name:<11} exit={res['exit_code']} wall={res['wall_s']:.2f}s "
+                f"requests={res['requests_total']} rss={res['peak_rss_mb']}MB",
+                flush=True,
+            )
+        return out
+    finally:
+        srv.stop()
+
+
+def compare(a_path: str, b_path: str) -> None:
+    with open(a_path, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(b_path, encoding="utf-8") as f:
+        b = json.load(f)
+    print(f"A={a.get('commit')}  B={b.get('commit')}")
+    for key, sa in a["scenarios"].items():
+        sb = b["scenarios"].get(key)
+        if not sb:
+            continue
+        print(f"[{key}]")
+        for run_name, ra in sa["runs"].items():
+            rb = sb["runs"].get(run_name)
+            if not rb:
+                continue
+            for m in ("wall_s", "requests_total", "peak_rss_mb"):
+                va, vb = ra[m], rb[m]
+                pct = ((vb - va) / va * 100.0) if va else 0.0
+                print(f"  {run_name:<11} {m:<15} {va:>10} -> {vb:>10}  ({pct:+.1f}%)")
+
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="End-to-end benchmark against the fake API")
+    ap.add_argument("--sizes", default="1k", help="SKU counts, e.g. 1k,10k,100k")
+    ap.add_argument("--bundle-ratio", type=float, default=0.1, help="bundles per SKU")
+    ap.add_argument("--postings", type=int, default=200, help="postings per cabinet")
+    ap.add_argument("--cabinets", type=int, default=2)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    ap.add_argument("--supplies", type=int, default=0, help="FBO supply orders per cabinet")
+    ap.add_argument("--stores", type=int, default=1, choices=(1, 2), help="MS stores / Ozon warehouses per cabinet")
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "results"))
+    ap.add_argument("--compare", nargs=2, metavar=("A", "B"))
+    a = ap.parse_args(argv)
+
+    if a.compare:
+        compare(*a.compare)
+        return 0
+
+    if os.path.exists(os.path.join(ROOT, ".env")):
+        # app.config грузит .env с override=True — значения оттуда перебьют стенд
+        print("WARNING: .env exists in repo root and overrides bench env vars", file=sys.stderr)
+
+    commit = git_commit()
+    result: Dict[str, Any] = {
+        "commit": commit,
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "scenarios": {},
+    }
+
+    for size in [parse_size(x) for x in a.sizes.split(",") if x.strip()]:
+        spec = BenchSpec(
+            skus=size,
+            bundles=int(size * a.bundle_ratio),
+            postings=a.postings,
+            cabinets=a.cabinets,
+            seed=a.seed,
+            latency_ms=a.latency_ms,
+            rate_429=a.rate_429,
+            supplies=a.supplies,
+            stores=a.stores,
+        )
+        key = f"skus={size},postings={a.postings},cabinets={a.cabinets},lat={a.latency_ms},429={a.rate_429}"
+        if a.supplies:
+            key += f",supplies={a.supplies}"
+        if a.stores > 1:
+            key += f",stores={a.stores}"
+        print(f"[{key}]", flush=True)
+        workdir = tempfile.mkdtemp(prefix=f"ozon_ms_bench_{size}_")
+        result["scenarios"][key] = run_scenario(spec, workdir)
+
+    os.makedirs(a.out, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(a.out, f"{stamp}-{commit}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"results: {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
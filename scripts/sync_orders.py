@@ -1,75 +1,177 @@
 from __future__ import annotations
 
+import argparse
+import logging
+import os
+import threading
+from typing import Sequence
+from contextlib import nullcontext
 from datetime import datetime, timezone
 
 import requests
 
-from app.config import load_config
+from app import batching, ledger, metrics, profiling, shard, trace
+from app.budget import Budget, Checkpoint
+from app.breaker import CircuitOpenError
+from app.cabinets import ozon_clients, run_per_cabinet
+from app.config import CabinetConfig, Config, load_config
+from app.http import HttpError
+from app.log import flush_aggregates, log_aggregate, log_json, setup_logging
 from app.moysklad_client import MoySkladClient
-from app.ozon_client import OzonClient, OzonCreds
+from app.ozon_client import OzonClient
+from app.pipeline import KeyedPool, stage_rates
+from app.shard import ShardSet
+from app.targeted import recompute_and_push
 
-from app.orders_sync.constants import (
-    OZON_ORDERS_CUTOFF,
-    MS_SALES_CHANNEL_CAB1_ID,
-    MS_SALES_CHANNEL_CAB2_ID,
-)
+from app.orders_sync.constants import OZON_ORDERS_CUTOFF
 from app.orders_sync.ms_customerorder import CustomerOrderService
 from app.orders_sync.ms_demand import DemandService
+from app.orders_sync.outbox import (
+    OP_DEMAND_CREATE,
+    OP_DEMAND_DEDUP,
+    OP_ENSURE_PRICES,
+    OP_ORDER_UPSERT,
+    OP_POSTING,
+    OP_REMOVE_RESERVE,
+    open_outbox,
+    order_ref,
+    posting_key,
+)
+
+METRICS_JOB = "orders_sync"
 
 SHIPMENT_DATE_FROM = datetime(2025, 12, 3, tzinfo=timezone.utc)  # 03.12.2025 включительно
 
+# при лимите времени сначала то, что меняет доступный остаток: отмены и новые заказы
+STATUS_PRIORITY = {"cancelled": 0, "awaiting_packaging": 1, "awaiting_deliver": 2, "delivering": 3}
+
+# необязательные шаги при превышении мягкого бюджета вызовов (CALL_BUDGETS) остаются только
+# там, где они вероятнее нужны: цены — у только что созданных заказов, дубли отгрузок —
+# где отгрузки вообще бывают. После жёсткого — пропускаются до следующего прогона.
+SOFT_BUDGET_STATUSES = {
+    "ensure_prices": {"awaiting_packaging"},
+    "demand_dedup": {"delivering", "delivered"},
+}
+
+# постингов кабинета в работе одновременно (МС всё равно держит не больше 5 параллельных)
+POSTING_WORKERS = max(1, int(os.getenv("ORDERS_WORKERS", "4") or 4))
+
 def now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
-def main() -> None:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(prog="scripts/sync_orders.py", description="Заказы FBS Ozon -> МС")
+    ap.add_argument("--profile", action="store_true", help="профиль прогона (как SYNC_PROFILE=1)")
+    sub = ap.add_subparsers(dest="cmd")
+    p = sub.add_parser("postings", help="только указанные постинги (во всех кабинетах; шаги — заново, без журнала)")
+    p.add_argument("posting_numbers", nargs="+")
+    p.add_argument("--profile", action="store_true", default=argparse.SUPPRESS, help=argparse.SUPPRESS)
+    return ap.parse_args(argv)
+
+def main(argv: list[str] | None = None) -> int:
+    a = parse_args(argv)
     cfg = load_config()
+    setup_logging(cfg.log_level)
+    logger = logging.getLogger("sync_orders")
+    os.makedirs(cfg.cache_dir, exist_ok=True)
+    # частичный прогон — свои метрики/трейс, чтобы не затирать итоги полного
+    job = METRICS_JOB if a.cmd is None else f"{METRICS_JOB}_partial"
+    if cfg.metrics_port:
+        metrics.serve(cfg.metrics_port, job)
+
+    batching.restore(cfg.cache_dir)
+    budget = Budget(cfg.run_budget_s)
+    prof = profiling.session(cfg.cache_dir, job, logger, a.profile)
+    root = trace.span(job)
+    try:
+        with prof or nullcontext(), root:
+            if a.cmd is None and cfg.shard is not None:
+                return shard.run_sharded(
+                    cfg.shard, job, shard.plan_orders(cfg),
+                    lambda owned: run(cfg, logger, budget, shards=owned), logger, budget,
+                )
+            return run(cfg, logger, budget, only=a.posting_numbers if a.cmd == "postings" else None)
+    finally:
+        if budget.limited:
+            log_json(logger, "run_budget", **budget.summary())
+        flush_aggregates(logger)
+        trace.report(logger, root, cfg.cache_dir, job)
+        metrics.report_run(logger, cfg.cache_dir, job)
+        ledger.report(logger, cfg.cache_dir, job)
+        batching.report(logger, cfg.cache_dir, job)
+
+def run(
+    cfg: Config,
+    logger: logging.Logger,
+    budget: Budget | None = None,
+    only: Sequence[str] | None = None,
+    shards: ShardSet | None = None,
+) -> int:
+    """
+    Код выхода: 0 — все кабинеты прошли, 5 — хоть один упал (в т.ч. ошибка воркера постингов).
 
+    only — частичный прогон: только эти posting_number (кабинет определяется по fbs_get),
+    без листания списка постингов и без checkpoint полного прогона; шаги этих постингов
+    выполняются заново, даже если журнал (outbox) отмечает их сделанными.
+    shards — шарды этого воркера (SHARD_DIR): свои кабинеты, окна времени и
+    hash-корзины posting_number; checkpoint — свой на набор шардов.
+    """
+    budget = budget or Budget(0)
     ms = MoySkladClient(cfg.moysklad_token)
     co = CustomerOrderService(ms)
     dem = DemandService(ms)
 
-    accounts = [
-        (
-            "cab1",
-            OzonClient(
-                OzonCreds(
-                    name="cab1",
-                    client_id=cfg.ozon1_client_id,
-                    api_key=cfg.ozon1_api_key,
-                    warehouse_id=cfg.ozon1_warehouse_id,
-                ),
-                cache_dir=cfg.cache_dir,
-            ),
-            MS_SALES_CHANNEL_CAB1_ID,
-        ),
-        (
-            "cab2",
-            OzonClient(
-                OzonCreds(
-                    name="cab2",
-                    client_id=cfg.ozon2_client_id,
-                    api_key=cfg.ozon2_api_key,
-                    warehouse_id=cfg.ozon2_warehouse_id,
-                ),
-                cache_dir=cfg.cache_dir,
-            ),
-            MS_SALES_CHANNEL_CAB2_ID,
-        ),
-    ]
-
     date_from = OZON_ORDERS_CUTOFF
     date_to = now_utc()
 
-    for name, oz, channel_id in accounts:
-        postings = oz.fbs_list(date_from=date_from, date_to=date_to, limit=100)
+    ob = open_outbox(cfg.cache_dir)
+    log_json(logger, "outbox_loaded", path=ob.path, **ob.counts())
+
+    # постинги, до которых прошлый прогон не дошёл, — первыми
+    checkpoint = Checkpoint(cfg.cache_dir, METRICS_JOB if shards is None else f"{METRICS_JOB}@{shards.tag}")
+    resume = (checkpoint.load().get("remaining") or {}) if only is None else {}
+    remaining: dict[str, list[str]] = {}
+    # частичный прогон: постинги, найденные хоть в одном кабинете
+    found: set[str] = set()
+
+    def optional_step(op: str, key: str, status: str) -> str:
+        """
+        run — выполнять; skip — жёсткий лимит вызовов этапа, постинг не считается
+        завершённым (шаг повторится в следующий прогон); degrade — мягкий лимит,
+        шаг для этого статуса осознанно не делаем.
+        """
+        if ob.is_done(op, key):
+            return "run"  # ответ из журнала, вызовов не будет
+        lvl = ledger.level(op, logger)
+        if lvl == ledger.HARD:
+            ledger.note_skipped(op)
+            return "skip"
+        if lvl == ledger.SOFT and status not in SOFT_BUDGET_STATUSES.get(op, ()):
+            ledger.note_degraded(op)
+            return "degrade"
+        return "run"
 
-        for p in postings:
-            posting_number = p.get("posting_number")
-            if not posting_number:
-                continue
+    def sync_posting(name: str, oz: OzonClient, channel_id: str, p: dict) -> None:
+        posting_number = (p.get("posting_number") or "").strip()
+        if not posting_number:
+            return
+        list_status = (p.get("status") or "").strip().lower()
 
-            d = oz.fbs_get(posting_number)
+        # заказ уже создан/обновлён в этом статусе (прерванный прогон) — fbs_get не нужен
+        upserted = ob.result(OP_ORDER_UPSERT, posting_key(posting_number, list_status)) if list_status else None
+        if upserted is not None:
+            status = list_status
+            order = upserted["result"]
+        else:
+            try:
+                with trace.span("fbs_get"), ledger.stage("fbs_get"):
+                    d = oz.fbs_get(posting_number)
+            except HttpError as e:
+                if only is None or e.status != 404:
+                    raise
+                return  # постинг другого кабинета
             r = d.get("result") or {}
+            found.add(posting_number)
 
             posting_number = (r.get("posting_number") or "").strip()
             status = (r.get("status") or "").strip().lower()
@@ -77,56 +179,258 @@ def main() -> None:
             products = r.get("products") or []
 
             if not posting_number or not status or not shipment_date:
-                continue
+                return
+            if only is not None:
+                # точечный прогон — записи в МС заново, а не ответы из журнала
+                ob.forget(posting_key(posting_number, status))
 
             # фильтр по дате отгрузки (shipment_date) — берём только с 03.12.2025 включительно
             try:
                 sd = datetime.fromisoformat(shipment_date.replace("Z", "+00:00"))
             except Exception:
-                continue
+                return
 
             if sd < SHIPMENT_DATE_FROM:
-                continue
+                ob.done(OP_POSTING, posting_key(posting_number, status), skipped="shipment_date")
+                return
 
             try:
-                order = co.upsert_from_ozon(
-                    order_number=posting_number,      # ключ МС = posting_number
-                    ozon_status=status,
-                    shipment_date=shipment_date,
-                    products=products,
-                    sales_channel_id=channel_id,
-                    posting_number=posting_number,
-                )
+                with trace.span("upsert"), ledger.stage("upsert"):
+                    order, _ = ob.once(
+                        OP_ORDER_UPSERT, posting_key(posting_number, status),
+                        lambda: co.upsert_from_ozon(
+                            order_number=posting_number,      # ключ МС = posting_number
+                            ozon_status=status,
+                            shipment_date=shipment_date,
+                            products=products,
+                            sales_channel_id=channel_id,
+                            posting_number=posting_number,
+                        ),
+                        keep=order_ref,
+                        posting_number=posting_number,
+                    )
+            except CircuitOpenError:
+                raise
             except Exception as e:
-                print(f"[{name}] SKIP posting {posting_number}: {e}")
-                continue
+                log_aggregate("posting_skipped", group_by=("cabinet",), cabinet=name, posting_number=posting_number, error=str(e))
+                return
+
+        key = posting_key(posting_number, status)
+        complete = True
+
+        # подчистить дубли отгрузок по связанному заказу (если они уже есть)
+        step = optional_step(OP_ENSURE_PRICES, key, status)
+        if step == "run":
+            with trace.span("ensure_prices"), ledger.stage("ensure_prices"):
+                ob.once(OP_ENSURE_PRICES, key, lambda: co.ensure_prices(order))
+        elif step == "skip":
+            complete = False
+        try:
+            step = optional_step(OP_DEMAND_DEDUP, key, status)
+            if step == "run":
+                with trace.span("demand_dedup"), ledger.stage("demand_dedup"):
+                    ob.once(OP_DEMAND_DEDUP, key, lambda: dem.ensure_single_demand_for_order(order))
+            elif step == "skip":
+                complete = False
+        except requests.exceptions.RequestException as e:
+            complete = False
+            log_json(logger, "ms_request_failed", cabinet=name, step="ensure_single_demand_for_order", posting_number=posting_number, error=str(e))
 
-            # подчистить дубли отгрузок по связанному заказу (если они уже есть)
-            co.ensure_prices(order)
+        # delivering → создаём отгрузку (если нет)
+        if status == "delivering":
             try:
-                dem.ensure_single_demand_for_order(order)
+                with trace.span("demand_create"), ledger.stage("demand_create"):
+                    demand, _ = ob.once(
+                        OP_DEMAND_CREATE, key,
+                        lambda: dem.create_from_customerorder_if_missing(
+                            customerorder=order,
+                            posting_number=posting_number,
+                            sales_channel_id=channel_id,
+                        ),
+                        keep=lambda d: {"id": d.get("id")},
+                        # нет остатка — отгрузки нет, попробуем в следующий прогон
+                        done_if=lambda d: d is not None,
+                        external_code=posting_number,
+                    )
+                if demand is None:
+                    complete = False
+                    log_aggregate("demand_skipped_no_stock", group_by=("cabinet",), cabinet=name, posting_number=posting_number)
             except requests.exceptions.RequestException as e:
-                print(f"[{name}] WARN MS request failed (ensure_single_demand_for_order) {posting_number}: {e}")
+                complete = False
+                log_json(logger, "ms_request_failed", cabinet=name, step="create_demand", posting_number=posting_number, error=str(e))
+
+        # cancelled → снимаем резерв
+        if status == "cancelled":
+            with trace.span("remove_reserve"), ledger.stage("remove_reserve"):
+                ob.once(OP_REMOVE_RESERVE, key, lambda: co.remove_reserve(order))
+
+        if complete:
+            ob.done(OP_POSTING, key)
+        log_aggregate("posting_synced", group_by=("cabinet", "status"), cabinet=name, posting_number=posting_number, status=status)
+
+    def status_of(p: dict) -> str:
+        return (p.get("status") or "").strip().lower()
+
+    def by_priority(postings: list[dict]) -> list[dict]:
+        return sorted(postings, key=lambda p: STATUS_PRIORITY.get(status_of(p), len(STATUS_PRIORITY)))
+
+    def left_after(postings: list[dict], i: int) -> list[dict]:
+        return [
+            {"posting_number": x["posting_number"], "status": status_of(x)} for x in postings[i:]
+            if x.get("posting_number")
+            and not ob.is_done(OP_POSTING, posting_key(x["posting_number"], status_of(x)))
+        ]
+
+    def sync_cabinet(cab: CabinetConfig, oz: OzonClient) -> None:
+        with trace.span(f"cabinet[{cab.name}]") as cab_span:
+            # из старого checkpoint — только номера; статус тогда возьмёт fbs_get
+            carried = [
+                x if isinstance(x, dict) else {"posting_number": x}
+                for x in resume.get(cab.name) or ()
+            ]
+            if only is not None:
+                carried = [{"posting_number": pn.strip()} for pn in only if pn.strip()]
+            carried_numbers = {x.get("posting_number") for x in carried}
+            windows = [(date_from, date_to)] if shards is None else shards.windows(cab.name, date_from, date_to)
+
+            def window_postings():
+                # yield from: close() доходит до страниц окна, запрошенных наперёд
+                for since, to in windows:
+                    yield from oz.iter_fbs_postings(date_from=since, date_to=to)
+
+            pages = window_postings()
 
-            # delivering → создаём отгрузку (если нет)
-            if status == "delivering":
+            def batches():
+                # недоделанное в прошлый раз — первым, дальше страницы по мере загрузки;
+                # приоритет статусов — внутри страницы (список целиком не ждём)
+                if carried:
+                    yield by_priority(carried), True
+                while only is None:
+                    with trace.span("fbs_list") as sp, ledger.stage("fbs_list"):
+                        page = next(pages, None)
+                        sp.add_items(len(page or ()))
+                    if page is None:
+                        return
+                    yield by_priority(page), False
+
+            # постинги — параллельно, шаги одного постинга — по порядку в одном потоке
+            # (ключ — posting_number); темп запросов держит общий ratelimit
+            pool = KeyedPool(POSTING_WORKERS, name=f"posting_{cab.name.lower()}")
+            stop = threading.Event()
+            stop_reason: list[CircuitOpenError | None] = []
+            left: list[dict] = []  # не начатые постинги — в checkpoint
+            lock = threading.Lock()
+
+            def halt(err: CircuitOpenError | None = None) -> None:
+                with lock:
+                    if not stop_reason:
+                        stop_reason.append(err)
+                stop.set()
+
+            def later(ps: list[dict]) -> None:
+                with lock:
+                    left.extend(ps)
+
+            def work(p: dict) -> None:
+                if not stop.is_set() and budget.expired(0, "postings"):
+                    halt()
+                if stop.is_set():
+                    later([p])
+                    return
                 try:
-                    demand = dem.create_from_customerorder_if_missing(
-                        customerorder=order,
-                        posting_number=posting_number,
-                        sales_channel_id=channel_id,
+                    with trace.span("posting"):
+                        sync_posting(cab.name, oz, cab.sales_channel_id, p)
+                except CircuitOpenError as e:
+                    # МС или Ozon недоступен — остаток кабинета подхватит следующий прогон
+                    halt(e)
+                    later([p])
+                except BaseException:
+                    # упавший постинг — тоже в checkpoint; ошибку пул отдаст в pool.error
+                    later([p])
+                    raise
+
+            def feed() -> None:
+                for postings, is_carried in batches():
+                    for i, p in enumerate(postings):
+                        if not stop.is_set() and budget.expired(0, "postings"):
+                            halt()
+                        if stop.is_set() or pool.error is not None:
+                            # дальше список не листаем: незагруженное подхватит следующий прогон
+                            later(postings[i:])
+                            return
+                        pn = (p.get("posting_number") or "").strip()
+                        st = status_of(p)
+                        if shards is not None and not shards.has_key(pn, cab.name):
+                            # чужая hash-корзина
+                            continue
+                        if not is_carried and pn in carried_numbers:
+                            # уже обработан первым из checkpoint
+                            continue
+                        if pn and st and ob.is_done(OP_POSTING, posting_key(pn, st)):
+                            # уже синхронизирован в этом статусе — без запросов
+                            log_aggregate("posting_already_synced", group_by=("cabinet",), cabinet=cab.name, posting_number=pn)
+                            continue
+                        pool.submit(pn, work, p)
+
+            try:
+                feed()
+            finally:
+                pool.close()
+                # отменяет страницы, запрошенные наперёд
+                pages.close()
+
+            if pool.error is not None:
+                # не начатые и упавший — в checkpoint до выхода с ошибкой, иначе следующий прогон их потеряет
+                remaining[cab.name] = left_after(by_priority(left), 0)
+                log_json(logger, "posting_worker_failed", cabinet=cab.name, postings_left=len(remaining[cab.name]), error=str(pool.error))
+                raise pool.error
+            log_json(
+                logger, "posting_pipeline", cabinet=cab.name, **pool.summary(),
+                stages=stage_rates(cab_span.node.children.get("posting") if cab_span.node else None, pool.elapsed()),
+            )
+            if stop_reason:
+                remaining[cab.name] = left_after(by_priority(left), 0)
+                err = stop_reason[0]
+                if err is None:
+                    log_json(logger, "postings_budget_exhausted", cabinet=cab.name, postings_left=len(remaining[cab.name]))
+                else:
+                    log_json(
+                        logger, "cabinet_aborted", cabinet=cab.name, reason="circuit_open",
+                        host=err.host, endpoint_class=err.endpoint_class, postings_left=len(remaining[cab.name]),
                     )
-                    if demand is None:
-                        print(f"[{name}] SKIP demand for {posting_number}: no stock in MS")
-                except requests.exceptions.RequestException as e:
-                    print(f"[{name}] WARN MS request failed (create demand) {posting_number}: {e}")
 
-            # cancelled → снимаем резерв
-            if status == "cancelled":
-                co.remove_reserve(order)
+    # кабинеты независимы (общий только МС) — синхронизируем параллельно
+    clients = ozon_clients(cfg)
+    own = shards.cabinets(cab.name for cab, _ in clients) if shards is not None else None
+    try:
+        results = run_per_cabinet(sync_cabinet, [(cab, oz) for cab, oz in clients if own is None or cab.name in own])
+    finally:
+        ob.close()
+        try:
+            if only is not None:
+                pass  # checkpoint полного прогона не трогаем
+            elif remaining:
+                checkpoint.save({"remaining": remaining})
+            else:
+                checkpoint.clear()
+        except Exception as e:
+            log_json(logger, "checkpoint_write_failed", error=str(e))
+    rc = 0
+    for name, (_, err) in results.items():
+        if err is not None:
+            log_json(logger, "cabinet_failed", cabinet=name, error=str(err))
+            rc = 5
+    if only is not None:
+        missing = sorted({pn.strip() for pn in only if pn.strip()} - found)
+        log_json(logger, "partial_sync_done", postings=len(only), found=len(found), not_found=missing, remaining=remaining)
 
-            print(f"[{name}] synced {posting_number} status={status}")
+    # резервы поменялись — отправляем эти остатки сразу, не дожидаясь полного stock sync
+    try:
+        recompute_and_push(cfg, ms, clients, co.touched, logger)
+    except Exception as e:
+        log_json(logger, "targeted_push_failed", error=str(e))
+    return rc
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+CABINETS = ("OZON1", "OZON2")
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    """Минимальное окружение load_config: два кабинета, свой CACHE_DIR."""
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("MOYSKLAD_TOKEN", "test")
+    monkeypatch.setenv("MOYSKLAD_STORE_ID", "00000000-0000-0000-0000-000000000001")
+    monkeypatch.setenv("OZON_CABINETS", ",".join(CABINETS))
+    monkeypatch.setenv("CACHE_DIR", str(cache_dir))
+    monkeypatch.setenv("METRICS_PORT", "0")
+    monkeypatch.delenv("SHARD_DIR", raising=False)
+    monkeypatch.delenv("SYNC_PROFILE", raising=False)
+    for i, name in enumerate(CABINETS):
+        monkeypatch.setenv(f"{name}_CLIENT_ID", str(100000 + i))
+        monkeypatch.setenv(f"{name}_API_KEY", "test")
+        monkeypatch.setenv(f"{name}_WAREHOUSE_ID", str(22000000000000 + i))
+        monkeypatch.setenv(f"{name}_SALES_CHANNEL_ID", f"00000000-0000-0000-0000-{i:012d}")
+        monkeypatch.delenv(f"{name}_WAREHOUSES", raising=False)
+    return tmp_path
@@ -0,0 +1,44 @@
+import sqlite3
+
+from app import shard
+from scripts import sync_orders
+
+
+def _done(shard_dir) -> dict:
+    db = sqlite3.connect(str(shard_dir / shard.LEASE_FILE))
+    try:
+        return {n: d for n, d in db.execute("SELECT name, done_at FROM leases WHERE name NOT LIKE '@%'")}
+    finally:
+        db.close()
+
+
+def test_failed_orders_shard_stays_not_done(env, monkeypatch):
+    shard_dir = env / "shards"
+    monkeypatch.setenv("SHARD_DIR", str(shard_dir))
+    monkeypatch.setenv("SHARD_BY", "cabinet")
+    monkeypatch.setenv("SHARD_WORKER_ID", "w1")
+    # доля воркера — один шард: каждый кабинет берётся и завершается отдельно
+    monkeypatch.setenv("SHARD_WORKERS", "2")
+    monkeypatch.setattr(sync_orders, "setup_logging", lambda level: None)
+
+    def run_per_cabinet(fn, items):
+        # кабинет OZON2 падает целиком, OZON1 проходит
+        return {
+            cab.name: (None, RuntimeError("boom") if cab.name == "OZON2" else None)
+            for cab, _ in items
+        }
+
+    monkeypatch.setattr(sync_orders, "run_per_cabinet", run_per_cabinet)
+
+    assert sync_orders.main([]) == 5
+    done = _done(shard_dir)
+    assert done["OZON1:cabinet:0/1"] > 0
+    assert done["OZON2:cabinet:0/1"] == 0
+
+    # в том же раунде несделанный шард снова можно взять
+    store = shard.LeaseStore(str(shard_dir / shard.LEASE_FILE), "w2", 60)
+    try:
+        got, _ = store.claim(["OZON1:cabinet:0/1", "OZON2:cabinet:0/1"], 2, 240)
+    finally:
+        store.close()
+    assert got == ["OZON2:cabinet:0/1"]